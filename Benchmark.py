@@ -0,0 +1,1097 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module contains the benchmarks for the hot paths of the probe data mapping
+Each benchmark can be run from the command line, e.g.
+
+    python3 Benchmark.py distance --candidates 30 --points 200
+    python3 Benchmark.py linkstore probe_data_map_matching/Partition6467LinkData.csv
+    python3 Benchmark.py linkparse probe_data_map_matching/Partition6467LinkData.csv --workers 1 2 4 8
+    python3 Benchmark.py probeparse probe_data_map_matching/Partition6467LinkData.csv probe_data_map_matching/Partition6467ProbePoints.csv --workers 1 2 4 8
+    python3 Benchmark.py probememory probe_data_map_matching/Partition6467ProbePoints.csv
+    python3 Benchmark.py sort probe_data_map_matching/Partition6467ProbePoints.csv --memory 16
+    python3 Benchmark.py schedule probe_data_map_matching/Partition6467LinkData.csv probe_data_map_matching/Partition6467ProbePoints.csv --skew 20
+    python3 Benchmark.py candidates probe_data_map_matching/Partition6467LinkData.csv probe_data_map_matching/Partition6467ProbePoints.csv
+    python3 Benchmark.py geometry probe_data_map_matching/Partition6467LinkData.csv --candidates 30 --points 200
+    python3 Benchmark.py prefilter probe_data_map_matching/Partition6467LinkData.csv probe_data_map_matching/Partition6467ProbePoints.csv
+    python3 Benchmark.py sequential probe_data_map_matching/Partition6467LinkData.csv --trips 200 --links 6
+    python3 Benchmark.py slope probe_data_map_matching/Partition6467ProbePoints.csv --window 5
+    python3 Benchmark.py linkstats probe_data_map_matching/MatchedPoints.csv probe_data_map_matching/MatchedPointsSlope.csv --parts 8
+    python3 Benchmark.py stages --links 20000 --trajectories 5000 --points 60 --skew 1.0 --json stages.json
+    python3 Benchmark.py compress probe_data_map_matching/Partition6467LinkData.csv probe_data_map_matching/Partition6467ProbePoints.csv --distance 10
+    python3 Benchmark.py candidatecache probe_data_map_matching/Partition6467LinkData.csv probe_data_map_matching/Partition6467ProbePoints.csv --sizes 0 1 64
+    python3 Benchmark.py resultstore probe_data_map_matching/MatchedPoints.csv probe_data_map_matching/MatchedPointsSlope.csv --queries 200
+
+The stages benchmark runs on synthetic data (see SyntheticData), so it needs no partition files, and its json report
+can be compared between commits with --compare old.json
+"""
+
+import argparse
+import csv
+import gc
+import json
+import math
+import os
+import pickle
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from itertools import islice
+
+import numpy as np
+
+from LinkData import LinkData, calcdistanceFromRefMatrix, calcdistanceFromLinkMatrix, greatCircleMatrix, distanceFromLinkMatrix, matchCandidates
+from LinkGeometry import LinkGeometry
+from CandidateFilter import CandidateFilter
+from CandidateCache import CandidateCache
+from SequentialMatcher import LinkAdjacency, matchSequential
+from ProbeData import ProbeData, ProbeAdditionalInfo, slopeArray, setSlopes, refnodeArray
+from LinkDataProcess import LinkDataProcess
+from LinkStore import ProbeStore
+from ExternalSort import sortProbeFile
+from Scheduler import localityBatches, fileOrderBatches, defaultChunksize, batchStats
+from ProbeDataProcess import ProbeDataProcess
+from SpatialIndex import SegmentGridIndex
+from SlopeAggregation import SlopeAccumulator
+from SyntheticData import generateData
+from ResultWriter import MatchedPointsWriter
+
+
+def timeit(func, repeat):
+    """
+    run func repeat times, return the best wall clock time in seconds and the last result
+    """
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def randomLinks(num, center=(51.0, 9.0), spread=0.05, seed=0):
+    """
+    generate num random straight links around center, for the distance benchmarks
+    """
+    rnd = random.Random(seed)
+    links = []
+    for i in range(num):
+        lat, lon = center[0] + rnd.uniform(-spread, spread), center[1] + rnd.uniform(-spread, spread)
+        refInfo = (lat, lon, rnd.uniform(90, 130))
+        nonrefInfo = (lat + rnd.uniform(-0.002, 0.002), lon + rnd.uniform(-0.002, 0.002), rnd.uniform(90, 130))
+        links.append(LinkData(str(i), str(i + 1), 'F', refInfo, nonrefInfo, [], [(0.0, 1.0)]))
+    return links
+
+
+def randomPoints(num, center=(51.0, 9.0), spread=0.05, seed=1):
+    """
+    generate num random probe points around center
+    """
+    rnd = random.Random(seed)
+    return [(center[0] + rnd.uniform(-spread, spread), center[1] + rnd.uniform(-spread, spread), rnd.uniform(90, 130))
+            for _ in range(num)]
+
+
+def benchDistance(candidates, points, repeat):
+    """
+    compare the scalar geopy path of LinkData with the vectorized (candidates x points) kernels
+    both the time and the maximum absolute difference (in meters) are reported
+    """
+    links = randomLinks(candidates)
+    pointlist = randomPoints(points)
+
+    def geopyPath():
+        return ([link.calcdistanceFromRef(pointlist) for link in links],
+                [link.calcdistanceFromLink(pointlist) for link in links])
+
+    def numpyPath():
+        return calcdistanceFromRefMatrix(links, pointlist), calcdistanceFromLinkMatrix(links, pointlist)
+
+    geopytime, (geopyref, geopylink) = timeit(geopyPath, repeat)
+    numpytime, (numpyref, numpylink) = timeit(numpyPath, repeat)
+
+    report = {
+        'candidates': candidates,
+        'points': points,
+        'geopy_s': geopytime,
+        'numpy_s': numpytime,
+        'speedup': geopytime / numpytime if numpytime else float('inf'),
+        'max_abs_diff_ref_m': float(np.max(np.abs(np.array(geopyref) - numpyref))),
+        'max_abs_diff_link_m': float(np.max(np.abs(np.array(geopylink) - numpylink))),
+    }
+    return report
+
+
+def tracedMemory(func):
+    """
+    run func under tracemalloc, rtype: result, bytes still allocated by the result
+    """
+    tracemalloc.start()
+    try:
+        result = func()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current
+
+
+def benchLinkStore(sourcepath, linkfilename):
+    """
+    compare the columnar LinkStore with the old dict of LinkData objects on a link file,
+    memory held, pickle size and unpickle time are reported
+    """
+    with tempfile.TemporaryDirectory() as tgtpath:
+        linkstore, storememory = tracedMemory(lambda: LinkDataProcess(sourcepath, linkfilename, tgtpath).loadData()[2])
+    linkInfo, dictmemory = tracedMemory(linkstore.toLinkInfo)
+
+    report = {'links': len(linkstore), 'dict_bytes': dictmemory, 'store_bytes': storememory, 'store_array_bytes': linkstore.nbytes()}
+    for name, content in (('dict', linkInfo), ('store', linkstore)):
+        data = pickle.dumps(content, protocol=pickle.HIGHEST_PROTOCOL)
+        loadtime, _ = timeit(lambda: pickle.loads(data), 3)
+        report[name + '_pickle_bytes'] = len(data)
+        report[name + '_unpickle_s'] = loadtime
+    report['memory_saving'] = 1.0 - float(storememory) / dictmemory
+    return report
+
+
+def benchLinkParse(sourcepath, linkfilename, workerlist):
+    """
+    time the link file parse with each number of workers, and check the result is identical to the serial parse
+    """
+    report, serial = {}, None
+    for workers in workerlist:
+        process = LinkDataProcess(sourcepath, linkfilename, '', workers=workers)
+        parsetime, (geohashmap7prec, geohashmap8prec, linkstore) = timeit(process.parseData, 1)
+        if serial is None:
+            serial = (dict(geohashmap7prec), dict(geohashmap8prec), linkstore.arrays())
+            report['links'] = len(linkstore)
+        identical = serial[0] == dict(geohashmap7prec) and serial[1] == dict(geohashmap8prec) and \
+            all(np.array_equal(values, serial[2][name]) for name, values in linkstore.arrays().items() if values.dtype.kind != 'f') and \
+            all(np.array_equal(values, serial[2][name], equal_nan=True) for name, values in linkstore.arrays().items() if values.dtype.kind == 'f')
+        report['workers_{}_s'.format(workers)] = parsetime
+        report['workers_{}_identical'.format(workers)] = identical
+    return report
+
+
+def benchProbeParse(linkfile, probefile, workerlist):
+    """
+    time the probe file parse (with the candidate lookup) with each number of workers,
+    and check the result is identical to the serial parse
+    """
+    sourcepath, linkfilename = os.path.split(os.path.abspath(linkfile))
+    with tempfile.TemporaryDirectory() as tgtpath:
+        geohashmap7prec, geohashmap8prec, linkstore = LinkDataProcess(sourcepath, linkfilename, tgtpath).loadData()
+    probepath, probefilename = os.path.split(os.path.abspath(probefile))
+
+    def serialParse():
+        probeInfo, addiInfo = [], []
+        for probe, addi in process.iterData():
+            probeInfo.append(probe)
+            addiInfo.append(addi)
+        return ProbeStore.fromProbeInfo(probeInfo, addiInfo, linkstore)
+
+    report, serial = {}, None
+    for workers in workerlist:
+        process = ProbeDataProcess(probepath, probefilename, '', geohashmap7prec, geohashmap8prec, linkstore=linkstore, workers=workers)
+        parsetime, probestore = timeit(process.parseParallel if workers > 1 else serialParse, 1)
+        if serial is None:
+            serial = probestore.arrays()
+            report['trajectories'] = len(probestore)
+        report['workers_{}_s'.format(workers)] = parsetime
+        report['workers_{}_identical'.format(workers)] = all(np.array_equal(values, serial[name]) for name, values in probestore.arrays().items())
+    return report
+
+
+def readProbeRows(probefile):
+    """
+    read the rows of a probe data csv grouped by consecutive sampleID, rtype: list of lists of rows
+    """
+    groups, previd = [], None
+    with open(probefile, 'r') as f:
+        for line in csv.reader(f):
+            if len(line) != 8:
+                continue
+            if line[0] != previd:
+                groups.append([])
+                previd = line[0]
+            groups[-1].append(line)
+    return groups
+
+
+def benchProbeMemory(probefile):
+    """
+    compare the compact ProbeData and ProbeAdditionalInfo with plain lists of tuples and raw strings,
+    i.e. the representation before, memory held and pickle size are reported
+    """
+    groups = readProbeRows(probefile)
+
+    def plainProbes():
+        return [(rows[0][0], [(float(row[3]), float(row[4]), float(row[5])) for row in rows],
+                 [row[1] for row in rows], [row[2] for row in rows], [row[6] for row in rows], [row[7] for row in rows])
+                for rows in groups]
+
+    def compactProbes():
+        return [(ProbeData(rows[0][0], 0.0, [(float(row[3]), float(row[4]), float(row[5])) for row in rows], '', []),
+                 ProbeAdditionalInfo([row[1] for row in rows], [row[2] for row in rows], [row[6] for row in rows], [row[7] for row in rows]))
+                for rows in groups]
+
+    plain, plainmemory = tracedMemory(plainProbes)
+    compact, compactmemory = tracedMemory(compactProbes)
+    identical = all(probe.shapeInfo == shapeInfo and addi.dateTimelist == dateTimes and addi.sourceCodelist == sourceCodes
+                    and addi.speedlist == speeds and addi.headinglist == headings
+                    for (probe, addi), (_, shapeInfo, dateTimes, sourceCodes, speeds, headings) in zip(compact, plain))
+
+    report = {'trajectories': len(groups), 'points': sum(len(rows) for rows in groups),
+              'plain_bytes': plainmemory, 'compact_bytes': compactmemory, 'memory_saving': 1.0 - float(compactmemory) / plainmemory,
+              'plain_pickle_bytes': len(pickle.dumps(plain, protocol=pickle.HIGHEST_PROTOCOL)),
+              'compact_pickle_bytes': len(pickle.dumps(compact, protocol=pickle.HIGHEST_PROTOCOL)),
+              'text_identical': identical}
+    return report
+
+
+def benchSort(probefile, memory, fanin):
+    """
+    external sort of a copy of the probe file with its rows shuffled, the throughput is reported
+    """
+    with open(probefile, 'rb') as f:
+        lines = f.readlines()
+    random.Random(0).shuffle(lines)
+    with tempfile.TemporaryDirectory() as tgtpath:
+        shuffledfile = os.path.join(tgtpath, 'shuffled.csv')
+        with open(shuffledfile, 'wb') as f:
+            f.writelines(line if line.endswith(b'\n') else line + b'\r\n' for line in lines)
+        return sortProbeFile(shuffledfile, os.path.join(tgtpath, 'sorted.csv'), memorylimit=memory << 20, fanin=fanin)
+
+
+def skewProbes(probeInfo, skew, fraction=0.05, seed=0):
+    """
+    make a skewed partition: the points of a random fraction of the trajectories are repeated skew times
+    """
+    rnd = random.Random(seed)
+    return [ProbeData(probe.sampleID, probe.duration, probe.shapeInfo * skew, probe.geohashtag, probe.candidatelist)
+            if rnd.random() < fraction else probe for probe in probeInfo]
+
+
+def benchSchedule(linkfile, probefile, skew, workers, batchpoints):
+    """
+    compare pool.map in file order with the locality scheduling on a (skewed) partition,
+    wall clock time of the mapping, balance and locality of the batches are reported
+    """
+    from ProbeMapMatching import attachLinkInfo, matchProbeBatch
+    from multiprocessing import Pool
+
+    sourcepath, linkfilename = os.path.split(os.path.abspath(linkfile))
+    probepath, probefilename = os.path.split(os.path.abspath(probefile))
+    with tempfile.TemporaryDirectory() as tgtpath:
+        geohashmap7prec, geohashmap8prec, linkstore = LinkDataProcess(sourcepath, linkfilename, tgtpath).loadData()
+        probeInfo, _ = ProbeDataProcess(probepath, probefilename, tgtpath, geohashmap7prec, geohashmap8prec).loadData()
+    probeInfo = skewProbes(probeInfo, skew) if skew > 1 else probeInfo
+
+    schedules = (('file_order', fileOrderBatches(probeInfo, defaultChunksize(len(probeInfo), workers))),
+                 ('locality', localityBatches(probeInfo, batchpoints, workers)))
+    report = {'trajectories': len(probeInfo), 'points': sum(probe.numpoints for probe in probeInfo)}
+    with Pool(workers, initializer=attachLinkInfo, initargs=(linkstore,)) as pool:
+        for name, batches in schedules:
+            tasks = [(batch, [probeInfo[idx] for idx in batch]) for batch in batches]
+            # file order keeps the static assignment of pool.map, locality lets idle workers take the next batch
+            mapper = pool.map if name == 'file_order' else lambda func, items: list(pool.imap_unordered(func, items))
+            report[name + '_s'], _ = timeit(lambda: mapper(matchProbeBatch, tasks), 3)
+            for key, value in batchStats(probeInfo, batches).items():
+                report[name + '_' + key] = value
+    return report
+
+
+def readTrajectories(probefile, limit=None):
+    """
+    read the point lists of the trajectories of a probe data csv, grouped by consecutive sampleID
+    """
+    trajectories, previd = [], None
+    with open(probefile, 'r') as f:
+        for line in csv.reader(f):
+            if len(line) != 8:
+                continue
+            if line[0] != previd:
+                if limit and len(trajectories) == limit:
+                    break
+                trajectories.append([])
+                previd = line[0]
+            trajectories[-1].append((float(line[3]), float(line[4]), float(line[5])))
+    return trajectories
+
+
+def candidateStats(probeProcess, trajectories):
+    """
+    time calcCandidateLinks for each trajectory, rtype: dict of candidate count and latency statistics
+    """
+    counts, latencies = [], []
+    for shapeInfo in trajectories:
+        start = time.perf_counter()
+        _, candidatelist = probeProcess.calcCandidateLinks(shapeInfo)
+        latencies.append(time.perf_counter() - start)
+        counts.append(len(candidatelist) if candidatelist else 0)
+    counts, latencies = np.array(counts), np.array(latencies) * 1e6
+    return {'found': float(np.mean(counts > 0)), 'mean_candidates': float(np.mean(counts)),
+            'median_candidates': float(np.median(counts)), 'p95_candidates': float(np.percentile(counts, 95)),
+            'mean_latency_us': float(np.mean(latencies)), 'p99_latency_us': float(np.percentile(latencies, 99))}
+
+
+def benchCandidates(linkfile, probefile, limit, radius, k):
+    """
+    compare the candidate lookup with the ref node geohash maps and with the segment spatial index
+    """
+    sourcepath, linkfilename = os.path.split(os.path.abspath(linkfile))
+    with tempfile.TemporaryDirectory() as tgtpath:
+        geohashmap7prec, geohashmap8prec, linkstore = LinkDataProcess(sourcepath, linkfilename, tgtpath).loadData()
+    buildtime, spatialindex = timeit(lambda: SegmentGridIndex.fromLinkStore(linkstore), 1)
+    trajectories = readTrajectories(probefile, limit)
+
+    geohashprocess = ProbeDataProcess('', '', '', geohashmap7prec, geohashmap8prec)
+    indexprocess = ProbeDataProcess('', '', '', geohashmap7prec, geohashmap8prec, spatialindex, linkstore)
+    indexprocess.searchradius, indexprocess.maxcandidates = radius, k
+
+    report = {'trajectories': len(trajectories), 'index_build_s': buildtime}
+    for name, probeProcess in (('geohash', geohashprocess), ('segment_index', indexprocess)):
+        for key, value in candidateStats(probeProcess, trajectories).items():
+            report[name + '_' + key] = value
+    return report
+
+
+def pointsOnShape(linkstore, links, seed=0):
+    """
+    one point on the polyline of each link, at a random fraction of a random segment
+    rtype: points: (L, 3) array, arc: (L,) array, great circle distance from the ref node along the polyline to the point
+    """
+    rnd = np.random.RandomState(seed)
+    points, arc = [], []
+    for idx in links:
+        nodes = np.asarray(linkstore.coords[linkstore.polyoffsets[idx]:linkstore.polyoffsets[idx + 1]])
+        steps = greatCircleMatrix(nodes[:-1, 0], nodes[:-1, 1], nodes[1:, 0], nodes[1:, 1])
+        seg, frac = rnd.randint(len(nodes) - 1), rnd.uniform()
+        points.append(nodes[seg] + frac * (nodes[seg + 1] - nodes[seg]))
+        arc.append(steps[:seg].sum() + frac * steps[seg])
+    return np.array(points), np.array(arc)
+
+
+def benchGeometry(linkfile, candidates, points, repeat, seed=0):
+    """
+    compare the distances along the precomputed link polylines with the ref node and ref-nonref line kernels
+    the errors are measured on points lying on the links with shape nodes, where the true distFromLink is 0
+    and the true distFromRef is the length of the polyline up to the point
+    """
+    sourcepath, linkfilename = os.path.split(os.path.abspath(linkfile))
+    with tempfile.TemporaryDirectory() as tgtpath:
+        linkstore = LinkDataProcess(sourcepath, linkfilename, tgtpath).loadData()[2]
+    buildtime, geometry = timeit(lambda: LinkGeometry.fromLinkStore(linkstore), repeat)
+
+    curved = np.flatnonzero(np.diff(linkstore.polyoffsets) > 2)
+    onshape, arc = pointsOnShape(linkstore, curved, seed)
+    shaperef, shapelink = np.array([[value[0, 0] for value in geometry.polylineDistances([idx], point[np.newaxis])]
+                                    for idx, point in zip(curved, onshape)]).T
+    lineref = greatCircleMatrix(linkstore.endpoints[curved, 0], linkstore.endpoints[curved, 1], onshape[:, 0], onshape[:, 1])
+    linelink = np.array([distanceFromLinkMatrix(linkstore.endpoints[idx:idx+1], point[np.newaxis])[0, 0]
+                         for idx, point in zip(curved, onshape)])
+
+    rnd = np.random.RandomState(seed + 1)
+    links = rnd.choice(len(linkstore), candidates, replace=False)
+    pointarray = linkstore.endpoints[rnd.choice(len(linkstore), points), :3] + rnd.uniform(-0.0005, 0.0005, (points, 3))
+    linetime, _ = timeit(lambda: matchCandidates(linkstore.endpoints[links], pointarray), repeat)
+    shapetime, _ = timeit(lambda: geometry.matchCandidates(links, pointarray), repeat)
+
+    return {'links': len(linkstore), 'curved_links': len(curved), 'build_s': buildtime, 'geometry_bytes': sum(array.nbytes for array in geometry.arrays().values()),
+            'candidates': candidates, 'points': points, 'line_match_s': linetime, 'shape_match_s': shapetime,
+            'line_median_ref_error_m': float(np.median(np.abs(lineref - arc))), 'line_max_ref_error_m': float(np.max(np.abs(lineref - arc))),
+            'shape_median_ref_error_m': float(np.median(np.abs(shaperef - arc))),
+            'shape_max_ref_error_m': float(np.max(np.abs(shaperef - arc))),
+            'line_median_link_error_m': float(np.median(linelink)), 'line_max_link_error_m': float(np.max(linelink)),
+            'shape_max_link_error_m': float(np.max(shapelink))}
+
+
+def benchPrefilter(linkfile, probefile, margin, tolerance, minspeed, repeat):
+    """
+    compare the scoring of every trajectory on its candidate links without and with the candidate pre-filter,
+    in a single process, the pre-filter stage is timed separately as it runs once when the probe cache is built
+    the fraction of pruned candidates, the times and the trajectories whose matched link changed are reported
+    """
+    from ProbeMapMatching import matchProbeData
+
+    sourcepath, linkfilename = os.path.split(os.path.abspath(linkfile))
+    probepath, probefilename = os.path.split(os.path.abspath(probefile))
+    with tempfile.TemporaryDirectory() as tgtpath:
+        geohashmap7prec, geohashmap8prec, linkstore = LinkDataProcess(sourcepath, linkfilename, tgtpath).loadData()
+    probes = list(ProbeDataProcess(probepath, probefilename, '', geohashmap7prec, geohashmap8prec).iterData())
+    buildtime, candidatefilter = timeit(lambda: CandidateFilter(linkstore, margin=margin, tolerance=tolerance, minspeed=minspeed), 1)
+
+    def prune():
+        candidatefilter.numcandidates, candidatefilter.numpruned = 0, 0
+        return [candidatefilter.pruneCandidates(probe.candidatelist, probe.points, addi.headinglist, addi.speedlist) for probe, addi in probes]
+
+    def score(candidatelists):
+        return [candidatelist[matchCandidates(linkstore.endpoints[linkstore.indices(candidatelist)], probe.points)[0]]
+                for (probe, _), candidatelist in zip(probes, candidatelists)]
+
+    def match(candidatelists):
+        return [matchProbeData(ProbeData(probe.sampleID, probe.duration, probe.shapeInfo, probe.geohashtag, candidatelist), linkstore).maplinkID
+                for (probe, _), candidatelist in zip(probes, candidatelists)]
+
+    plainlists = [probe.candidatelist for probe, _ in probes]
+    filtertime, filteredlists = timeit(prune, repeat)
+    plaintime, plain = timeit(lambda: score(plainlists), repeat)
+    scoretime, filtered = timeit(lambda: score(filteredlists), repeat)
+    plainmatchtime, _ = timeit(lambda: match(plainlists), repeat)
+    matchtime, _ = timeit(lambda: match(filteredlists), repeat)
+    changed = [(probe.sampleID, before, after) for (probe, _), before, after in zip(probes, plain, filtered) if before != after]
+    return {'trajectories': len(probes), 'filter_build_s': buildtime,
+            'candidates': sum(len(candidates) for candidates in plainlists),
+            'candidates_after_filter': sum(len(candidates) for candidates in filteredlists),
+            'pruned_fraction': candidatefilter.numpruned / float(candidatefilter.numcandidates or 1),
+            'filter_s': filtertime, 'plain_score_s': plaintime, 'filtered_score_s': scoretime,
+            'score_speedup': plaintime / scoretime if scoretime else float('inf'),
+            'plain_match_s': plainmatchtime, 'filtered_match_s': matchtime,
+            'match_speedup': plainmatchtime / matchtime if matchtime else float('inf'),
+            'end_to_end_speedup': plainmatchtime / (filtertime + matchtime),
+            'changed_links': len(changed),
+            'changed': ' '.join('{}:{}->{}'.format(sampleID, before, after) for sampleID, before, after in changed)}
+
+
+def syntheticTrips(linkstore, adjacency, trips, numlinks, spacing, noise, seed=0):
+    """
+    random trips over chains of adjacent links, with a point every spacing meters along the links and gaussian noise
+    rtype: list of (points, true link index of each point)
+    """
+    rnd = np.random.RandomState(seed)
+    result = []
+    while len(result) < trips:
+        chain = [rnd.randint(len(linkstore))]
+        while len(chain) < numlinks:
+            neighbors = [link for link in adjacency.neighbors[adjacency.offsets[chain[-1]]:adjacency.offsets[chain[-1] + 1]].tolist() if link not in chain]
+            if not neighbors:
+                break
+            chain.append(neighbors[rnd.randint(len(neighbors))])
+        if len(chain) < numlinks:
+            continue
+
+        points, truth, prevnodes = [], [], None
+        for idx in chain:
+            nodes = np.asarray(linkstore.coords[linkstore.polyoffsets[idx]:linkstore.polyoffsets[idx + 1]])
+            nodes = nodes[np.isfinite(nodes[:, :2]).all(axis=1)]
+            nodes[:, 2] = np.nan_to_num(nodes[:, 2])
+            # travel the link from the node shared with the previous one
+            if prevnodes is not None and linkstore.nonrefnode[idx] in prevnodes:
+                nodes = nodes[::-1]
+            prevnodes = (linkstore.refnode[idx], linkstore.nonrefnode[idx])
+            steps = greatCircleMatrix(nodes[:-1, 0], nodes[:-1, 1], nodes[1:, 0], nodes[1:, 1])
+            arc = np.concatenate(([0.0], np.cumsum(steps)))
+            for at in np.arange(spacing / 2.0, arc[-1], spacing):
+                seg = min(np.searchsorted(arc, at, side='right') - 1, len(steps) - 1)
+                frac = (at - arc[seg]) / steps[seg] if steps[seg] else 0.0
+                point = nodes[seg] + frac * (nodes[seg + 1] - nodes[seg])
+                point[:2] += rnd.normal(0.0, noise / 111195.08, 2) * (1.0, 1.0 / np.cos(np.radians(point[0])))
+                points.append(point)
+                truth.append(idx)
+        if points:
+            result.append((np.array(points), np.array(truth)))
+    return result
+
+
+def benchSequential(linkfile, trips, numlinks, spacing, noise, beamwidths, repeat):
+    """
+    compare the whole trajectory matcher with the sequential matcher on synthetic trips over several links,
+    the fraction of points mapped to their true link and the time per trajectory are reported
+    """
+    from ProbeMapMatching import matchProbeData
+
+    sourcepath, linkfilename = os.path.split(os.path.abspath(linkfile))
+    with tempfile.TemporaryDirectory() as tgtpath:
+        linkProcess = LinkDataProcess(sourcepath, linkfilename, tgtpath)
+        linkstore = linkProcess.loadData()[2]
+        adjacencytime, adjacency = timeit(lambda: LinkAdjacency.fromLinkStore(linkstore), 1)
+        spatialindex = linkProcess.loadSpatialIndex(linkstore)
+    linkstore.geometry = LinkGeometry.fromLinkStore(linkstore)
+
+    tripdata = syntheticTrips(linkstore, adjacency, trips, numlinks, spacing, noise)
+    probes = []
+    for points, truth in tripdata:
+        candidates = spatialindex.queryTrajectory(points[:, 0], points[:, 1], 50.0, 4 * numlinks)
+        probes.append(([str(linkPVID) for linkPVID in linkstore.linkPVIDs[candidates].tolist()], points, truth))
+
+    def run(matcher):
+        return [matcher(ProbeData(None, 0, [tuple(point) for point in points.tolist()], None, candidatelist))
+                for candidatelist, points, _ in probes]
+
+    def accuracy(mapped):
+        correct = total = 0
+        for probe, (_, _, truth) in zip(mapped, probes):
+            linkids = probe.maplinkIDs or [probe.maplinkID] * probe.numpoints
+            correct += int(np.sum(linkstore.indices(linkids) == truth))
+            total += len(truth)
+        return correct / float(total)
+
+    report = {'trips': len(probes), 'points': sum(len(truth) for _, _, truth in probes),
+              'mean_candidates': float(np.mean([len(candidatelist) for candidatelist, _, _ in probes])),
+              'adjacency_build_s': adjacencytime}
+    wholetime, mapped = timeit(lambda: run(lambda probe: matchProbeData(probe, linkstore)), repeat)
+    report['whole_accuracy'], report['whole_us_per_trip'] = accuracy(mapped), wholetime / len(probes) * 1e6
+    linkstore.adjacency = adjacency
+    for beamwidth in beamwidths:
+        seqtime, mapped = timeit(lambda: run(lambda probe: matchSequential(probe, linkstore, beamwidth)), repeat)
+        report['beam_{}_accuracy'.format(beamwidth)] = accuracy(mapped)
+        report['beam_{}_us_per_trip'.format(beamwidth)] = seqtime / len(probes) * 1e6
+    return report
+
+
+def benchSlope(probefile, limit, window, repeat, seed=0):
+    """
+    compare the per point slopeDegree loop with the batched slopeArray on the trajectories of a probe file,
+    each trajectory starting from a ref node near its first point
+    the time, the maximum absolute difference in degrees and whether the zero slopes are the same points are reported
+    """
+    rnd = np.random.RandomState(seed)
+    trajectories = readTrajectories(probefile, limit)
+    refnodes = [(points[0][0] + rnd.uniform(-0.0005, 0.0005), points[0][1] + rnd.uniform(-0.0005, 0.0005), points[0][2] + rnd.uniform(-5, 5))
+                for points in trajectories]
+    probes = [ProbeData(None, 0, points, None, None) for points in trajectories]
+
+    def loopSlopes():
+        result = []
+        for probe, refnode in zip(probes, refnodes):
+            prev = refnode
+            for cur in probe.shapeInfo:
+                result.append(probe.slopeDegree(prev, cur))
+                prev = cur
+        return result
+
+    def trajectorySlopes():
+        for probe, refnode in zip(probes, refnodes):
+            probe.slpoe = []
+            probe.setSlope(refnode)
+        return [slope for probe in probes for slope in probe.slpoe]
+
+    def batchSlopes():
+        for probe in probes:
+            probe.slpoe = []
+        setSlopes(probes, refnodes)
+        return [slope for probe in probes for slope in probe.slpoe]
+
+    looptime, expected = timeit(loopSlopes, repeat)
+    trajtime, pertrajectory = timeit(trajectorySlopes, repeat)
+    batchtime, batched = timeit(batchSlopes, repeat)
+
+    offsets = np.concatenate(([0], np.cumsum([probe.numpoints for probe in probes])))
+    points = np.concatenate([probe.points for probe in probes])
+    smoothed = slopeArray(points, offsets, refnodeArray(refnodes), window)
+    raw = slopeArray(points, offsets, refnodeArray(refnodes))
+    return {'trajectories': len(probes), 'points': len(expected),
+            'loop_s': looptime, 'per_trajectory_s': trajtime, 'batched_s': batchtime,
+            'per_trajectory_speedup': looptime / trajtime, 'batched_speedup': looptime / batchtime,
+            'max_abs_diff_deg': max(abs(a - b) for a, b in zip(expected, batched)) if expected else 0.0,
+            'same_integer_zeros': [type(slope) is int for slope in expected] == [type(slope) is int for slope in batched],
+            'per_trajectory_identical_to_batched': pertrajectory == batched,
+            'window': window, 'raw_std_deg': float(np.nanstd(raw)), 'smoothed_std_deg': float(np.nanstd(smoothed))}
+
+
+def benchLinkStats(mappedfile, slopefile, parts, repeat):
+    """
+    compare a dict of lists per link with the SlopeAccumulator on the rows of a finished run,
+    and the accumulator of the whole run with the merge of parts accumulators over interleaved slices of the rows
+    """
+    with open(mappedfile, 'r') as mapf, open(slopefile, 'r') as slopef:
+        linkIDs = [row[8] for row in islice(csv.reader(mapf, delimiter = ','), 1, None)]
+        sloperows = list(islice(csv.reader(slopef, delimiter = ','), 1, None))
+    slopes = [float(row[5]) for row in sloperows]
+    linkslopes = [float(row[6]) if row[6] != '' else None for row in sloperows]
+
+    def loopStats():
+        grouped = {}
+        for linkID, slope, linkslope in zip(linkIDs, slopes, linkslopes):
+            grouped.setdefault(linkID, []).append((slope, linkslope))
+        stats = {}
+        for linkID, values in grouped.items():
+            errors = [slope - linkslope for slope, linkslope in values if linkslope is not None]
+            stats[linkID] = (len(values), sum(slope for slope, _ in values) / len(values), float(np.median([slope for slope, _ in values])),
+                             math.sqrt(sum(error ** 2 for error in errors) / len(errors)) if errors else float('nan'),
+                             sum(errors) / len(errors) if errors else float('nan'))
+        return stats
+
+    def accumulatorStats():
+        accumulator = SlopeAccumulator()
+        accumulator.add(linkIDs, slopes, linkslopes)
+        return accumulator.table()
+
+    def mergedStats():
+        accumulator = SlopeAccumulator()
+        for part in range(parts):
+            partial = SlopeAccumulator()
+            partial.add(linkIDs[part::parts], slopes[part::parts], linkslopes[part::parts])
+            accumulator.merge(partial)
+        return accumulator.table()
+
+    looptime, expected = timeit(loopStats, repeat)
+    acctime, table = timeit(accumulatorStats, repeat)
+    mergetime, merged = timeit(mergedStats, repeat)
+
+    exact = np.array([expected[linkID] for linkID in table['linkPVID'].tolist()])
+    ours = np.column_stack([table[name] for name in ('count', 'meanSlope', 'medianSlope', 'rmse', 'bias')])
+    diff = np.abs(exact - ours)
+    return {'points': len(linkIDs), 'links': len(table['linkPVID']),
+            'loop_s': looptime, 'accumulator_s': acctime, 'merged_s': mergetime, 'speedup': looptime / acctime,
+            'max_abs_diff_mean_rmse_bias': float(np.nanmax(diff[:, [1, 3, 4]])) if len(diff) else 0.0,
+            'max_abs_diff_median': float(diff[:, 2].max()) if len(diff) else 0.0,
+            'median_resolution': SlopeAccumulator.resolution,
+            'merged_max_abs_diff': max(float(np.nanmax(np.abs(table[name] - merged[name]), initial=0.0))
+                                       for name in table if name != 'linkPVID')}
+
+
+def benchCompress(linkfile, probefile, distance, seconds, repeat, sequential=False):
+    """
+    compare the mapping of every row with the mapping of the stationary point compression, in a single process,
+    with the whole trajectory matcher or the sequential one
+    the reduction of the points which are mapped, the parse, match and expand times, and the rows whose link, distances
+    or slope changed after the expansion are reported, with the RMSE of both
+    """
+    from ProbeMapMatching import matchProbeList
+
+    sourcepath, linkfilename = os.path.split(os.path.abspath(linkfile))
+    probepath, probefilename = os.path.split(os.path.abspath(probefile))
+    with tempfile.TemporaryDirectory() as tgtpath:
+        linkProcess = LinkDataProcess(sourcepath, linkfilename, tgtpath)
+        geohashmap7prec, geohashmap8prec, linkstore = linkProcess.loadData()
+        if sequential:
+            linkstore.geometry = LinkGeometry.fromLinkStore(linkstore)
+            linkstore.adjacency = linkProcess.loadAdjacency(linkstore)
+    parsetime, full = timeit(lambda: list(ProbeDataProcess(probepath, probefilename, '', geohashmap7prec, geohashmap8prec).iterData()), repeat)
+    compressedparsetime, compressed = timeit(lambda: list(ProbeDataProcess(probepath, probefilename, '', geohashmap7prec, geohashmap8prec,
+                                                                           compress=(distance, seconds)).iterData()), repeat)
+
+    def match(probes):
+        # fresh copies for each repeat, the mapping sets the results on the ProbeData
+        copies = [pickle.loads(blob) for blob in [pickle.dumps([probe for probe, _ in probes])] * repeat]
+        # the objects alive so far are left out of the garbage collection, which would otherwise slow the second timing
+        gc.collect()
+        gc.freeze()
+        try:
+            return timeit(lambda: matchProbeList(copies.pop(), linkstore), repeat)
+        finally:
+            gc.unfreeze()
+
+    matchtime, fullresult = match(full)
+    compressedmatchtime, compressedresult = match(compressed)
+    expandtime, _ = timeit(lambda: [probe.expand() for probe in compressedresult], 1)
+
+    fullwriter, compressedwriter = MatchedPointsWriter(None, None, linkstore), MatchedPointsWriter(None, None, linkstore)
+    changedlinks = changeddistances = changedslopes = 0
+    for fullprobe, compressedprobe, (_, addiinfo) in zip(fullresult, compressedresult, full):
+        fullrows, fullsloperows = fullwriter.probeRows(fullprobe, addiinfo)
+        rows, sloperows = compressedwriter.probeRows(compressedprobe, addiinfo)
+        changedlinks += sum(a[8] != b[8] for a, b in zip(fullrows, rows))
+        changeddistances += sum(a[9:] != b[9:] for a, b in zip(fullrows, rows))
+        changedslopes += sum(a[5] != b[5] for a, b in zip(fullsloperows, sloperows))
+
+    rows = sum(probe.numpoints for probe, _ in full)
+    points = sum(probe.numpoints for probe, _ in compressed)
+    return {'trajectories': len(full), 'rows': rows, 'mapped_points': points, 'reduction': 1.0 - points / float(rows or 1),
+            'compressed_trajectories': sum(probe.repeats is not None for probe, _ in compressed),
+            'distance_evaluations': sum(len(probe.candidatelist) * probe.numpoints for probe, _ in full),
+            'compressed_distance_evaluations': sum(len(probe.candidatelist) * probe.numpoints for probe, _ in compressed),
+            'distance_m': distance, 'seconds': seconds, 'sequential': sequential,
+            'parse_s': parsetime, 'compressed_parse_s': compressedparsetime,
+            'match_s': matchtime, 'compressed_match_s': compressedmatchtime,
+            'match_speedup': matchtime / compressedmatchtime if compressedmatchtime else float('inf'), 'expand_s': expandtime,
+            'rows_written': compressedwriter.totalnum, 'changed_link_rows': changedlinks,
+            'changed_distance_rows': changeddistances, 'changed_slope_rows': changedslopes,
+            'rmse': fullwriter.rmse() if fullwriter.totalnum else None,
+            'compressed_rmse': compressedwriter.rmse() if compressedwriter.totalnum else None}
+
+
+def benchCandidateCache(linkfile, probefile, sizelist, shapedistance, prefilter, sequential, repeat):
+    """
+    time the probe parse (with the candidate lookup, and the pre-filter if set) and the matching, in a single process,
+    with a candidate cache of each size in megabytes, 0 for none, see CandidateCache
+    the hit rates and evictions of the cell cache of the parse and of the candidate cache of the matching are reported,
+    and whether the results are identical to those without a cache
+    """
+    from ProbeMapMatching import matchProbeList
+
+    sourcepath, linkfilename = os.path.split(os.path.abspath(linkfile))
+    probepath, probefilename = os.path.split(os.path.abspath(probefile))
+    with tempfile.TemporaryDirectory() as tgtpath:
+        linkProcess = LinkDataProcess(sourcepath, linkfilename, tgtpath)
+        geohashmap7prec, geohashmap8prec, linkstore = linkProcess.loadData()
+        if shapedistance or sequential:
+            linkstore.geometry = LinkGeometry.fromLinkStore(linkstore)
+        if sequential:
+            linkstore.adjacency = linkProcess.loadAdjacency(linkstore)
+    candidatefilter = CandidateFilter(linkstore, linkstore.geometry) if prefilter else None
+
+    report, baseline = {}, None
+    for size in sizelist:
+        cachebytes = int(size * (1 << 20))
+        processes = []
+
+        def parse():
+            processes.append(ProbeDataProcess(probepath, probefilename, '', geohashmap7prec, geohashmap8prec, linkstore=linkstore,
+                                              candidatefilter=candidatefilter, cachebytes=cachebytes))
+            return [probe for probe, _ in processes[-1].iterData()]
+        parsetime, probes = timeit(parse, repeat)
+
+        # fresh copies and a fresh cache for each repeat, the mapping sets the results on the ProbeData
+        copies = [pickle.loads(blob) for blob in [pickle.dumps(probes)] * repeat]
+        caches = [CandidateCache(cachebytes) if cachebytes else None for _ in range(repeat)]
+
+        def match():
+            linkstore.candidatecache = caches.pop()
+            return matchProbeList(copies.pop(), linkstore)
+        gc.collect()
+        gc.freeze()
+        try:
+            matchtime, result = timeit(match, repeat)
+        finally:
+            gc.unfreeze()
+        matchcache, linkstore.candidatecache = linkstore.candidatecache, None
+
+        values = [(probe.candidatelist, probe.maplinkID, probe.maplinkIDs, probe.distFromRef, probe.distFromLink, probe.slpoe) for probe in result]
+        if baseline is None:
+            baseline = values
+            report.update(trajectories=len(result), points=sum(probe.numpoints for probe in result),
+                          cells=len(set(probe.geohashtag for probe in result)), candidate_lists=len(set(tuple(value[0]) for value in values)))
+        key = 'cache_{:g}mb'.format(size)
+        report[key + '_parse_s'] = parsetime
+        report[key + '_match_s'] = matchtime
+        for name, cache in (('cell', processes[-1].cellcache), ('candidate', matchcache)):
+            stats = cache.stats() if cache is not None else CandidateCache(0).stats()
+            report['{}_{}_hit_rate'.format(key, name)] = stats['hit_rate']
+            report['{}_{}_evictions'.format(key, name)] = stats['evictions']
+            report['{}_{}_mb'.format(key, name)] = stats['bytes'] / float(1 << 20)
+        report[key + '_identical'] = values == baseline
+    return report
+
+
+def benchResultStore(mappedfile, slopefile, queries, seed=0):
+    """
+    load the output files of a run into a ResultStore and query it
+    the load rate in this process (with the index build), the time the output writing takes without and with a
+    ResultStoreWriter process loading the rows as they are written (and the wait for its last rows and indexes), and the p50 / p99 latency of
+    queries on random links, trajectories and one hour time ranges are reported, with a csv scan of one link to compare
+    """
+    from ResultStore import ResultStore, ResultStoreWriter
+
+    groups = [[], []]
+    with open(mappedfile, 'r') as mapped, open(slopefile, 'r') as slope:
+        maprows, sloperows = csv.reader(mapped), csv.reader(slope)
+        next(maprows, None)
+        next(sloperows, None)
+        previd = None
+        for maprow, sloperow in zip(maprows, sloperows):
+            if maprow[0] != previd:
+                groups[0].append([])
+                groups[1].append([])
+                previd = maprow[0]
+            groups[0][-1].append(maprow)
+            groups[1][-1].append(sloperow)
+    rows = sum(len(maprows) for maprows in groups[0])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbpath = os.path.join(tmpdir, 'MatchedPoints.db')
+        start = time.perf_counter()
+        store = ResultStore(dbpath, create=True)
+        store.loadCsv(mappedfile, slopefile)
+        loadtime = time.perf_counter() - start
+        start = time.perf_counter()
+        store.createIndexes()
+        indextime = time.perf_counter() - start
+        store.close()
+
+        def write(storewriter):
+            # the rows of each trajectory as MatchedPointsWriter.writeProbe writes them
+            with MatchedPointsWriter(os.path.join(tmpdir, 'mapped.csv'), os.path.join(tmpdir, 'slope.csv'), {}, store=storewriter) as writer:
+                for maprows, sloperows in zip(*groups):
+                    writer.writeRows(maprows, sloperows)
+        writetime, _ = timeit(lambda: write(None), 1)
+        storepath = os.path.join(tmpdir, 'written.db')
+        start = time.perf_counter()
+        with ResultStoreWriter(storepath) as storewriter:
+            write(storewriter)
+            storewritetime = time.perf_counter() - start
+        storetotaltime = time.perf_counter() - start
+
+        random.seed(seed)
+        with ResultStore(dbpath) as store:
+            links = [row[0] for row in store.connection.execute('SELECT DISTINCT linkPVID FROM points')]
+            samples = [row[0] for row in store.connection.execute('SELECT DISTINCT sampleID FROM points')]
+            first, last = store.connection.execute('SELECT min(dateTime), max(dateTime) FROM points').fetchone()
+            report = {'rows': rows, 'links': len(links), 'trajectories': len(samples), 'db_mb': os.path.getsize(dbpath) / float(1 << 20),
+                      'load_s': loadtime, 'load_rows_per_s': rows / loadtime, 'index_s': indextime,
+                      'write_s': writetime, 'write_with_store_s': storewritetime, 'write_with_store_total_s': storetotaltime,
+                      'writer_process_load_s': storewriter.report['load_s'], 'writer_process_index_s': storewriter.report['index_s']}
+            cases = (('link', lambda: store.link(random.choice(links))),
+                     ('trajectory', lambda: store.trajectory(random.choice(samples))),
+                     ('time_range_1h', lambda: store.timeRange(*(lambda t: (t, t + 3600))(random.randint(first, max(first, last - 3600))))))
+            for name, query in cases:
+                latencies, sizes = [], []
+                for _ in range(queries):
+                    start = time.perf_counter()
+                    sizes.append(len(query()))
+                    latencies.append(time.perf_counter() - start)
+                latencies = np.array(latencies) * 1e3
+                report[name + '_p50_ms'] = float(np.percentile(latencies, 50))
+                report[name + '_p99_ms'] = float(np.percentile(latencies, 99))
+                report[name + '_mean_rows'] = float(np.mean(sizes))
+
+    linkPVID = random.choice(links)
+    start = time.perf_counter()
+    with open(mappedfile, 'r') as mapped:
+        scanned = sum(1 for row in csv.reader(mapped) if row[8] == linkPVID)
+    report['csv_scan_link_ms'] = (time.perf_counter() - start) * 1e3
+    report['csv_scan_rows'] = scanned
+    return report
+
+
+def peakRss():
+    """
+    rtype: float, peak resident set size of this process so far in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchStages(numlinks, numtrajectories, numpoints, skew, seed, workdir=None, window=1):
+    """
+    time each stage of the pipeline on synthetic data, in this process and from cold caches:
+    link parse (with the geohash maps), probe parse with the candidate lookup, matching, slope and output
+    each stage reports its seconds, the probe points per second and the peak RSS of the process after it
+    """
+    from ProbeMapMatching import matchProbeData
+    tmpdir = workdir or tempfile.mkdtemp(prefix='stages')
+    try:
+        start = time.perf_counter()
+        data = generateData(os.path.join(tmpdir, 'data'), numlinks, numtrajectories, numpoints, skew, seed)
+        generatetime = time.perf_counter() - start
+        tgtpath = os.path.join(tmpdir, 'output')
+        if os.path.isdir(tgtpath):
+            shutil.rmtree(tgtpath)
+        os.makedirs(tgtpath)
+
+        stages = {}
+
+        def stage(name, func):
+            start = time.perf_counter()
+            # the progress messages of the pipeline go to stderr, so stdout is only the report
+            with redirect_stdout(sys.stderr):
+                result = func()
+            stages[name] = {'seconds': time.perf_counter() - start, 'peak_rss_mb': peakRss()}
+            return result
+
+        linkProcess = LinkDataProcess(os.path.join(tmpdir, 'data'), data['linkfile'], tgtpath)
+        geohashmap7prec, geohashmap8prec, linkInfo = stage('link_parse', linkProcess.loadData)
+        linkInfo.slopewindow = window
+        probeProcess = ProbeDataProcess(os.path.join(tmpdir, 'data'), data['probefile'], tgtpath, geohashmap7prec, geohashmap8prec,
+                                        linkstore=linkInfo, linkfile=linkProcess.sourcefile)
+        probes, addiinfos = stage('probe_parse', probeProcess.loadData)
+        stage('matching', lambda: [matchProbeData(probe, linkInfo, setslope=False) for probe in probes])
+        stage('slope', lambda: setSlopes(probes, [linkInfo[probe.maplinkID].refInfo for probe in probes], window))
+
+        def output():
+            with MatchedPointsWriter(os.path.join(tgtpath, 'MatchedPoints.csv'), os.path.join(tgtpath, 'MatchedPointsSlope.csv'), linkInfo) as writer:
+                for probe, addiinfo in zip(probes, addiinfos):
+                    writer.writeProbe(probe, addiinfo)
+        stage('output', output)
+
+        points = sum(probe.numpoints for probe in probes)
+        for report in stages.values():
+            report['points_per_s'] = points / report['seconds'] if report['seconds'] else float('inf')
+        return {'commit': gitCommit(), 'links': numlinks, 'trajectories': len(probes), 'points': points,
+                'generated_points': data['points'], 'skew': skew, 'seed': seed, 'window': window, 'generate_s': generatetime,
+                'total_s': sum(report['seconds'] for report in stages.values()), 'peak_rss_mb': peakRss(), 'stages': stages}
+    finally:
+        if workdir is None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def compareStages(report, baseline):
+    """
+    rtype: dict, seconds of each stage relative to the baseline report, above 1 is slower
+    """
+    ratios = {name: stagereport['seconds'] / baseline['stages'][name]['seconds']
+              for name, stagereport in report['stages'].items() if baseline['stages'].get(name, {}).get('seconds')}
+    if baseline.get('total_s'):
+        ratios['total'] = report['total_s'] / baseline['total_s']
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the probe data mapping')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    distparser = subparsers.add_parser('distance', help='geopy distance loop vs vectorized kernels')
+    distparser.add_argument('--candidates', type=int, default=30)
+    distparser.add_argument('--points', type=int, default=200)
+    distparser.add_argument('--repeat', type=int, default=3)
+
+    storeparser = subparsers.add_parser('linkstore', help='memory of the columnar LinkStore vs dict of LinkData')
+    storeparser.add_argument('linkfile', help='path of a link data csv, e.g. Partition6467LinkData.csv')
+
+    parseparser = subparsers.add_parser('linkparse', help='scaling of the parallel link file parse')
+    parseparser.add_argument('linkfile')
+    parseparser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+
+    probeparser = subparsers.add_parser('probeparse', help='scaling of the parallel probe file parse')
+    probeparser.add_argument('linkfile')
+    probeparser.add_argument('probefile')
+    probeparser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+
+    memparser = subparsers.add_parser('probememory', help='memory of the compact ProbeData and ProbeAdditionalInfo vs plain lists')
+    memparser.add_argument('probefile')
+
+    sortparser = subparsers.add_parser('sort', help='throughput of the external sort of a shuffled probe file')
+    sortparser.add_argument('probefile')
+    sortparser.add_argument('--memory', type=int, default=64, help='megabytes of memory taken by the rows of each sorted run')
+    sortparser.add_argument('--fanin', type=int, default=64)
+
+    schedparser = subparsers.add_parser('schedule', help='file order pool.map vs locality scheduling of the mapping')
+    schedparser.add_argument('linkfile')
+    schedparser.add_argument('probefile')
+    schedparser.add_argument('--skew', type=int, default=20, help='repeat the points of 5%% of the trajectories SKEW times')
+    schedparser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    schedparser.add_argument('--batchpoints', type=int, default=4096)
+
+    candparser = subparsers.add_parser('candidates', help='candidate counts and latency of the geohash maps vs the segment index')
+    candparser.add_argument('linkfile')
+    candparser.add_argument('probefile')
+    candparser.add_argument('--limit', type=int, default=None, help='only use the first LIMIT trajectories')
+    candparser.add_argument('--radius', type=float, default=50.0)
+    candparser.add_argument('--k', type=int, default=8)
+
+    geomparser = subparsers.add_parser('geometry', help='distances along the precomputed link polylines vs the ref node and ref-nonref line')
+    geomparser.add_argument('linkfile')
+    geomparser.add_argument('--candidates', type=int, default=30)
+    geomparser.add_argument('--points', type=int, default=200)
+    geomparser.add_argument('--repeat', type=int, default=3)
+
+    filterparser = subparsers.add_parser('prefilter', help='candidate pruning by bounding box, heading and direction before scoring')
+    filterparser.add_argument('linkfile')
+    filterparser.add_argument('probefile')
+    filterparser.add_argument('--margin', type=float, default=50.0, help='meters the link bounding boxes are grown by')
+    filterparser.add_argument('--tolerance', type=float, default=45.0, help='degrees between heading and link bearing')
+    filterparser.add_argument('--minspeed', type=float, default=5.0, help='km/h below which the heading is not used')
+    filterparser.add_argument('--repeat', type=int, default=3)
+
+    seqparser = subparsers.add_parser('sequential', help='whole trajectory vs per point beam matching on synthetic multi link trips')
+    seqparser.add_argument('linkfile')
+    seqparser.add_argument('--trips', type=int, default=200)
+    seqparser.add_argument('--links', type=int, default=6, help='number of adjacent links per trip')
+    seqparser.add_argument('--spacing', type=float, default=20.0, help='meters between two points')
+    seqparser.add_argument('--noise', type=float, default=5.0, help='standard deviation of the position noise in meters')
+    seqparser.add_argument('--beamwidths', type=int, nargs='+', default=[1, 3, 5, 8])
+    seqparser.add_argument('--repeat', type=int, default=3)
+
+    slopeparser = subparsers.add_parser('slope', help='per point slopeDegree loop vs batched slopeArray')
+    slopeparser.add_argument('probefile')
+    slopeparser.add_argument('--limit', type=int, default=None, help='only use the first LIMIT trajectories')
+    slopeparser.add_argument('--window', type=int, default=5, help='smoothing window reported next to the raw slopes')
+    slopeparser.add_argument('--repeat', type=int, default=3)
+
+    statsparser = subparsers.add_parser('linkstats', help='dict of lists per link vs the mergeable SlopeAccumulator on the output files of a run')
+    statsparser.add_argument('mappedfile')
+    statsparser.add_argument('slopefile')
+    statsparser.add_argument('--parts', type=int, default=8, help='number of accumulators merged, as with parallel or streaming runs')
+    statsparser.add_argument('--repeat', type=int, default=3)
+
+    stagesparser = subparsers.add_parser('stages', help='seconds, points per second and peak RSS of each pipeline stage on synthetic data')
+    stagesparser.add_argument('--links', type=int, default=10000)
+    stagesparser.add_argument('--trajectories', type=int, default=2000)
+    stagesparser.add_argument('--points', type=int, default=50, help='mean number of points per trajectory')
+    stagesparser.add_argument('--skew', type=float, default=0.0, help='0 for evenly spread trajectories, larger for a few hot spots')
+    stagesparser.add_argument('--seed', type=int, default=0)
+    stagesparser.add_argument('--window', type=int, default=1, help='slope window, see --slope-window')
+    stagesparser.add_argument('--workdir', default=None, help='folder for the data and output, kept after the run, by default a temporary folder')
+    stagesparser.add_argument('--json', default=None, help='also write the report to this json file')
+    stagesparser.add_argument('--compare', default=None, help='json report of an earlier run, the time ratio of each stage is reported')
+
+    compressparser = subparsers.add_parser('compress', help='mapping every row vs mapping one point per run of stationary points')
+    compressparser.add_argument('linkfile')
+    compressparser.add_argument('probefile')
+    compressparser.add_argument('--distance', type=float, default=10.0, help='meters from the first point of a run, see --stationary-distance')
+    compressparser.add_argument('--seconds', type=float, default=60.0, help='seconds from the first point of a run, see --stationary-seconds')
+    compressparser.add_argument('--sequential', action='store_true', help='match with the sequential matcher, see --sequential')
+    compressparser.add_argument('--repeat', type=int, default=3)
+
+    cacheparser = subparsers.add_parser('candidatecache', help='probe parse and matching without and with the per cell candidate cache')
+    cacheparser.add_argument('linkfile')
+    cacheparser.add_argument('probefile')
+    cacheparser.add_argument('--sizes', type=float, nargs='+', default=[0, 1, 64], help='megabytes of each cache, 0 for none, see --candidate-cache')
+    cacheparser.add_argument('--shape-distance', action='store_true', help='match with the link geometry, see --shape-distance')
+    cacheparser.add_argument('--prefilter', action='store_true', help='prune the candidates at parse time, see --prefilter')
+    cacheparser.add_argument('--sequential', action='store_true', help='match with the sequential matcher, see --sequential')
+    cacheparser.add_argument('--repeat', type=int, default=3)
+
+    storeparser = subparsers.add_parser('resultstore', help='load rate and query latency of the SQLite result store on the output files of a run')
+    storeparser.add_argument('mappedfile')
+    storeparser.add_argument('slopefile')
+    storeparser.add_argument('--queries', type=int, default=200, help='number of queries of each kind')
+
+    args = parser.parse_args()
+    if args.benchmark == 'distance':
+        report = benchDistance(args.candidates, args.points, args.repeat)
+    elif args.benchmark == 'linkstore':
+        report = benchLinkStore(*os.path.split(os.path.abspath(args.linkfile)))
+    elif args.benchmark == 'linkparse':
+        report = benchLinkParse(*os.path.split(os.path.abspath(args.linkfile)), workerlist=args.workers)
+    elif args.benchmark == 'probeparse':
+        report = benchProbeParse(args.linkfile, args.probefile, args.workers)
+    elif args.benchmark == 'probememory':
+        report = benchProbeMemory(args.probefile)
+    elif args.benchmark == 'sort':
+        report = benchSort(args.probefile, args.memory, args.fanin)
+    elif args.benchmark == 'schedule':
+        report = benchSchedule(args.linkfile, args.probefile, args.skew, args.workers, args.batchpoints)
+    elif args.benchmark == 'candidates':
+        report = benchCandidates(args.linkfile, args.probefile, args.limit, args.radius, args.k)
+    elif args.benchmark == 'geometry':
+        report = benchGeometry(args.linkfile, args.candidates, args.points, args.repeat)
+    elif args.benchmark == 'prefilter':
+        report = benchPrefilter(args.linkfile, args.probefile, args.margin, args.tolerance, args.minspeed, args.repeat)
+    elif args.benchmark == 'sequential':
+        report = benchSequential(args.linkfile, args.trips, args.links, args.spacing, args.noise, args.beamwidths, args.repeat)
+    elif args.benchmark == 'slope':
+        report = benchSlope(args.probefile, args.limit, args.window, args.repeat)
+    elif args.benchmark == 'linkstats':
+        report = benchLinkStats(args.mappedfile, args.slopefile, args.parts, args.repeat)
+    elif args.benchmark == 'compress':
+        report = benchCompress(args.linkfile, args.probefile, args.distance, args.seconds, args.repeat, args.sequential)
+    elif args.benchmark == 'candidatecache':
+        report = benchCandidateCache(args.linkfile, args.probefile, args.sizes, args.shape_distance, args.prefilter, args.sequential, args.repeat)
+    elif args.benchmark == 'resultstore':
+        report = benchResultStore(args.mappedfile, args.slopefile, args.queries)
+    elif args.benchmark == 'stages':
+        report = benchStages(args.links, args.trajectories, args.points, args.skew, args.seed, args.workdir, args.window)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=1)
+        if args.compare:
+            with open(args.compare, 'r') as f:
+                report['ratio_to_baseline'] = compareStages(report, json.load(f))
+        print(json.dumps(report, indent=1))
+        return
+    else:
+        parser.print_help()
+        return
+
+    for key, value in report.items():
+        print('{}: {}'.format(key, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module memoizes the setup work which only depends on the candidate links of a geohash cell
+Many trajectories fall in the same cell and so get the same candidate list. The probe parse keeps, per cell, the
+resolved candidate list of the precision 8 / precision 7 lookup and the link bounding boxes and segment bearings of
+the candidate pre-filter. The matching keeps, per candidate set, the link indices, the endpoints, the polyline segments
+in the frames of their links and the adjacency matrix of the sequential matcher. Both are bounded LRU caches of
+maxbytes bytes, local to each process, the least recently used entries are evicted first. Their hits, misses and
+evictions are counted in the run report with --metrics, see Metrics.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+import Metrics
+
+# bytes of each cache by default, see --candidate-cache
+DEFAULTMAXBYTES = 64 << 20
+
+
+class CandidateCache(object):
+    """
+    LRU cache of values built from their key, bounded by the sum of the sizes given by the builder
+    """
+    def __init__(self, maxbytes=DEFAULTMAXBYTES, name='candidate_cache'):
+        """
+        maxbytes type: int, entries are evicted while the total size is above it, 0 for no cache at all
+        name type: str, prefix of the counters, e.g. candidate_cache_hits
+        """
+        self.maxbytes = maxbytes
+        self.name = name
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, build):
+        """
+        build type: function, called on a miss, rtype: (value, size in bytes)
+        rtype: the value of key
+        """
+        if not self.maxbytes:
+            return build()[0]
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            Metrics.count(self.name + '_hits')
+            return entry[0]
+        self.misses += 1
+        Metrics.count(self.name + '_misses')
+        value, size = build()
+        if size <= self.maxbytes:
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+                Metrics.count(self.name + '_evictions')
+            Metrics.maximum(self.name + '_bytes', self.nbytes)
+        return value
+
+    def stats(self):
+        """
+        rtype: dict of the counters, the number of entries and their total size
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self.entries),
+                'bytes': self.nbytes, 'maxbytes': self.maxbytes, 'hit_rate': self.hits / float(lookups) if lookups else 0.0}
+
+    def __getstate__(self):
+        # a copy sent to another process starts empty
+        return {'maxbytes': self.maxbytes, 'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+class CandidateSet(object):
+    """
+    The arrays of one candidate list the distance kernels need, see matchProbeData, only those of the mode of the
+    link store are gathered
+    """
+    __slots__ = ('links', 'endpoints', 'segments', 'connected')
+
+    def __init__(self, linkstore, links):
+        """
+        links type: (C,) int array of the link indices of the candidates
+        """
+        self.links = np.asarray(links, dtype=np.int64)
+        # (C, 4) endpoints for LinkData.matchCandidates, or LinkGeometry.candidateSegments with the link geometry
+        self.endpoints = linkstore.endpoints[self.links] if linkstore.geometry is None else None
+        self.segments = linkstore.geometry.candidateSegments(self.links) if linkstore.geometry is not None else None
+        # (C, C) LinkAdjacency.connected matrix, only for the sequential matcher
+        self.connected = linkstore.adjacency.connected(self.links) if linkstore.adjacency is not None else None
+
+    @property
+    def nbytes(self):
+        arrays = [self.links, self.endpoints, self.connected] + list(self.segments or ())
+        return sum(array.nbytes for array in arrays if array is not None)
+
+
+def candidateSet(linkstore, candidates):
+    """
+    candidates type: list of linkPVIDs or int array of link indices
+    rtype: CandidateSet of the candidates, kept in the candidatecache of the link store if it has one
+    the key is the candidates themselves rather than their geohash cell, as the candidate filter can prune the links
+    of a cell differently for each trajectory
+    """
+    def build():
+        links = candidates if isinstance(candidates, np.ndarray) else linkstore.indices(candidates)
+        candidateset = CandidateSet(linkstore, links)
+        return candidateset, candidateset.nbytes
+
+    if linkstore.candidatecache is None:
+        return build()[0]
+    key = candidates.tobytes() if isinstance(candidates, np.ndarray) else tuple(candidates)
+    return linkstore.candidatecache.get(key, build)
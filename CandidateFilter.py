@@ -0,0 +1,128 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module is the cheap rejection stage run on the candidate links of a trajectory before the exact distance scoring
+A candidate link is rejected if
+    1. no point of the trajectory is inside the bounding box of the link grown by margin meters, or
+    2. the points inside that box are moving (speed >= minspeed) but none of them has a heading within tolerance
+       degrees of the bearing of a segment of the link, in the directionOfTravel of the link
+       (F: from the ref node, T: towards the ref node, B: both)
+If every candidate would be rejected the list is kept as it is, so a trajectory never loses its candidates.
+"""
+
+import numpy as np
+
+from LinkGeometry import LinkGeometry
+from SpatialIndex import expandRanges
+
+# meters per degree of latitude, with the radius of LinkData
+METERSPERDEGREE = 111195.08
+
+
+class CandidateFilter(object):
+    """
+    Bounding boxes and segment bearings of the links of a LinkStore, see pruneCandidates
+    """
+    def __init__(self, linkstore, geometry=None, margin=50.0, tolerance=45.0, minspeed=5.0):
+        """
+        geometry type: LinkGeometry of linkstore, built if not given
+        margin type: float, meters the bounding boxes are grown by
+        tolerance type: float, degrees between a probe heading and a link bearing to agree
+        minspeed type: float, km/h, the heading of a slower point is not used
+        """
+        self.linkstore = linkstore
+        self.geometry = geometry if geometry is not None else LinkGeometry.fromLinkStore(linkstore)
+        self.margin = margin
+        self.tolerance = tolerance
+        self.minspeed = minspeed
+
+        # (N, 4) min latitude, min longitude, max latitude, max longitude of every link, shape nodes without
+        # coordinates are ignored
+        coords = np.asarray(linkstore.coords)[:, :2]
+        starts = np.asarray(linkstore.polyoffsets[:-1], dtype=np.int64)
+        self.bboxes = np.column_stack((np.fmin.reduceat(coords, starts, axis=0), np.fmax.reduceat(coords, starts, axis=0)))
+        # F: 0, T: 1, B: 2
+        direction = np.asarray(linkstore.direction).astype(str)
+        self.directions = np.where(direction == 'F', 0, np.where(direction == 'T', 1, 2))
+        self.numcandidates, self.numpruned = 0, 0
+
+    def params(self):
+        """
+        rtype: dict, the parameters the pruned candidates depend on
+        """
+        return {'margin': self.margin, 'tolerance': self.tolerance, 'minspeed': self.minspeed}
+
+    def candidateBoxes(self, links):
+        """
+        the grown bounding boxes and the segments of the links gathered for keepMask, they only depend on the links
+        so they can be reused for every trajectory with the same candidates, see CandidateCache
+        links type: (C,) int array of link indices
+        rtype: tuple of the (C, 1) min latitude, max latitude, min longitude and max longitude columns of the grown boxes,
+                the (S, 1) bearings and directions and the (S,) valid mask of the S segments, the (C,) int64 firsts of the
+                segments of each link
+        """
+        links = np.asarray(links, dtype=np.int64)
+        bboxes = self.bboxes[links]
+        latmargin = self.margin / METERSPERDEGREE
+        lonmargin = latmargin / np.maximum(np.cos(np.radians(bboxes[:, 0])), 1e-6)
+        starts = self.geometry.polyoffsets[links]
+        counts = self.geometry.polyoffsets[links + 1] - 1 - starts
+        segstart = expandRanges(starts, starts + counts)
+        return ((bboxes[:, 0] - latmargin)[:, np.newaxis], (bboxes[:, 2] + latmargin)[:, np.newaxis],
+                (bboxes[:, 1] - lonmargin)[:, np.newaxis], (bboxes[:, 3] + lonmargin)[:, np.newaxis],
+                self.geometry.bearing[segstart, np.newaxis], np.repeat(self.directions[links], counts)[:, np.newaxis],
+                (self.geometry.seglength[segstart] > 0)[:, np.newaxis], np.cumsum(counts) - counts)
+
+    def keepMask(self, links, points, headings=None, speeds=None, boxes=None):
+        """
+        links type: (C,) int array of link indices
+        points type: (P, 2+) array of (latitude, longitude, ...) in degrees
+        headings, speeds type: (P,) float arrays, or None to use the bounding boxes only
+        boxes type: candidateBoxes(links), gathered here if not given
+        rtype: (C,) bool array, the candidates which pass
+        """
+        if boxes is None:
+            boxes = self.candidateBoxes(links)
+        minlat, maxlat, minlon, maxlon, bearings, directions, validsegment, firsts = boxes
+        points = np.asarray(points, dtype=np.float64)
+        inbox = ((points[np.newaxis, :, 0] >= minlat) & (points[np.newaxis, :, 0] <= maxlat) &
+                 (points[np.newaxis, :, 1] >= minlon) & (points[np.newaxis, :, 1] <= maxlon))
+        keep = inbox.any(axis=1)
+        if headings is None or speeds is None:
+            return keep
+
+        # heading of each point against the bearing of each segment of each link, (S, P)
+        forward = np.abs((headings[np.newaxis, :] - bearings + 180.0) % 360.0 - 180.0) <= self.tolerance
+        backward = np.abs((headings[np.newaxis, :] - bearings) % 360.0 - 180.0) <= self.tolerance
+        agree = np.where(directions == 0, forward, np.where(directions == 1, backward, forward | backward))
+        agree &= validsegment
+        agree = np.logical_or.reduceat(agree, firsts, axis=0)
+
+        moving = inbox & (speeds >= self.minspeed)[np.newaxis, :]
+        return keep & (~moving.any(axis=1) | (moving & agree).any(axis=1))
+
+    def pruneCandidates(self, candidatelist, points, headinglist=None, speedlist=None, links=None, boxes=None):
+        """
+        candidatelist type: list of linkPVIDs
+        headinglist, speedlist type: lists of numbers or strings, the heading test is skipped if they aren't numeric
+        links, boxes type: link indices of candidatelist and their candidateBoxes, e.g. from the cell cache of
+                ProbeDataProcess, looked up here if not given
+        rtype: list of the linkPVIDs which pass, in the same order, or candidatelist if none of them pass
+        """
+        self.numcandidates += len(candidatelist)
+        # a single candidate is kept anyway
+        if len(candidatelist) < 2:
+            return candidatelist
+        try:
+            headings = np.asarray(headinglist, dtype=np.float64) if headinglist is not None else None
+            speeds = np.asarray(speedlist, dtype=np.float64) if speedlist is not None else None
+        except ValueError:
+            headings, speeds = None, None
+        if links is None:
+            links = self.linkstore.indices(candidatelist)
+        keep = self.keepMask(links, points, headings, speeds, boxes)
+        if not keep.any():
+            return candidatelist
+        self.numpruned += int(len(candidatelist) - keep.sum())
+        return [candidate for candidate, kept in zip(candidatelist, keep.tolist()) if kept]
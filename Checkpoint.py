@@ -0,0 +1,180 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module keeps the checkpoints of the incremental mapping mode
+The probe file is mapped in batches of trajectories, the output rows of each batch are written to its own shard files,
+and after each batch the watermark (the byte offset in the probe file after the last mapped trajectory,
+and its sampleID) is saved to watermark.json, with the size and mtime of the probe file and of the shard files. A run resumes from the watermark, so a crashed run only redoes
+the batch it was in, and a probe file with appended data only maps the new trajectories.
+The checkpoints are dropped if the link file, the candidate parameters or the already mapped part of the probe file change.
+"""
+
+import os
+import json
+import glob
+import hashlib
+
+from DataCache import fileFingerprint
+from ResultWriter import MatchedPointsWriter, mergeShards, mergeLinkStats, shardFile
+
+# bump this whenever the layout of the checkpoints changes
+CHECKPOINTVERSION = 2
+
+
+def rangeDigest(sourcefile, start, stop):
+    """
+    rtype: sha256 hex digest of bytes [start, stop) of the file
+    """
+    sha = hashlib.sha256()
+    with open(sourcefile, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            block = f.read(min(remaining, 1 << 20))
+            if not block:
+                break
+            sha.update(block)
+            remaining -= len(block)
+    return sha.hexdigest()
+
+
+def syncFile(path):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+class CheckpointStore(object):
+    """
+    Shard files of the mapped batches plus the watermark, in one folder
+    """
+    manifestname = 'watermark.json'
+
+    def __init__(self, path, probefile, linkfile, params=None):
+        """
+        path type: str, folder of the checkpoints
+        probefile type: str, the probe data file, which may only grow between runs
+        linkfile type: str, the link data file, the checkpoints are dropped if it changes
+        params type: dict, json serializable parameters the mapping depends on
+        """
+        self.path = path
+        self.probefile = os.path.abspath(probefile)
+        self.linkfile = os.path.abspath(linkfile)
+        self.params = params or {}
+        self.manifestfile = os.path.join(self.path, self.manifestname)
+        self.manifest = None
+
+    @property
+    def offset(self):
+        return self.manifest['offset']
+
+    @property
+    def numbatches(self):
+        return len(self.manifest['batches'])
+
+    def readManifest(self):
+        try:
+            with open(self.manifestfile, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def writeManifest(self):
+        """
+        the manifest is written to a temporary file, synced and renamed, so it is either the old or the new one after a crash
+        """
+        tmpfile = self.manifestfile + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpfile, self.manifestfile)
+
+    def shardSizes(self, shardidx):
+        """
+        rtype: dict of shard file name -> size of the existing shard files of batch shardidx
+        """
+        sizes = {}
+        for shard in (shardFile(self.path, 'MatchedPoints', shardidx), shardFile(self.path, 'MatchedPointsSlope', shardidx),
+                      shardFile(self.path, 'LinkSlopeStats', shardidx, '.npz')):
+            if os.path.exists(shard):
+                sizes[os.path.basename(shard)] = os.path.getsize(shard)
+        return sizes
+
+    def isValid(self, manifest, linkfingerprint):
+        """
+        the checkpoints are valid if the link file and parameters are the same, the shard files of every batch still have
+        the recorded size, and every mapped byte range of the probe file still has the same content
+        as in DataCache.ArrayCache, the byte ranges are only hashed again if the size or mtime of the probe file changed,
+        e.g. after data was appended, in which case the new size and mtime are recorded
+        """
+        if not manifest or manifest.get('version') != CHECKPOINTVERSION or manifest.get('params') != self.params \
+                or manifest.get('probefile') != self.probefile or manifest.get('link') != linkfingerprint:
+            return False
+        current = fileFingerprint(self.probefile, withhash=False)
+        if current['size'] < manifest['offset']:
+            return False
+        if any(self.shardSizes(shardidx) != batch['shards'] for shardidx, batch in enumerate(manifest['batches'])):
+            return False
+        if current != manifest['probe']:
+            if not all(rangeDigest(self.probefile, batch['start'], batch['stop']) == batch['sha256'] for batch in manifest['batches']):
+                return False
+            manifest['probe'] = current
+            self.manifest = manifest
+            self.writeManifest()
+        return True
+
+    def open(self):
+        """
+        resume from the saved watermark, or start over if the checkpoints are missing or no longer valid
+        rtype: int, byte offset in the probe file to continue from
+        """
+        os.makedirs(self.path, exist_ok=True)
+        linkfingerprint = fileFingerprint(self.linkfile)
+        del linkfingerprint['mtime_ns']
+        manifest = self.readManifest()
+        if self.isValid(manifest, linkfingerprint):
+            self.manifest = manifest
+        else:
+            for shard in glob.glob(os.path.join(self.path, 'MatchedPoints*-*.csv')) + glob.glob(os.path.join(self.path, 'LinkSlopeStats-*.npz')):
+                os.remove(shard)
+            self.manifest = {'version': CHECKPOINTVERSION, 'params': self.params, 'probefile': self.probefile,
+                             'link': linkfingerprint, 'probe': fileFingerprint(self.probefile, withhash=False),
+                             'offset': 0, 'sampleID': None, 'batches': []}
+            self.writeManifest()
+        # shards of a batch that was running when the last run stopped are overwritten
+        return self.offset
+
+    def commitBatch(self, stats, stop, sampleID):
+        """
+        record a mapped batch, whose shard files are complete, and move the watermark to stop
+        stats type: (accerror, probenum, totalnum) of the batch
+        stop type: int, byte offset right after the last trajectory of the batch
+        sampleID type: str, sampleID of the last trajectory of the batch
+        """
+        shardidx = self.numbatches
+        for name in ('MatchedPoints', 'MatchedPointsSlope'):
+            syncFile(shardFile(self.path, name, shardidx))
+        statsfile = shardFile(self.path, 'LinkSlopeStats', shardidx, '.npz')
+        if os.path.exists(statsfile):
+            syncFile(statsfile)
+        start = self.offset
+        self.manifest['batches'].append({'start': start, 'stop': stop, 'sha256': rangeDigest(self.probefile, start, stop),
+                                         'shards': self.shardSizes(shardidx), 'sampleID': sampleID, 'stats': list(stats)})
+        self.manifest['offset'], self.manifest['sampleID'] = stop, sampleID
+        self.manifest['probe'] = fileFingerprint(self.probefile, withhash=False)
+        self.writeManifest()
+
+    def writeOutput(self, mappedfile, slopefile, linkstats=False):
+        """
+        concatenate the shards of all recorded batches into the output files, the shards are kept for the next run
+        linkstats type: bool, if True the per link slope statistics saved with the batches are merged as well
+        rtype: MatchedPointsWriter holding the total slope error statistics
+        """
+        mergeShards(self.path, mappedfile, slopefile, numshards=self.numbatches, remove=False)
+        writer = MatchedPointsWriter(mappedfile, slopefile, None)
+        if linkstats:
+            writer.linkstats = mergeLinkStats(self.path, self.numbatches, remove=False)
+        for batch in self.manifest['batches']:
+            writer.addStats(batch['stats'])
+        return writer
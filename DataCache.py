@@ -0,0 +1,112 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module is the on-disk cache of the preprocessed link data and probe data
+Each cache is a folder of .npy arrays, which are memory-mapped on load, plus a manifest.json that records
+the schema version, the parameters used to build it, and the size, mtime and sha256 of every source file.
+The cache is only reused if all of them still match, otherwise it is rebuilt.
+"""
+
+import os
+import json
+import hashlib
+
+from LinkStore import saveArrays, loadArrays
+
+# bump this whenever the layout of any cached array changes
+SCHEMAVERSION = 3
+
+
+def fileFingerprint(sourcefile, withhash=True):
+    """
+    rtype: dict with size, mtime_ns and (if withhash) sha256 of the file
+    """
+    stat = os.stat(sourcefile)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if withhash:
+        sha = hashlib.sha256()
+        with open(sourcefile, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        fingerprint['sha256'] = sha.hexdigest()
+    return fingerprint
+
+
+class ArrayCache(object):
+    """
+    A folder of memory-mappable arrays, valid as long as the source files and parameters don't change
+    """
+    manifestname = 'manifest.json'
+
+    def __init__(self, path, sourcefiles, params=None, version=SCHEMAVERSION):
+        """
+        path type: str, folder of the cache
+        sourcefiles type: list of str, files the cached arrays are derived from
+        params type: dict, json serializable parameters the cached arrays depend on
+        """
+        self.path = path
+        self.sourcefiles = [os.path.abspath(sourcefile) for sourcefile in sourcefiles]
+        self.params = params or {}
+        self.version = version
+        self.manifestfile = os.path.join(self.path, self.manifestname)
+
+    def readManifest(self):
+        try:
+            with open(self.manifestfile, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def writeManifest(self, manifest):
+        tmpfile = self.manifestfile + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmpfile, self.manifestfile)
+
+    def isValid(self):
+        """
+        check the schema version, the parameters and the fingerprint of every source file
+        the sha256 is only recomputed if the size matches but the mtime doesn't, e.g. after a copy,
+        in which case an unchanged file keeps the cache and the new mtime is recorded
+        """
+        manifest = self.readManifest()
+        if not manifest or manifest.get('version') != self.version or manifest.get('params') != self.params \
+                or sorted(manifest.get('sources', {})) != sorted(self.sourcefiles):
+            return False
+
+        refreshed = False
+        for sourcefile in self.sourcefiles:
+            recorded = manifest['sources'][sourcefile]
+            try:
+                current = fileFingerprint(sourcefile, withhash=False)
+            except OSError:
+                return False
+            if current['size'] != recorded['size']:
+                return False
+            if current['mtime_ns'] != recorded['mtime_ns']:
+                if fileFingerprint(sourcefile)['sha256'] != recorded['sha256']:
+                    return False
+                recorded['mtime_ns'] = current['mtime_ns']
+                refreshed = True
+        if refreshed:
+            self.writeManifest(manifest)
+        return True
+
+    def load(self, names, mmap=True):
+        """
+        rtype: dict of name -> array, memory-mapped read only if mmap is True
+        """
+        return loadArrays(self.path, names, mmap)
+
+    def save(self, arrays):
+        """
+        arrays type: dict of name -> array
+        the manifest is removed first and written last, so an interrupted save leaves an invalid cache
+        """
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self.manifestfile):
+            os.remove(self.manifestfile)
+        saveArrays(self.path, arrays)
+        self.writeManifest({'version': self.version, 'params': self.params,
+                            'sources': {sourcefile: fileFingerprint(sourcefile) for sourcefile in self.sourcefiles}})
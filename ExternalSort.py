@@ -0,0 +1,150 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module sorts a probe data file by (sampleID, dateTime) with bounded memory
+ProbeDataProcess groups the rows of a trajectory by consecutive sampleID, so a file where the rows of the
+vehicles are interleaved has to be sorted first. The file is read in runs whose rows take at most memorylimit bytes
+in memory, counting the python objects of each row and not only its text, each run is sorted and spilled to a temporary file, then the runs are merged k ways at a time with heapq.merge.
+The rows are kept byte for byte, so the output can be given to ProbeDataProcess as is. The dateTime is parsed with
+ProbeData.parseDateTime, and the rows where it doesn't parse are kept after the other rows of their sampleID, as the
+loader keeps them too.
+"""
+
+import os
+import csv
+import heapq
+import sys
+import shutil
+import tempfile
+import time
+
+from ProbeData import parseDateTime
+
+
+# sort key time of the rows whose dateTime doesn't parse, after every valid time of their sampleID,
+# the rows are kept since the loader keeps them in their trajectory as well
+UNPARSED = 1 << 62
+
+
+def sortKey(line):
+    """
+    rtype: (sampleID, epoch seconds) of a raw probe data row, None if it is not a probe point (not 8 columns),
+            the time is UNPARSED if the dateTime doesn't parse, see ProbeData.parseDateTime
+    """
+    fields = line.rstrip(b'\r\n').split(b',')
+    if len(fields) != 8:
+        fields = next(csv.reader([line.decode('latin-1')]), [])
+        if len(fields) != 8:
+            return None
+        fields = [field.encode('latin-1') for field in fields]
+    try:
+        return fields[0], parseDateTime(fields[1])
+    except ValueError:
+        return fields[0], UNPARSED
+
+
+def rowOverhead(entry):
+    """
+    bytes of memory of a batch entry (key, index, line) besides the text of its line and sampleID, measured with
+    sys.getsizeof: the tuples, the int of the time and the index, the bytes object headers, the list slot of the batch
+    and the half slot list.sort may allocate to merge
+    """
+    (sampleID, timestamp), idx, line = entry
+    # the index is counted as a large int, the ints up to 256 are shared objects
+    ints = sys.getsizeof(timestamp) + sys.getsizeof(1 << 20)
+    return (sys.getsizeof(entry) + sys.getsizeof(entry[0]) + ints
+            + sys.getsizeof(sampleID) - len(sampleID) + sys.getsizeof(line) - len(line) + 12)
+
+
+def readRuns(sourcefile, tmpdir, memorylimit):
+    """
+    split the file into sorted runs whose rows take at most memorylimit bytes of memory, see rowOverhead
+    rtype: list of run file paths, number of rows, number of skipped rows, number of rows whose dateTime doesn't parse
+    """
+    runs, rows, skipped, unparsed = [], 0, 0, 0
+    batch, batchbytes, overhead = [], 0, None
+    with open(sourcefile, 'rb') as f:
+        for line in f:
+            key = sortKey(line)
+            if key is None:
+                skipped += 1
+                continue
+            if key[1] == UNPARSED:
+                unparsed += 1
+            if not line.endswith(b'\n'):
+                line += b'\r\n'
+            batch.append((key, len(batch), line))
+            if overhead is None:
+                # the same for every row, measured once
+                overhead = rowOverhead(batch[-1])
+            batchbytes += len(line) + len(key[0]) + overhead
+            rows += 1
+            if batchbytes >= memorylimit:
+                runs.append(writeRun(batch, tmpdir, len(runs)))
+                batch, batchbytes = [], 0
+    if batch:
+        runs.append(writeRun(batch, tmpdir, len(runs)))
+    return runs, rows, skipped, unparsed
+
+
+def writeRun(batch, tmpdir, idx):
+    """
+    sort one batch, ties keep the file order, and spill it to a run file
+    """
+    batch.sort()
+    runfile = os.path.join(tmpdir, 'run_{}_0.csv'.format(idx))
+    with open(runfile, 'wb') as f:
+        f.writelines(line for _, _, line in batch)
+    return runfile
+
+
+def mergeRuns(runfiles, tgtfile):
+    """
+    k way merge of sorted run files, heapq.merge is stable so equal keys keep the order of the runs
+    """
+    files = [open(runfile, 'rb') for runfile in runfiles]
+    try:
+        with open(tgtfile, 'wb') as f:
+            f.writelines(heapq.merge(*files, key=sortKey))
+    finally:
+        for runfile in files:
+            runfile.close()
+
+
+def sortProbeFile(sourcefile, tgtfile, memorylimit=64 << 20, fanin=64, tmpdir=None):
+    """
+    sort the rows of a probe data file by (sampleID, dateTime) into tgtfile, rows with the same key keep their order
+    rows which are not probe points are dropped, ProbeDataProcess skips them anyway
+    rows whose dateTime doesn't parse are kept after the other rows of their sampleID
+    memorylimit type: int, bytes of memory taken by the rows of a run, including their python objects, see rowOverhead
+    fanin type: int, maximum number of runs merged (and files open) at once, more runs are merged in several passes
+    tmpdir type: str, folder for the run files, the folder of tgtfile by default
+    rtype: dict with the number of rows, of skipped rows, of rows without a valid dateTime, of runs and merge passes,
+            and the throughput
+    """
+    start = time.perf_counter()
+    tmpdir = tempfile.mkdtemp(prefix='probesort_', dir=tmpdir or os.path.dirname(os.path.abspath(tgtfile)))
+    try:
+        runs, rows, skipped, unparsed = readRuns(sourcefile, tmpdir, memorylimit)
+        numruns, passes = len(runs), 0
+        while len(runs) > fanin:
+            passes += 1
+            merged = []
+            for idx in range(0, len(runs), fanin):
+                runfile = os.path.join(tmpdir, 'run_{}_{}.csv'.format(idx // fanin, passes))
+                mergeRuns(runs[idx:idx+fanin], runfile)
+                for spent in runs[idx:idx+fanin]:
+                    os.remove(spent)
+                merged.append(runfile)
+            runs = merged
+        mergeRuns(runs, tgtfile)
+        passes += 1
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(sourcefile)
+    return {'rows': rows, 'skipped': skipped, 'unparsed': unparsed, 'runs': numruns, 'passes': passes, 'seconds': seconds,
+            'rows_per_s': rows / seconds if seconds else float('inf'),
+            'mb_per_s': size / float(1 << 20) / seconds if seconds else float('inf')}
@@ -6,10 +6,14 @@ This is the defined class LinkData
 used to store each link's info, including refID, nonrefID, direction, refInfo, nonrefInfo, shapeInfo and slopeInfo
 """
 
+import numpy as np
 from geopy.distance import great_circle as distance
 from geopy.point import Point
 from math import radians, degrees, sin, cos, tan, asin, acos, atan2, sqrt, pi
 
+# same earth radius (in meters) as geopy's great_circle, so the vectorized kernels agree with it
+EARTH_RADIUS = 6371009.0
+
 class LinkData(object):
     def __init__(self, refID, nonrefID, direction, refInfo, nonrefInfo, shapeInfo, slopeInfo):
         """
@@ -104,4 +108,95 @@ class LinkData(object):
 
 
 
-
+def greatCircleMatrix(lat1, lon1, lat2, lon2):
+    """
+    vectorized version of geopy's great_circle, all inputs are in degrees and broadcast against each other
+    e.g. lat1 with shape (C, 1) and lat2 with shape (1, P) give a (C, P) matrix of distances in meters
+    It uses the same formula and radius as geopy, results agree with it within 1e-6 meters
+    """
+    lat1, lon1 = np.radians(lat1), np.radians(lon1)
+    lat2, lon2 = np.radians(lat2), np.radians(lon2)
+    sin_lat1, cos_lat1 = np.sin(lat1), np.cos(lat1)
+    sin_lat2, cos_lat2 = np.sin(lat2), np.cos(lat2)
+    delta_lon = lon2 - lon1
+    cos_delta_lon, sin_delta_lon = np.cos(delta_lon), np.sin(delta_lon)
+
+    d = np.arctan2(np.sqrt((cos_lat2 * sin_delta_lon) ** 2 + (cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * cos_delta_lon) ** 2),
+                   sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_delta_lon)
+    return EARTH_RADIUS * d
+
+
+def perpendicularDistMatrix(reflat, reflon, nonreflat, nonreflon, lat, lon):
+    """
+    vectorized version of LinkData.perpendicularDist, link endpoints have shape (C, 1), points have shape (1, P)
+    return a (C, P) matrix, which reproduces the scalar method within 1e-6 meters
+    """
+    dist1p = greatCircleMatrix(lat, lon, reflat, reflon)
+    dist12 = greatCircleMatrix(reflat, reflon, nonreflat, nonreflon)
+    dot = (np.radians(lat) - np.radians(reflat)) * (np.radians(nonreflat) - np.radians(reflat)) \
+        + (np.radians(lon) - np.radians(reflon)) * (np.radians(nonreflon) - np.radians(reflon))
+
+    valid = (dist1p != 0) & (dist12 != 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dist = np.sin(np.arccos(dot) / (dist12 * dist1p)) * dist1p * 1609.34
+    return np.where(valid, dist, 0.0)
+
+
+def linkEndpoints(links):
+    """
+    gather the ref and nonref node coordinates of a list of LinkData
+    rtype: (C, 4) array, each row is (reflat, reflon, nonreflat, nonreflon)
+    """
+    return np.array([(link.refInfo[0], link.refInfo[1], link.nonrefInfo[0], link.nonrefInfo[1]) for link in links], dtype=np.float64).reshape(-1, 4)
+
+
+def pointArray(pointlist):
+    """
+    rtype: (P, 2) array of latitude and longitude of the point list of a probe data
+    """
+    return np.array([point[:2] for point in pointlist], dtype=np.float64).reshape(-1, 2)
+
+
+def distanceFromRefMatrix(endpoints, points):
+    """
+    endpoints type: (C, 4) array as returned by linkEndpoints
+    points type: (P, 2+) array, latitude and longitude in the first two columns
+    rtype: (C, P) matrix, distance from each link's ref node to each point in meters
+    """
+    return greatCircleMatrix(endpoints[:, 0:1], endpoints[:, 1:2], points[np.newaxis, :, 0], points[np.newaxis, :, 1])
+
+
+def distanceFromLinkMatrix(endpoints, points):
+    """
+    rtype: (C, P) matrix, perpendicular distance from each point to each link in meters
+    """
+    return perpendicularDistMatrix(endpoints[:, 0:1], endpoints[:, 1:2], endpoints[:, 2:3], endpoints[:, 3:4],
+                                   points[np.newaxis, :, 0], points[np.newaxis, :, 1])
+
+
+def matchCandidates(endpoints, points):
+    """
+    pick the candidate with the minimum average distance to its ref node
+    rtype: idx: index of the chosen candidate
+            distfromref: (P,) array, distance from ref node of the chosen link for each point
+            distfromlink: (P,) array, perpendicular distance to the chosen link for each point
+    """
+    distmatrix = distanceFromRefMatrix(endpoints, points)
+    idx = int(np.argmin(distmatrix.mean(axis=1)))
+    distfromlink = distanceFromLinkMatrix(endpoints[idx:idx+1], points)[0]
+    return idx, distmatrix[idx], distfromlink
+
+
+def calcdistanceFromRefMatrix(links, pointlist):
+    """
+    score every candidate link against every probe point in one call
+    rtype: (candidates x points) matrix, distance from each link's ref node to each point in meters
+    """
+    return distanceFromRefMatrix(linkEndpoints(links), pointArray(pointlist))
+
+
+def calcdistanceFromLinkMatrix(links, pointlist):
+    """
+    rtype: (candidates x points) matrix, perpendicular distance from each point to each link in meters
+    """
+    return distanceFromLinkMatrix(linkEndpoints(links), pointArray(pointlist))
@@ -4,9 +4,9 @@ author: Linlin Chen
 
 This module is used to process the linkdata 
 
-For the initialization, input the source path, source file name and target path(to put the output file)
+For the initialization, input the source path, source file name and target path(to put the output file and the cache)
 The loadData will handle all the process, it will return the geohash map(with precision 7 and precision 8) and the link infomation,
-which is represented as ProbeData class
+which is represented as a columnar LinkStore, indexable by linkPVID like a dict of LinkData
 """
 
 
@@ -14,86 +14,143 @@ import os
 import numpy as np
 import pickle
 import csv
+import io
+import locale
 from collections import defaultdict
+from multiprocessing import Pool
 from LinkData import LinkData
+from LinkStore import LinkStore, LinkStoreBuilder, GeohashMap
+from SpatialIndex import SegmentGridIndex
+from SequentialMatcher import LinkAdjacency
+from DataCache import ArrayCache
 import geohash
 
 class LinkDataProcess(object):
-    def __init__(self, sourcepath, sourcefilename, tgtpath):
+    def __init__(self, sourcepath, sourcefilename, tgtpath, workers=1):
         """ 
         sourcepath type: str 
         sourcefilename type: str 
         tgtpath type: str 
+        workers type: int, number of processes parsing byte ranges of the link file in parallel
         """
         self.sourcepath = sourcepath
         self.sourcefilename = sourcefilename
         self.tgtpath = tgtpath
         self.sourcefile = os.path.join(self.sourcepath, self.sourcefilename)
+        self.workers = workers
 
-        self.geohashmap7precfilename = 'Link_geohash_7_prec.pickle'
-        self.geohash7precfile = os.path.join(self.tgtpath, self.geohashmap7precfilename)
-        self.geohashmap8precfilename = 'Link_geohash_8_prec.pickle'
-        self.geohash8precfile = os.path.join(self.tgtpath, self.geohashmap8precfilename)
-
-        self.linkinfofilename = 'linkData.pickle'
-        self.linkinfofile = os.path.join(self.tgtpath, self.linkinfofilename)
+        self.cachepath = os.path.join(self.tgtpath, 'linkcache')
+        self.indexcachepath = os.path.join(self.tgtpath, 'linkindexcache')
+        self.adjacencycachepath = os.path.join(self.tgtpath, 'linkadjacencycache')
 
 
     def loadData(self):
         """
-        load the data from file, save the processed content with pickle
+        load the data from file, the processed content is cached as memory-mapped arrays in linkcache/,
+        which is reused as long as the link file doesn't change
 
         return:
-            geohashmap7prec: geohash with precision 7, dic type
-            geohashmap8prec: geohash with precision 8, dict type
-            linkInfo: linkinfo, ProbeData type
+            geohashmap7prec: geohash with precision 7, GeohashMap type, geohash -> list of linkPVIDs like a dict
+            geohashmap8prec: geohash with precision 8, GeohashMap type
+            linkInfo: linkinfo, LinkStore type, store[linkPVID] gives a LinkData compatible view
 
         """
 
         print("Load link data now...")
-        if os.path.exists(self.geohash7precfile) and os.path.exists(self.geohash8precfile) and os.path.exists(self.linkinfofile):
+        cache = ArrayCache(self.cachepath, [self.sourcefile])
+        if cache.isValid():
             try:
-                geohashmap7prec = self.loadFilewithPickle(self.geohash7precfile)
-                geohashmap8prec = self.loadFilewithPickle(self.geohash8precfile)
-                linkInfo = self.loadFilewithPickle(self.linkinfofile)
+                arrays = cache.load(LinkStore.prefixedNames('link_') + GeohashMap.prefixedNames('geohash7_') + GeohashMap.prefixedNames('geohash8_'))
+                linkInfo = LinkStore.fromArrays(arrays, 'link_')
+                geohashmap7prec = GeohashMap.fromArrays(arrays, 'geohash7_')
+                geohashmap8prec = GeohashMap.fromArrays(arrays, 'geohash8_')
+                geohashmap7prec.linkPVIDs = geohashmap8prec.linkPVIDs = linkInfo.linkPVIDs
                 return geohashmap7prec, geohashmap8prec, linkInfo
-            except RuntimeError:
-                print("\tFiles already exist, but pickle load uncessfully!")
-        
-        geohashmap7prec = defaultdict(list)        #store 7 length geohash, precision <= 153m * 153m
-        geohashmap8prec = defaultdict(list)        #store 8 length geohash, precision <= 38.2 * 19.1
-        linkInfo = defaultdict()
-        with open(self.sourcefile, 'r') as linkfile:
-            #linkPVID, refNodeID, nrefNodeID, directionOfTravel, shapeInfo, curvatureInfo, slopeInfo = np.loadtxt(linkfile, dtype =str, delimiter = ',', usecols = (), unpack=True)
-            linkreader = csv.reader(linkfile, delimiter = ',')
-            for line in linkreader:
-                linkPVID, refNodeId, nrefNodeID, directionOfTravel, shapeInfo, slopeInfo = \
-                    line[0], line[1], line[2], line[5], line[14], line[16]
-                #check whether shapeInfo is empty
-                # We only consider link with valid latitute and longitute information
-                if shapeInfo and len(shapeInfo.split('|')) >= 2:
-                    shapeInfo = shapeInfo.split('|')
-                    refInfo = tuple(float(val) for val in shapeInfo[0].split('/') if val)
-                    nonrefInfo = tuple(float(val) for val in shapeInfo[-1].split('/') if val)
-                    # refnode and nonref node must at least have longitute and latitute info, otherwise skip
-                    if len(refInfo) < 2 or len(nonrefInfo) < 2:
-                        continue
-                    shapenodeInfo = [tuple(float(val) for val in info.split('/') if val) for info in shapeInfo[1:-1]]
-                    slopeinfo = None if not slopeInfo else [tuple(float(val) for val in info.split('/') if val) for info in slopeInfo.split('|')]
-                    linkInfo[linkPVID] = LinkData(refNodeId, nrefNodeID, directionOfTravel, 
-                        refInfo, nonrefInfo, shapenodeInfo, slopeinfo)
-                    
-                    #geohashmap7prec[geohash.encode(*refInfo[:2], precision=7)] = geohashmap7prec.get(geohash.encode(*refInfo[:2], precision=7), set()).add(linkPVID)
-                    geohashmap7prec[geohash.encode(*refInfo[:2], precision=7)].append(linkPVID)
-                    #geohashmap8prec[geohash.encode(*refInfo[:2], precision=8)] = geohashmap8prec.get(geohash.encode(*refInfo[:2], precision=8), set()).add(linkPVID)
-                    geohashmap8prec[geohash.encode(*refInfo[:2], precision=8)].append(linkPVID)
+            except (OSError, ValueError, KeyError):
+                print("\tCache already exists, but load unsuccessfully!")
+
+        geohashmap7prec, geohashmap8prec, linkInfo = self.parseData()
+        geohashmap7prec = GeohashMap.fromDict(geohashmap7prec, linkInfo)
+        geohashmap8prec = GeohashMap.fromDict(geohashmap8prec, linkInfo)
 
         try:
-            self.dumpFilewithPickle(self.geohash7precfile, geohashmap7prec)
-            self.dumpFilewithPickle(self.geohash8precfile, geohashmap8prec)
-            self.dumpFilewithPickle(self.linkinfofile, linkInfo)
-        except RuntimeError:
-            print("Cannot save files with pickle!")
+            arrays = linkInfo.arrays('link_')
+            arrays.update(geohashmap7prec.arrays('geohash7_'))
+            arrays.update(geohashmap8prec.arrays('geohash8_'))
+            cache.save(arrays)
+        except OSError:
+            print("Cannot save the link cache!")
+        return geohashmap7prec, geohashmap8prec, linkInfo
+
+
+    def loadSpatialIndex(self, linkInfo, cellsize=100.0):
+        """
+        load the segment spatial index of the links, cached in linkindexcache/ like loadData
+        linkInfo type: LinkStore returned by loadData
+        rtype: SegmentGridIndex
+        """
+        cache = ArrayCache(self.indexcachepath, [self.sourcefile], params={'cellsize': cellsize})
+        if cache.isValid():
+            try:
+                return SegmentGridIndex.fromArrays(cache.load(SegmentGridIndex.arraynames))
+            except (OSError, ValueError, KeyError):
+                print("\tCache already exists, but load unsuccessfully!")
+
+        spatialindex = SegmentGridIndex.fromLinkStore(linkInfo, cellsize)
+        try:
+            cache.save(spatialindex.arrays())
+        except OSError:
+            print("Cannot save the link index cache!")
+        return spatialindex
+
+
+    def loadAdjacency(self, linkInfo):
+        """
+        load the adjacency of the links (links sharing a ref or non ref node), cached in linkadjacencycache/ like loadData
+        linkInfo type: LinkStore returned by loadData
+        rtype: LinkAdjacency
+        """
+        cache = ArrayCache(self.adjacencycachepath, [self.sourcefile])
+        if cache.isValid():
+            try:
+                return LinkAdjacency.fromArrays(cache.load(LinkAdjacency.arraynames))
+            except (OSError, ValueError, KeyError):
+                print("\tCache already exists, but load unsuccessfully!")
+
+        adjacency = LinkAdjacency.fromLinkStore(linkInfo)
+        try:
+            cache.save(adjacency.arrays())
+        except OSError:
+            print("Cannot save the link adjacency cache!")
+        return adjacency
+
+
+    def parseData(self):
+        """
+        parse the link data file, in parallel byte ranges if self.workers > 1
+
+        return:
+            geohashmap7prec: dict, geohash with precision 7 -> list of linkPVIDs
+            geohashmap8prec: dict, geohash with precision 8 -> list of linkPVIDs
+            linkInfo: LinkStore
+        """
+        if self.workers > 1:
+            ranges = newlineAlignedRanges(self.sourcefile, self.workers)
+            with Pool(self.workers) as pool:
+                chunks = pool.starmap(parseLinkRange, [(self.sourcefile, start, stop) for start, stop in ranges])
+            linkInfo = LinkStore.concatenate([chunk[0] for chunk in chunks])
+            geohashtags7 = [tag for chunk in chunks for tag in chunk[1]]
+            geohashtags8 = [tag for chunk in chunks for tag in chunk[2]]
+        else:
+            with open(self.sourcefile, 'r') as linkfile:
+                #linkPVID, refNodeID, nrefNodeID, directionOfTravel, shapeInfo, curvatureInfo, slopeInfo = np.loadtxt(linkfile, dtype =str, delimiter = ',', usecols = (), unpack=True)
+                linkInfo, geohashtags7, geohashtags8 = parseLinkRows(csv.reader(linkfile, delimiter = ','))
+
+        geohashmap7prec = defaultdict(list)        #store 7 length geohash, precision <= 153m * 153m
+        geohashmap8prec = defaultdict(list)        #store 8 length geohash, precision <= 38.2 * 19.1
+        for linkPVID, geohashtag7, geohashtag8 in zip(linkInfo.linkPVIDs.tolist(), geohashtags7, geohashtags8):
+            geohashmap7prec[geohashtag7].append(linkPVID)
+            geohashmap8prec[geohashtag8].append(linkPVID)
         return geohashmap7prec, geohashmap8prec, linkInfo
 
     def loadFilewithPickle(self, file):
@@ -113,6 +170,74 @@ class LinkDataProcess(object):
 
 
 
+def parseLinkRows(linkreader):
+    """
+    parse the rows of the link data file
+    linkreader type: iterable of rows, i.e. lists of column values
+    return:
+        linkInfo: LinkStore of the links with valid ref and non-ref nodes, in file order
+        geohashtags7: list, geohash with precision 7 of the ref node of each link
+        geohashtags8: list, geohash with precision 8 of the ref node of each link
+    """
+    linkstorebuilder = LinkStoreBuilder()
+    geohashtags7, geohashtags8 = [], []
+    for line in linkreader:
+        linkPVID, refNodeId, nrefNodeID, directionOfTravel, shapeInfo, slopeInfo = \
+            line[0], line[1], line[2], line[5], line[14], line[16]
+        #check whether shapeInfo is empty
+        # We only consider link with valid latitute and longitute information
+        if shapeInfo and len(shapeInfo.split('|')) >= 2:
+            shapeInfo = shapeInfo.split('|')
+            refInfo = tuple(float(val) for val in shapeInfo[0].split('/') if val)
+            nonrefInfo = tuple(float(val) for val in shapeInfo[-1].split('/') if val)
+            # refnode and nonref node must at least have longitute and latitute info, otherwise skip
+            if len(refInfo) < 2 or len(nonrefInfo) < 2:
+                continue
+            shapenodeInfo = [tuple(float(val) for val in info.split('/') if val) for info in shapeInfo[1:-1]]
+            slopeinfo = None if not slopeInfo else [tuple(float(val) for val in info.split('/') if val) for info in slopeInfo.split('|')]
+            linkstorebuilder.add(linkPVID, refNodeId, nrefNodeID, directionOfTravel,
+                [refInfo] + shapenodeInfo + [nonrefInfo], slopeinfo)
+
+            geohashtags7.append(geohash.encode(*refInfo[:2], precision=7))
+            geohashtags8.append(geohash.encode(*refInfo[:2], precision=8))
+    return linkstorebuilder.build(), geohashtags7, geohashtags8
+
+
+def parseLinkRange(sourcefile, start, stop):
+    """
+    This is written for multiprocessing
+    parse the rows in bytes [start, stop) of the link data file, which must be newline aligned
+    rtype: same as parseLinkRows
+    """
+    with open(sourcefile, 'rb') as linkfile:
+        linkfile.seek(start)
+        data = linkfile.read(stop - start)
+    # same decoding and newline handling as open(sourcefile, 'r') in the serial parse
+    linkfile = io.TextIOWrapper(io.BytesIO(data), encoding=locale.getpreferredencoding(False))
+    return parseLinkRows(csv.reader(linkfile, delimiter = ','))
+
+
+def newlineAlignedRanges(sourcefile, parts):
+    """
+    split a file into about parts byte ranges, each range ends right after a newline so no row is cut
+    rows are assumed to contain no quoted newlines, which holds for the link and probe data files
+    rtype: list of (start, stop)
+    """
+    size = os.path.getsize(sourcefile)
+    bounds = [0]
+    with open(sourcefile, 'rb') as f:
+        for part in range(1, parts):
+            pos = max(size * part // parts, bounds[-1])
+            if pos >= size:
+                break
+            f.seek(pos)
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+
 # lps = LinkDataProcess('./probe_data_map_matching/', 'Partition6467LinkData.csv', './probe_data_map_matching/')
 # geohashmap7prec, geohashmap8prec, linkInfo = lps.loadData()
 
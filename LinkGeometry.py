@@ -0,0 +1,129 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module precomputes the planar geometry of every link polyline for the distance kernels
+Each link is projected once, at load time, into its own local equirectangular frame (meters, origin at the ref node),
+with the length, the bearing and the distance from the ref node of every segment. The distance from a probe point
+to a link is then the planar distance to the nearest point of the whole polyline (ref node, shape nodes, non-ref node),
+and distFromRef is measured along the polyline up to that nearest point, instead of straight to the ref node.
+"""
+
+import numpy as np
+
+from LinkData import EARTH_RADIUS
+from LinkStore import ArrayStore
+from SpatialIndex import expandRanges
+
+
+class LinkGeometry(ArrayStore):
+    """
+    Planar polylines of the links of a LinkStore, node i of the store is xy[i] in the frame of its link
+    the segment starting at node i has length seglength[i], bearing bearing[i] and starts cumdist[i] meters
+    along the link from its ref node, the last node of a link starts no segment and has seglength 0
+    """
+    arraynames = ('origins', 'xy', 'seglength', 'cumdist', 'bearing', 'polyoffsets')
+
+    def __init__(self, origins, xy, seglength, cumdist, bearing, polyoffsets):
+        """
+        type origins: (N, 3) float64 array, (latitude, longitude, cos latitude) of the ref node of each link, in radians
+        type xy: (M, 2) float64 array, (east, north) meters of every node from the ref node of its link
+        type seglength, cumdist: (M,) float64 arrays, meters
+        type bearing: (M,) float64 array, degrees clockwise from north
+        type polyoffsets: (N+1,) int64 array, same as the LinkStore
+        """
+        self.origins = origins
+        self.xy = xy
+        self.seglength = seglength
+        self.cumdist = cumdist
+        self.bearing = bearing
+        self.polyoffsets = polyoffsets
+
+    @classmethod
+    def fromLinkStore(cls, linkstore):
+        polyoffsets = np.asarray(linkstore.polyoffsets, dtype=np.int64)
+        nodelink = np.repeat(np.arange(len(polyoffsets) - 1), np.diff(polyoffsets))
+        coords = np.radians(np.asarray(linkstore.coords)[:, :2])
+
+        # a shape node without latitude or longitude takes the place of the node before it, the ref node is always valid
+        filled = np.where(np.isfinite(coords).all(axis=1), np.arange(len(coords)), 0)
+        coords = coords[np.maximum.accumulate(filled)] if len(coords) else coords
+
+        refs = coords[polyoffsets[:-1]]
+        origins = np.column_stack((refs, np.cos(refs[:, 0])))
+        xy = np.column_stack((EARTH_RADIUS * (coords[:, 1] - origins[nodelink, 1]) * origins[nodelink, 2],
+                              EARTH_RADIUS * (coords[:, 0] - origins[nodelink, 0])))
+
+        seglength, bearing = np.zeros(len(xy)), np.zeros(len(xy))
+        steps = np.diff(xy, axis=0)
+        seglength[:-1] = np.hypot(steps[:, 0], steps[:, 1])
+        bearing[:-1] = np.degrees(np.arctan2(steps[:, 0], steps[:, 1])) % 360.0
+        lasts = polyoffsets[1:] - 1
+        seglength[lasts], bearing[lasts] = 0.0, 0.0
+
+        before = np.concatenate(([0.0], np.cumsum(seglength)[:-1]))
+        cumdist = before - before[polyoffsets[:-1]][nodelink]
+        return cls(origins, xy, seglength, cumdist, bearing, polyoffsets)
+
+    def candidateSegments(self, links):
+        """
+        the segments of the links gathered for polylineDistances, they only depend on the links so they can be reused
+        for every trajectory with the same candidates, see CandidateCache
+        links type: (C,) int array of link indices
+        rtype: tuple of (S, 1) float64 columns (origin latitude, origin longitude, origin cos latitude, start x, start y,
+                step x, step y, length, cumdist) of the S segments, and the (C,) int64 counts and firsts of the segments
+                of each link
+        """
+        links = np.asarray(links, dtype=np.int64)
+        starts, stops = self.polyoffsets[links], self.polyoffsets[links + 1] - 1
+        counts = stops - starts
+        segstart = expandRanges(starts, stops)
+        origins = self.origins[np.repeat(links, counts)]
+        return (origins[:, 0, np.newaxis], origins[:, 1, np.newaxis], origins[:, 2, np.newaxis],
+                self.xy[segstart, 0, np.newaxis], self.xy[segstart, 1, np.newaxis],
+                (self.xy[segstart + 1, 0] - self.xy[segstart, 0])[:, np.newaxis],
+                (self.xy[segstart + 1, 1] - self.xy[segstart, 1])[:, np.newaxis],
+                self.seglength[segstart, np.newaxis], self.cumdist[segstart, np.newaxis],
+                counts, np.cumsum(counts) - counts)
+
+    def polylineDistances(self, links, points, segments=None):
+        """
+        planar distance from each point to the polyline of each link, and distance along the polyline from its ref node
+        to the nearest point of the polyline
+        links type: (C,) int array of link indices
+        points type: (P, 2+) array of (latitude, longitude, ...) in degrees
+        segments type: candidateSegments(links), gathered here if not given
+        rtype: distfromref, distfromlink: (C, P) float64 matrices in meters
+        """
+        if segments is None:
+            segments = self.candidateSegments(links)
+        originlat, originlon, origincos, startx, starty, stepx, stepy, length, cumdist, counts, firsts = segments
+        latlon = np.radians(np.asarray(points, dtype=np.float64)[:, :2])
+
+        # every point in the frame of the link of every segment, (S, P)
+        relx = EARTH_RADIUS * (latlon[np.newaxis, :, 1] - originlon) * origincos - startx
+        rely = EARTH_RADIUS * (latlon[np.newaxis, :, 0] - originlat) - starty
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(length > 0, (relx * stepx + rely * stepy) / length ** 2, 0.0)
+        t = np.clip(t, 0.0, 1.0)
+        dist = np.hypot(relx - t * stepx, rely - t * stepy)
+        along = cumdist + t * length
+
+        # nearest segment of each link, ties go to the one nearest to the ref node
+        distfromlink = np.minimum.reduceat(dist, firsts, axis=0)
+        nearest = dist == np.repeat(distfromlink, counts, axis=0)
+        distfromref = np.minimum.reduceat(np.where(nearest, along, np.inf), firsts, axis=0)
+        return distfromref, distfromlink
+
+    def matchCandidates(self, links, points, segments=None):
+        """
+        pick the candidate with the minimum average distFromLink, the perpendicular distance to its polyline,
+        ties go to the first candidate. distFromRef is no score along the link shape: it is 0 for any link whose
+        nearest point to the probes is its ref node, however far the link is
+        segments type: candidateSegments(links), gathered here if not given
+        rtype: idx: int, position of the chosen candidate in links
+                distfromref, distfromlink: (P,) arrays of the chosen candidate
+        """
+        distfromref, distfromlink = self.polylineDistances(links, points, segments)
+        idx = int(np.argmin(distfromlink.mean(axis=1)))
+        return idx, distfromref[idx], distfromlink[idx]
@@ -0,0 +1,653 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module stores the link data and probe data as flat numpy arrays
+instead of many small python objects per link, which saves memory and makes pickling and loading fast
+The arrays are saved as .npy files, so that each worker process can memory-map them at startup
+instead of receiving the whole link info with every task
+"""
+
+import os
+import numpy as np
+from array import array
+
+from LinkData import LinkData
+from ProbeData import ProbeData, ProbeAdditionalInfo, formatDateTime, formatFloat32
+
+NAN = float('nan')
+
+
+class ArrayStore(object):
+    """
+    Base class of the stores made of named numpy arrays, arraynames lists the constructor arguments
+    """
+    arraynames = ()
+
+    def arrays(self, prefix=''):
+        """
+        rtype: dict of prefix + name -> array
+        """
+        return {prefix + name: getattr(self, name) for name in self.arraynames}
+
+    @classmethod
+    def fromArrays(cls, arrays, prefix=''):
+        return cls(**{name: arrays[prefix + name] for name in cls.arraynames})
+
+    @classmethod
+    def prefixedNames(cls, prefix=''):
+        return [prefix + name for name in cls.arraynames]
+
+    def save(self, path):
+        saveArrays(path, self.arrays())
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        return cls.fromArrays(loadArrays(path, cls.arraynames, mmap))
+
+
+class LinkStore(ArrayStore):
+    """
+    Columnar link store, replaces the dict of LinkData objects
+    link index i refers to the i-th link, linkPVIDs is the side table back to linkPVID
+    nodes of link i (ref node, shape nodes, non-ref node) are coords[polyoffsets[i]:polyoffsets[i+1]]
+    slope entries of link i are slopes[slopeoffsets[i]:slopeoffsets[i+1]]
+
+    It can be used like the old dict, store[linkPVID] returns a LinkView with the same attributes and methods as LinkData
+    """
+    arraynames = ('linkPVIDs', 'nodeIDs', 'refnode', 'nonrefnode', 'direction', 'coords', 'polyoffsets',
+                  'slopes', 'slopeoffsets', 'hasslope', 'avgslope', 'endpoints')
+
+    def __init__(self, linkPVIDs, nodeIDs, refnode, nonrefnode, direction, coords, polyoffsets,
+                 slopes, slopeoffsets, hasslope, avgslope, endpoints):
+        """
+        type linkPVIDs: (N,) str array, linkPVID of each link
+        type nodeIDs: str array, interned node identifiers
+        type refnode, nonrefnode: (N,) int32 arrays, index into nodeIDs of the ref and non-ref node
+        type direction: (N,) str array, directionOfTravel of each link
+        type coords: (M, 3) float64 array, (latitude, longitude, altitude) of every node, nan where a value is missing
+        type polyoffsets: (N+1,) int32 array
+        type slopes: (K, 2) float64 array, (distance, slope) entries, nan where a value is missing
+        type slopeoffsets: (N+1,) int32 array
+        type hasslope: (N,) bool array, False if the link has no slope info at all
+        type avgslope: (N,) float64 array, average slope of each link, nan if no slope info
+        type endpoints: (N, 4) float64 array, (reflat, reflon, nonreflat, nonreflon) of each link, for the distance kernels
+        """
+        self.linkPVIDs = linkPVIDs
+        self.nodeIDs = nodeIDs
+        self.refnode = refnode
+        self.nonrefnode = nonrefnode
+        self.direction = direction
+        self.coords = coords
+        self.polyoffsets = polyoffsets
+        self.slopes = slopes
+        self.slopeoffsets = slopeoffsets
+        self.hasslope = hasslope
+        self.avgslope = avgslope
+        self.endpoints = endpoints
+        self._linkindex = None
+        # LinkGeometry of the link polylines, set by the callers that measure distances along the link shape
+        self.geometry = None
+        # LinkAdjacency of the links, set by the callers that map each point to its own link
+        self.adjacency = None
+        # number of steps the slopes of the points mapped to these links are smoothed over, see ProbeData.slopeArray
+        self.slopewindow = 1
+        # CandidateCache of the CandidateSet of each candidate list, set by the callers that match many trajectories,
+        # a copy sent to another process starts empty
+        self.candidatecache = None
+
+    @property
+    def linkindex(self):
+        """
+        dict from linkPVID to link index, only built when needed so that workers don't pay for it
+        """
+        if self._linkindex is None:
+            self._linkindex = {linkPVID: idx for idx, linkPVID in enumerate(self.linkPVIDs.tolist())}
+        return self._linkindex
+
+    # dict interface, so the store can replace the linkInfo dict for existing callers
+    def __len__(self):
+        return len(self.linkPVIDs)
+
+    def __contains__(self, linkPVID):
+        return linkPVID in self.linkindex
+
+    def __getitem__(self, linkPVID):
+        return LinkView(self, self.linkindex[linkPVID])
+
+    def __iter__(self):
+        return iter(self.linkPVIDs.tolist())
+
+    def keys(self):
+        return self.linkPVIDs.tolist()
+
+    def values(self):
+        return [LinkView(self, idx) for idx in range(len(self))]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def indices(self, linkPVIDs):
+        """
+        rtype: int array, link index of each linkPVID
+        """
+        return np.array([self.linkindex[linkPVID] for linkPVID in linkPVIDs], dtype=np.int64)
+
+    def link(self, idx):
+        """
+        rtype: LinkView of link index idx
+        """
+        return LinkView(self, idx)
+
+    def nbytes(self):
+        """
+        total size of all arrays in bytes
+        """
+        return sum(getattr(self, name).nbytes for name in self.arraynames)
+
+    @classmethod
+    def fromLinkInfo(cls, linkInfo):
+        """
+        build the store from a dict of LinkData
+        """
+        builder = LinkStoreBuilder()
+        for linkPVID, link in linkInfo.items():
+            builder.add(linkPVID, link.refID, link.nonrefID, link.direction,
+                        [link.refInfo] + list(link.shapeInfo) + [link.nonrefInfo], link.slopeInfo)
+        return builder.build()
+
+    @classmethod
+    def concatenate(cls, stores):
+        """
+        merge stores in order, e.g. the chunks of a parallel parse, the result is the same as adding all links to one builder
+        """
+        nodeindex, noderemaps = {}, []
+        for store in stores:
+            noderemaps.append(np.array([nodeindex.setdefault(nodeID, len(nodeindex)) for nodeID in store.nodeIDs.tolist()], dtype=np.int32).reshape(-1))
+        nodeIDs = sorted(nodeindex, key=nodeindex.get)
+
+        def concatOffsets(name):
+            offsets, base = [np.zeros(1, dtype=np.int32)], 0
+            for store in stores:
+                offsets.append(np.asarray(getattr(store, name))[1:] + base)
+                base += int(getattr(store, name)[-1])
+            return np.concatenate(offsets).astype(np.int32)
+
+        return cls(np.concatenate([store.linkPVIDs for store in stores]).astype(str), np.array(nodeIDs, dtype=str),
+                   np.concatenate([remap[store.refnode] for store, remap in zip(stores, noderemaps)]).astype(np.int32),
+                   np.concatenate([remap[store.nonrefnode] for store, remap in zip(stores, noderemaps)]).astype(np.int32),
+                   np.concatenate([store.direction for store in stores]).astype(str),
+                   np.concatenate([store.coords for store in stores]).reshape(-1, 3), concatOffsets('polyoffsets'),
+                   np.concatenate([store.slopes for store in stores]).reshape(-1, 2), concatOffsets('slopeoffsets'),
+                   np.concatenate([store.hasslope for store in stores]).astype(bool),
+                   np.concatenate([store.avgslope for store in stores]).astype(np.float64),
+                   np.concatenate([store.endpoints for store in stores]).reshape(-1, 4))
+
+    def toLinkInfo(self):
+        """
+        rtype: dict of LinkData objects, the representation used before the columnar store
+        """
+        return {linkPVID: LinkData(view.refID, view.nonrefID, view.direction, view.refInfo, view.nonrefInfo, view.shapeInfo, view.slopeInfo)
+                for linkPVID, view in self.items()}
+
+class LinkStoreBuilder(object):
+    """
+    Collect links one at a time into compact typed buffers, then build a LinkStore
+    """
+    def __init__(self):
+        self.linkPVIDs = []
+        self.nodeindex = {}
+        self.refnode = array('i')
+        self.nonrefnode = array('i')
+        self.direction = []
+        self.coords = array('d')
+        self.nodecounts = array('i')
+        self.slopes = array('d')
+        self.slopecounts = array('i')
+        self.hasslope = array('b')
+        self.avgslope = array('d')
+
+    def internNode(self, nodeID):
+        return self.nodeindex.setdefault(nodeID, len(self.nodeindex))
+
+    def add(self, linkPVID, refID, nonrefID, direction, nodes, slopeInfo):
+        """
+        type nodes: list of tuples, ref node, shape nodes and non-ref node, same tuples as LinkData
+        type slopeInfo: list of tuples or None, same as LinkData.slopeInfo
+        """
+        self.linkPVIDs.append(linkPVID)
+        self.refnode.append(self.internNode(refID))
+        self.nonrefnode.append(self.internNode(nonrefID))
+        self.direction.append(direction)
+
+        for node in nodes:
+            self.coords.extend(padValues(node, 3))
+        self.nodecounts.append(len(nodes))
+
+        slopeInfo = slopeInfo or []
+        for slope in slopeInfo:
+            self.slopes.extend(padValues(slope, 2))
+        self.slopecounts.append(len(slopeInfo))
+        self.hasslope.append(bool(slopeInfo))
+        self.avgslope.append(averageSlope(slopeInfo))
+
+    def build(self):
+        polyoffsets = np.zeros(len(self.nodecounts) + 1, dtype=np.int32)
+        polyoffsets[1:] = np.cumsum(np.frombuffer(self.nodecounts, dtype=np.int32))
+        slopeoffsets = np.zeros(len(self.slopecounts) + 1, dtype=np.int32)
+        slopeoffsets[1:] = np.cumsum(np.frombuffer(self.slopecounts, dtype=np.int32))
+
+        coords = np.frombuffer(self.coords, dtype=np.float64).reshape(-1, 3).copy()
+        endpoints = np.column_stack((coords[polyoffsets[:-1], :2], coords[polyoffsets[1:] - 1, :2])) if len(self.linkPVIDs) else np.empty((0, 4))
+        nodeIDs = sorted(self.nodeindex, key=self.nodeindex.get)
+
+        return LinkStore(np.array(self.linkPVIDs, dtype=str), np.array(nodeIDs, dtype=str),
+                         np.frombuffer(self.refnode, dtype=np.int32).copy(), np.frombuffer(self.nonrefnode, dtype=np.int32).copy(),
+                         np.array(self.direction, dtype=str), coords, polyoffsets,
+                         np.frombuffer(self.slopes, dtype=np.float64).reshape(-1, 2).copy(), slopeoffsets,
+                         np.frombuffer(self.hasslope, dtype=np.int8).astype(bool), np.frombuffer(self.avgslope, dtype=np.float64).copy(),
+                         np.ascontiguousarray(endpoints, dtype=np.float64))
+
+
+class LinkView(LinkData):
+    """
+    LinkData compatible view of one link of a LinkStore, attributes are read from the arrays on access
+    """
+    def __init__(self, store, idx):
+        self.store = store
+        self.idx = idx
+
+    @property
+    def refID(self):
+        return str(self.store.nodeIDs[self.store.refnode[self.idx]])
+
+    @property
+    def nonrefID(self):
+        return str(self.store.nodeIDs[self.store.nonrefnode[self.idx]])
+
+    @property
+    def direction(self):
+        return str(self.store.direction[self.idx])
+
+    @property
+    def refInfo(self):
+        return unpadValues(self.store.coords[self.store.polyoffsets[self.idx]])
+
+    @property
+    def nonrefInfo(self):
+        return unpadValues(self.store.coords[self.store.polyoffsets[self.idx+1] - 1])
+
+    @property
+    def shapeInfo(self):
+        return [unpadValues(node) for node in self.store.coords[self.store.polyoffsets[self.idx] + 1:self.store.polyoffsets[self.idx+1] - 1]]
+
+    @property
+    def slopeInfo(self):
+        if not self.store.hasslope[self.idx]:
+            return None
+        return [unpadValues(slope) for slope in self.store.slopes[self.store.slopeoffsets[self.idx]:self.store.slopeoffsets[self.idx+1]]]
+
+    @property
+    def avgslope(self):
+        avgslope = self.store.avgslope[self.idx]
+        return None if np.isnan(avgslope) else float(avgslope)
+
+
+def joinColumn(columns, dtype, formatter):
+    """
+    concatenate the columns of ProbeAdditionalInfo or ProbeStore, typed arrays or raw text
+    rtype: dtype array if every column is typed, otherwise str array of the text of every value
+    """
+    if not any(isinstance(column, list) or np.asarray(column).dtype.kind == 'U' for column in columns):
+        return np.concatenate([np.asarray(column, dtype=dtype) for column in columns] or [np.empty(0, dtype=dtype)])
+    return np.array([value for column in columns for value in (column if isinstance(column, list) or np.asarray(column).dtype.kind == 'U'
+                                                                else map(formatter, column.tolist()))], dtype=str)
+
+
+def joinCodes(columns):
+    """
+    columns type: list of (categories, codes into them)
+    rtype: (K,) str array of the categories of all columns, in first seen order, and the codes of every value into it
+    """
+    index = {}
+    codes = [np.array([index.setdefault(category, len(index)) for category in categories], dtype=np.uint32)[np.asarray(column, dtype=np.int64)]
+             if len(column) else np.empty(0, dtype=np.uint32) for categories, column in columns]
+    codes = np.concatenate(codes or [np.empty(0, dtype=np.uint32)])
+    return np.array(list(index), dtype=str), codes.astype(np.uint8 if len(index) <= 256 else np.uint32)
+
+
+def pointValues(values, typecode):
+    """
+    rtype: array of typecode sharing nothing with values, or the list of text of a str array
+    """
+    if values.dtype.kind == 'U':
+        return values.tolist()
+    column = array(typecode)
+    column.frombytes(np.ascontiguousarray(values, dtype=np.dtype(typecode)).tobytes())
+    return column
+
+
+def padValues(values, width):
+    """
+    pad a tuple of floats with nan to width, the parsed tuples drop empty values so nan only appears at the end
+    """
+    return tuple(values[:width]) + (NAN,) * (width - len(values[:width]))
+
+
+def unpadValues(row):
+    """
+    inverse of padValues, rtype: tuple of floats
+    """
+    return tuple(val for val in row.tolist() if val == val)
+
+
+def averageSlope(slopeInfo):
+    """
+    same as LinkData.setavgslope, rtype: float, nan if there is no slope info
+    """
+    if not slopeInfo:
+        return NAN
+    slopes = [slope[0] for slope in slopeInfo if len(slope) == 2]
+    return sum(slopes) / len(slopes)
+
+
+class TrajectoryStore(ArrayStore):
+    """
+    Flat copy of the probe data points and their candidate links
+    points of trajectory t are points[offsets[t]:offsets[t+1]],
+    candidate link indices of trajectory t are candidates[candoffsets[t]:candoffsets[t+1]]
+    """
+    arraynames = ('points', 'offsets', 'candidates', 'candoffsets')
+
+    def __init__(self, points, offsets, candidates, candoffsets):
+        """
+        type points: (M, 3) float64 array, (latitude, longitude, altitude) of all probe points
+        type offsets: (T+1,) int64 array
+        type candidates: (K,) int32 array, link index into the LinkStore
+        type candoffsets: (T+1,) int64 array
+        """
+        self.points = points
+        self.offsets = offsets
+        self.candidates = candidates
+        self.candoffsets = candoffsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def fromProbeInfo(cls, probeInfo, linkstore, rows=False):
+        """
+        build the store from the list of ProbeData returned by ProbeDataProcess
+        rows type: bool, True to store every row of the compressed ProbeData instead of the points which are mapped
+        """
+        offsets = np.zeros(len(probeInfo) + 1, dtype=np.int64)
+        candoffsets = np.zeros(len(probeInfo) + 1, dtype=np.int64)
+        points = [probe.rowpoints if rows else probe.points for probe in probeInfo]
+        offsets[1:] = np.cumsum([len(probepoints) for probepoints in points])
+        candoffsets[1:] = np.cumsum([len(probe.candidatelist) for probe in probeInfo])
+
+        points = np.concatenate(points or [np.empty((0, 3))]).reshape(-1, 3)
+        candidates = np.array([linkstore.linkindex[candidate] for probe in probeInfo for candidate in probe.candidatelist], dtype=np.int32)
+        return cls(points, offsets, candidates, candoffsets)
+
+    def trajectory(self, t):
+        """
+        rtype: points: (P, 3) array, candidates: (C,) array of link indices
+        """
+        return self.points[self.offsets[t]:self.offsets[t+1]], self.candidates[self.candoffsets[t]:self.candoffsets[t+1]]
+
+
+class ProbeStore(ArrayStore):
+    """
+    Flat copy of everything ProbeDataProcess.loadData returns, i.e. the ProbeData and ProbeAdditionalInfo lists
+    the per point columns share the offsets of the points, and are as compact as in ProbeAdditionalInfo: a column is
+    only kept as text if the text of one of its values doesn't survive the round trip
+    """
+    arraynames = TrajectoryStore.arraynames + ('sampleIDs', 'durations', 'geohashtags', 'dateTimes', 'sourceCategories', 'sourceCodes',
+                                               'speeds', 'headings', 'repeats')
+
+    def __init__(self, points, offsets, candidates, candoffsets, sampleIDs, durations, geohashtags, dateTimes, sourceCategories, sourceCodes,
+                 speeds, headings, repeats):
+        """
+        type points, offsets, candidates, candoffsets: same as TrajectoryStore, with every row of the compressed trajectories
+        type sampleIDs, geohashtags: (T,) str arrays
+        type durations: (T,) float64 array
+        type dateTimes: (M,) int64 array of epoch seconds, or str array of the raw text
+        type sourceCategories: (K,) str array of the distinct sourceCodes, sourceCodes type: (M,) uint8 (uint32 for more
+                                than 256 categories) array of codes into it
+        type speeds, headings: (M,) float32 arrays, or str arrays of the raw text
+        type repeats: (M,) int32 array, number of rows of the run a row starts, 0 for the rows collapsed into the row
+                      before, all ones without compression, see ProbeData.compress
+        """
+        self.points = points
+        self.offsets = offsets
+        self.candidates = candidates
+        self.candoffsets = candoffsets
+        self.sampleIDs = sampleIDs
+        self.durations = durations
+        self.geohashtags = geohashtags
+        self.dateTimes = dateTimes
+        self.sourceCategories = sourceCategories
+        self.sourceCodes = sourceCodes
+        self.speeds = speeds
+        self.headings = headings
+        self.repeats = repeats
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def fromProbeInfo(cls, probeInfo, addiInfo, linkstore):
+        trajectories = TrajectoryStore.fromProbeInfo(probeInfo, linkstore, rows=True)
+        repeats = np.ones(len(trajectories.points), dtype=np.int32)
+        for probe, start in zip(probeInfo, trajectories.offsets[:-1].tolist()):
+            if probe.repeats is not None:
+                counts = np.asarray(probe.repeats, dtype=np.int32)
+                rows = np.zeros(counts.sum(), dtype=np.int32)
+                rows[np.cumsum(counts) - counts] = counts
+                repeats[start:start + len(rows)] = rows
+        sourceCategories, sourceCodes = joinCodes([(addi.sourceCategories, np.asarray(addi.sourceCodes)) for addi in addiInfo])
+        return cls(trajectories.points, trajectories.offsets, trajectories.candidates, trajectories.candoffsets,
+                   np.array([probe.sampleID for probe in probeInfo], dtype=str),
+                   np.array([probe.duration for probe in probeInfo], dtype=np.float64),
+                   np.array([probe.geohashtag for probe in probeInfo], dtype=str),
+                   joinColumn([addi.dateTimes for addi in addiInfo], np.int64, formatDateTime), sourceCategories, sourceCodes,
+                   joinColumn([addi.speeds for addi in addiInfo], np.float32, formatFloat32),
+                   joinColumn([addi.headings for addi in addiInfo], np.float32, formatFloat32), repeats)
+
+    @classmethod
+    def concatenate(cls, stores):
+        """
+        merge stores in order, e.g. the chunks of a parallel parse, the candidate link indices must refer to the same LinkStore
+        """
+        def concatOffsets(name):
+            offsets, base = [np.zeros(1, dtype=np.int64)], 0
+            for store in stores:
+                offsets.append(np.asarray(getattr(store, name))[1:] + base)
+                base += int(getattr(store, name)[-1])
+            return np.concatenate(offsets).astype(np.int64)
+
+        def concatColumn(name, dtype):
+            return np.concatenate([np.asarray(getattr(store, name)) for store in stores] or [np.empty(0)]).astype(dtype)
+
+        sourceCategories, sourceCodes = joinCodes([(store.sourceCategories.tolist(), np.asarray(store.sourceCodes)) for store in stores])
+        return cls(np.concatenate([store.points for store in stores] or [np.empty(0)]).reshape(-1, 3), concatOffsets('offsets'),
+                   concatColumn('candidates', np.int32), concatOffsets('candoffsets'),
+                   concatColumn('sampleIDs', str), concatColumn('durations', np.float64), concatColumn('geohashtags', str),
+                   joinColumn([store.dateTimes for store in stores], np.int64, formatDateTime), sourceCategories, sourceCodes,
+                   joinColumn([store.speeds for store in stores], np.float32, formatFloat32),
+                   joinColumn([store.headings for store in stores], np.float32, formatFloat32), concatColumn('repeats', np.int32))
+
+    def trajectories(self):
+        """
+        rtype: TrajectoryStore sharing the arrays of this store
+        """
+        return TrajectoryStore(self.points, self.offsets, self.candidates, self.candoffsets)
+
+    def select(self, indices):
+        """
+        rtype: ProbeStore of the trajectories indices in that order, e.g. a batch of nearby trajectories for a worker
+        """
+        def gather(offsets, columns):
+            counts = offsets[np.asarray(indices, dtype=np.int64) + 1] - offsets[indices]
+            rows = np.concatenate([np.arange(offsets[t], offsets[t+1]) for t in indices] or [np.empty(0, dtype=np.int64)])
+            newoffsets = np.zeros(len(indices) + 1, dtype=np.int64)
+            np.cumsum(counts, out=newoffsets[1:])
+            return newoffsets, [np.asarray(column)[rows] for column in columns]
+
+        offsets, (points, dateTimes, sourceCodes, speeds, headings, repeats) = gather(
+            np.asarray(self.offsets), (self.points, self.dateTimes, self.sourceCodes, self.speeds, self.headings, self.repeats))
+        candoffsets, (candidates,) = gather(np.asarray(self.candoffsets), (self.candidates,))
+        return ProbeStore(points, offsets, candidates, candoffsets, np.asarray(self.sampleIDs)[indices], np.asarray(self.durations)[indices],
+                          np.asarray(self.geohashtags)[indices], dateTimes, np.asarray(self.sourceCategories), sourceCodes, speeds, headings, repeats)
+
+    def pointCounts(self):
+        """
+        rtype: (T,) int64 array, number of points of each ProbeData, i.e. of the rows which start a run, see ProbeData.compress
+        """
+        starts = np.concatenate(([0], np.cumsum(np.asarray(self.repeats) > 0)))
+        return starts[np.asarray(self.offsets)[1:]] - starts[np.asarray(self.offsets)[:-1]]
+
+    def probeData(self, t, linkstore):
+        """
+        rtype: ProbeData of trajectory t, the same object as ProbeDataProcess built from the file
+        """
+        start, stop = self.offsets[t], self.offsets[t+1]
+        candidates = self.candidates[self.candoffsets[t]:self.candoffsets[t+1]]
+        probe = ProbeData(str(self.sampleIDs[t]), float(self.durations[t]), [tuple(point) for point in self.points[start:stop].tolist()],
+                          str(self.geohashtags[t]), linkstore.linkPVIDs[candidates].tolist())
+        repeats = np.asarray(self.repeats[start:stop])
+        probe.compress(repeats[repeats > 0])
+        return probe
+
+    def addiInfo(self, t):
+        """
+        rtype: ProbeAdditionalInfo of trajectory t
+        """
+        start, stop = self.offsets[t], self.offsets[t+1]
+        sourceCodes = np.asarray(self.sourceCodes[start:stop])
+        return ProbeAdditionalInfo.fromColumns(pointValues(self.dateTimes[start:stop], 'q'), tuple(self.sourceCategories.tolist()),
+                                               pointValues(sourceCodes, 'B' if sourceCodes.dtype == np.uint8 else 'I'),
+                                               pointValues(self.speeds[start:stop], 'f'), pointValues(self.headings[start:stop], 'f'))
+
+    def probeInfoList(self, linkstore):
+        """
+        rtype: ProbeDataSequence, the ProbeData built on access
+        """
+        return ProbeDataSequence(self, linkstore)
+
+    def addiInfoList(self):
+        """
+        rtype: sequence of ProbeAdditionalInfo, built on access
+        """
+        return LazySequence(self.addiInfo, len(self))
+
+
+class GeohashMap(ArrayStore):
+    """
+    Read only replacement of the geohash -> list of linkPVIDs dicts, as sorted keys and offsets into link indices
+    linkPVIDs of geohash keys[i] are linkPVIDs[links[offsets[i]:offsets[i+1]]], in the order they were added
+    """
+    arraynames = ('keys_', 'offsets', 'links')
+
+    def __init__(self, keys_, offsets, links, linkPVIDs=None):
+        """
+        type keys_: (G,) sorted str array
+        type offsets: (G+1,) int64 array
+        type links: int32 array of link indices
+        type linkPVIDs: str array, the LinkStore side table, must be set before lookups
+        """
+        self.keys_ = keys_
+        self.offsets = offsets
+        self.links = links
+        self.linkPVIDs = linkPVIDs
+
+    @classmethod
+    def fromDict(cls, geohashmap, linkstore):
+        """
+        geohashmap type: dict, geohash -> list of linkPVIDs
+        """
+        keys_ = sorted(geohashmap)
+        offsets = np.zeros(len(keys_) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(geohashmap[key]) for key in keys_])
+        links = np.array([linkstore.linkindex[linkPVID] for key in keys_ for linkPVID in geohashmap[key]], dtype=np.int32)
+        return cls(np.array(keys_, dtype=str), offsets, links, linkstore.linkPVIDs)
+
+    def position(self, key):
+        """
+        rtype: index of key in keys_, -1 if missing
+        """
+        pos = int(np.searchsorted(self.keys_, key))
+        return pos if pos < len(self.keys_) and self.keys_[pos] == key else -1
+
+    def __contains__(self, key):
+        return self.position(key) >= 0
+
+    def __getitem__(self, key):
+        pos = self.position(key)
+        if pos < 0:
+            raise KeyError(key)
+        return self.linkPVIDs[self.links[self.offsets[pos]:self.offsets[pos+1]]].tolist()
+
+    def __len__(self):
+        return len(self.keys_)
+
+    def __iter__(self):
+        return iter(self.keys_.tolist())
+
+    def keys(self):
+        return self.keys_.tolist()
+
+    def items(self):
+        return ((key, self[key]) for key in self.keys())
+
+
+class LazySequence(object):
+    """
+    Sequence whose items are built by func(index, *args) on access
+    """
+    def __init__(self, func, length, args=()):
+        self.func = func
+        self.length = length
+        self.args = args
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.func(i, *self.args) for i in range(*idx.indices(self.length))]
+        if idx < 0:
+            idx += self.length
+        if not 0 <= idx < self.length:
+            raise IndexError(idx)
+        return self.func(idx, *self.args)
+
+    def __iter__(self):
+        return (self.func(idx, *self.args) for idx in range(self.length))
+
+
+class ProbeDataSequence(LazySequence):
+    """
+    The ProbeData of a ProbeStore built on access, the store is kept so the trajectories can be scheduled from its
+    columns, or sent to the workers as arrays and built there, without building them here, see Scheduler
+    """
+    def __init__(self, store, linkstore):
+        LazySequence.__init__(self, store.probeData, len(store), (linkstore,))
+        self.store = store
+
+
+def saveArrays(path, arrays):
+    """
+    save each array to path/<name>.npy
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, values in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(values))
+
+
+def loadArrays(path, names, mmap=True):
+    """
+    load path/<name>.npy for each name, memory-mapped read only if mmap is True
+    """
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None) for name in names}
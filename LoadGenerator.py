@@ -0,0 +1,115 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module is the load generator of MatchService
+It replays the points of a probe data file as requests of up to --points points (1 for single pings),
+over --connections connections with up to --depth requests in flight on each, and reports the latency
+percentiles and the throughput, e.g.
+
+    python3 MatchService.py --port 8765 &
+    python3 LoadGenerator.py probe_data_map_matching/Partition6467ProbePoints.csv --port 8765 --requests 20000
+"""
+
+import csv
+import json
+import time
+import asyncio
+import argparse
+from itertools import cycle
+
+import numpy as np
+
+
+def readRequests(probefile, maxpoints, limit):
+    """
+    cut the trajectories of a probe data file into requests of at most maxpoints consecutive points
+    rtype: list of request dicts without id
+    """
+    requests, rows, previd = [], [], None
+
+    def flush():
+        for start in range(0, len(rows), maxpoints):
+            requests.append({'sampleID': previd, 'points': rows[start:start + maxpoints]})
+
+    with open(probefile, 'r') as f:
+        for line in csv.reader(f, delimiter = ','):
+            if len(line) != 8:
+                continue
+            if line[0] != previd:
+                flush()
+                if len(requests) >= limit:
+                    break
+                rows, previd = [], line[0]
+            rows.append([float(line[3]), float(line[4]), float(line[5])])
+        else:
+            flush()
+    return requests[:limit]
+
+
+async def runConnection(host, port, unixpath, requests, depth, latencies, errors):
+    """
+    send requests over one connection, keeping up to depth of them in flight
+    """
+    if unixpath:
+        reader, writer = await asyncio.open_unix_connection(unixpath)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    sent, inflight = {}, asyncio.Semaphore(depth)
+
+    async def receive():
+        for _ in range(len(requests)):
+            response = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - sent.pop(response['id']))
+            if 'error' in response:
+                errors.append(response['error'])
+            inflight.release()
+
+    receiver = asyncio.ensure_future(receive())
+    for reqid, request in requests:
+        await inflight.acquire()
+        sent[reqid] = time.perf_counter()
+        writer.write(json.dumps(dict(request, id=reqid)).encode() + b'\n')
+        await writer.drain()
+    await receiver
+    writer.close()
+
+
+async def generateLoad(requests, numrequests, connections, depth, host='127.0.0.1', port=8765, unixpath=None):
+    """
+    replay numrequests requests, cycling through requests, split over the connections
+    rtype: dict with the throughput and latency percentiles in milliseconds
+    """
+    numbered = list(zip(range(numrequests), cycle(requests)))
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[runConnection(host, port, unixpath, numbered[conn::connections], depth, latencies, errors)
+                           for conn in range(connections)])
+    seconds = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000.0
+    return {'requests': len(latencies), 'errors': len(errors), 'seconds': seconds,
+            'throughput_rps': len(latencies) / seconds if seconds else float('inf'),
+            'p50_ms': float(np.percentile(latencies, 50)), 'p90_ms': float(np.percentile(latencies, 90)),
+            'p99_ms': float(np.percentile(latencies, 99)), 'max_ms': float(latencies.max())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for MatchService')
+    parser.add_argument('probefile', help='probe data csv whose points are replayed')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='path of the Unix socket of the service')
+    parser.add_argument('--requests', type=int, default=10000, help='number of requests to send')
+    parser.add_argument('--points', type=int, default=1, help='maximum number of points per request')
+    parser.add_argument('--connections', type=int, default=8)
+    parser.add_argument('--depth', type=int, default=4, help='requests in flight per connection')
+    args = parser.parse_args()
+
+    requests = readRequests(args.probefile, args.points, args.requests)
+    report = asyncio.run(generateLoad(requests, args.requests, args.connections, args.depth, args.host, args.port, args.unix))
+    for key, value in report.items():
+        print('{}: {}'.format(key, value))
+
+
+if __name__ == '__main__':
+    main()
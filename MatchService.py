@@ -0,0 +1,252 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module is a long running asyncio service that maps live probe points to links
+It loads the link store and the candidate index once, then serves requests over a local TCP or Unix socket
+with a line delimited JSON protocol, one request per line:
+
+    {"id": 1, "sampleID": "3001", "points": [[51.0253, 9.0470, 105.0], [51.0254, 9.0471, 106.0]]}
+    {"id": 2, "point": [51.0253, 9.0470, 105.0]}
+
+and one response per line, in the order they are ready, with the id of the request:
+
+    {"id": 1, "linkPVID": "62007637", "direction": "F", "distFromRef": [...], "distFromLink": [...], "slope": [...], "linkSlope": 1.2}
+    {"id": 2, "error": "no candidate link"}
+
+The candidate lookup and the scoring run in a pool of worker processes, requests that arrive together
+are sent to the pool as one batch, up to maxbatch requests or maxwait seconds after the first one.
+
+    python3 MatchService.py --port 8765
+    python3 MatchService.py --unix /tmp/probematch.sock
+"""
+
+import os
+import json
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from LinkDataProcess import LinkDataProcess
+from ProbeData import ProbeData
+from ProbeDataProcess import ProbeDataProcess
+from ProbeMapMatching import matchProbeData
+from CandidateCache import CandidateCache
+
+
+# ProbeDataProcess holding the link store and candidate index, one per worker process, see attachMatcher
+_matcher = None
+
+
+def loadMatcher(sourcepath, linkfilename, tgtpath, segmentindex=False):
+    """
+    load the link store, the geohash maps and optionally the spatial index, from the link cache if it is valid
+    rtype: ProbeDataProcess used only for its candidate lookup
+    """
+    linkProcess = LinkDataProcess(sourcepath, linkfilename, tgtpath)
+    geohashmap7prec, geohashmap8prec, linkstore = linkProcess.loadData()
+    spatialindex = linkProcess.loadSpatialIndex(linkstore) if segmentindex else None
+    # each worker keeps its own cells and candidate arrays, the workers live as long as the service
+    linkstore.candidatecache = CandidateCache()
+    return ProbeDataProcess(sourcepath, '', tgtpath, geohashmap7prec, geohashmap8prec, spatialindex=spatialindex, linkstore=linkstore)
+
+
+def attachMatcher(sourcepath, linkfilename, tgtpath, segmentindex):
+    """
+    Pool initializer of the service, the link cache is memory-mapped once per worker
+    """
+    global _matcher
+    _matcher = loadMatcher(sourcepath, linkfilename, tgtpath, segmentindex)
+
+
+def matchRequest(request, matcher):
+    """
+    map the points of one request
+    rtype: dict, the response without id
+    """
+    points = request.get('points')
+    if points is None and 'point' in request:
+        points = [request['point']]
+    if not points:
+        return {'error': 'no points'}
+    try:
+        shapeInfo = [tuple(float(value) for value in point) for point in points]
+    except (TypeError, ValueError):
+        return {'error': 'invalid points'}
+    if any(len(point) != 3 for point in shapeInfo):
+        return {'error': 'points must be [latitude, longitude, altitude]'}
+
+    geohashtag, candidatelist = matcher.calcCandidateLinks(shapeInfo)
+    if not geohashtag:
+        return {'error': 'no candidate link'}
+    probePoint = matchProbeData(ProbeData(request.get('sampleID'), 0, shapeInfo, geohashtag, candidatelist), matcher.linkstore)
+    link = matcher.linkstore[probePoint.maplinkID]
+    return {'linkPVID': probePoint.maplinkID, 'direction': link.direction,
+            'distFromRef': probePoint.distFromRef, 'distFromLink': probePoint.distFromLink,
+            'slope': [float(slope) for slope in probePoint.slpoe], 'linkSlope': link.avgslope}
+
+
+def matchBatch(requests):
+    """
+    This is written for multiprocessing
+    rtype: list of responses without id, one per request
+    """
+    responses = []
+    for request in requests:
+        try:
+            responses.append(matchRequest(request, _matcher))
+        except Exception as error:
+            responses.append({'error': '{}: {}'.format(type(error).__name__, error)})
+    return responses
+
+
+class MatchService(object):
+    """
+    asyncio server, every connection can send any number of requests without waiting for the responses
+    """
+    def __init__(self, sourcepath, linkfilename, tgtpath, segmentindex=False, workers=None, maxbatch=64, maxwait=0.002):
+        """
+        workers type: int, number of worker processes, one per CPU by default
+        maxbatch type: int, maximum number of requests sent to a worker at once
+        maxwait type: float, seconds a request waits for others to join its batch
+        """
+        self.sourcepath = sourcepath
+        self.linkfilename = linkfilename
+        self.tgtpath = tgtpath
+        self.segmentindex = segmentindex
+        self.workers = workers or os.cpu_count() or 1
+        self.maxbatch = maxbatch
+        self.maxwait = maxwait
+
+        self.queue = None
+        self.executor = None
+        self.numbatches, self.numrequests = 0, 0
+
+    def start(self):
+        """
+        build the link cache once in this process, then start the workers which memory-map it
+        """
+        loadMatcher(self.sourcepath, self.linkfilename, self.tgtpath, self.segmentindex)
+        self.executor = ProcessPoolExecutor(self.workers, initializer=attachMatcher,
+                                            initargs=(self.sourcepath, self.linkfilename, self.tgtpath, self.segmentindex))
+        self.queue = asyncio.Queue()
+
+    async def batcher(self):
+        """
+        collect the queued requests into batches and send them to the workers,
+        up to one batch per worker is in flight, so requests queue up and batch better under load
+        """
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.workers)
+        while True:
+            # wait for a free worker first, the requests arriving meanwhile join the next batch
+            await slots.acquire()
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.maxwait
+            while len(batch) < self.maxbatch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            loop.create_task(self.runBatch(batch, slots))
+
+    async def runBatch(self, batch, slots):
+        loop = asyncio.get_running_loop()
+        try:
+            responses = await loop.run_in_executor(self.executor, matchBatch, [request for request, _ in batch])
+        except Exception as error:
+            responses = [{'error': '{}: {}'.format(type(error).__name__, error)}] * len(batch)
+        finally:
+            slots.release()
+        self.numbatches += 1
+        self.numrequests += len(batch)
+        for (_, future), response in zip(batch, responses):
+            if not future.done():
+                future.set_result(response)
+
+    async def match(self, request):
+        """
+        rtype: response dict of one request
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def handleRequest(self, line, writer):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request must be a JSON object')
+        except ValueError as error:
+            response = {'id': None, 'error': 'invalid request: {}'.format(error)}
+        else:
+            response = dict(await self.match(request), id=request.get('id'))
+        writer.write(json.dumps(response).encode() + b'\n')
+
+    async def handleConnection(self, reader, writer):
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                task = asyncio.ensure_future(self.handleRequest(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                await writer.drain()
+            if tasks:
+                await asyncio.gather(*tasks)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, unixpath=None):
+        self.start()
+        batcher = asyncio.ensure_future(self.batcher())
+        if unixpath:
+            server = await asyncio.start_unix_server(self.handleConnection, path=unixpath)
+        else:
+            server = await asyncio.start_server(self.handleConnection, host, port)
+        print('Serving on {}'.format(unixpath or '{}:{}'.format(host, port)))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Line delimited JSON service mapping live probe points to links')
+    parser.add_argument('--sourcepath', default='./probe_data_map_matching')
+    parser.add_argument('--tgtpath', default='./probe_data_map_matching')
+    parser.add_argument('--linkfile', default='Partition6467LinkData.csv')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='path of a Unix socket to listen on instead of TCP')
+    parser.add_argument('--segment-index', action='store_true', help='look up candidate links over whole link polylines')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, one per CPU by default')
+    parser.add_argument('--maxbatch', type=int, default=64, help='maximum number of requests per batch')
+    parser.add_argument('--maxwait', type=float, default=2.0, help='milliseconds a request waits for others to join its batch')
+    args = parser.parse_args()
+
+    service = MatchService(args.sourcepath, args.linkfile, args.tgtpath, segmentindex=args.segment_index,
+                           workers=args.workers, maxbatch=args.maxbatch, maxwait=args.maxwait / 1000.0)
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,468 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module is the instrumentation of the probe data mapping
+It is off unless enable is called, then every count, maximum and timer call of the hot paths is a global lookup
+and a return. When enabled:
+    the parent and every worker process keep counters, maxima and timers, e.g. candidates per trajectory,
+    distance evaluations, points matched or skipped, bytes pickled, seconds in the queue and in each stage
+    the pool helpers (poolMap, poolImap, applyAsync) wrap each task in an InstrumentedTask, which stamps it when
+    it is queued and sends the counters of the worker back with its result, so they are merged per worker pid
+    the bytes pickled are measured in the parent, on one task and one result in PICKLESAMPLE, see stampTasks
+    one matching worker can run under cProfile or a sampling profiler, see InstrumentedTask
+    a progress line is printed every interval seconds, and report() gives the run report as a json serializable dict
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import signal
+import resource
+import threading
+from collections import Counter
+from contextlib import nullcontext
+
+# registry of the current process, None while the instrumentation is off
+_registry = None
+# one task and one result in this many are pickled again to count the bytes sent to and from the workers
+PICKLESAMPLE = 16
+NULLTIMER = nullcontext()
+
+
+class Timer(object):
+    """
+    context manager adding the seconds spent in its block to a timer of a registry
+    """
+    __slots__ = ('registry', 'name', 'start')
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.addTime(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class MetricsRegistry(object):
+    """
+    counters: name -> number, maxima: name -> number, timers: name -> [seconds, calls]
+    in the parent, workers holds the merged registry of each worker pid
+    """
+    def __init__(self):
+        self.pid = os.getpid()
+        self.counters, self.maxima, self.timers = {}, {}, {}
+        self.workers = {}
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def maximum(self, name, value):
+        if value > self.maxima.get(name, value - 1):
+            self.maxima[name] = value
+
+    def addTime(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [seconds, 1]
+        else:
+            timer[0] += seconds
+            timer[1] += 1
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def snapshot(self):
+        """
+        rtype: dict of counters, maxima and timers
+        """
+        with self.lock:
+            return {'counters': dict(self.counters), 'maxima': dict(self.maxima),
+                    'timers': {name: list(timer) for name, timer in list(self.timers.items())}}
+
+    def drain(self):
+        """
+        rtype: snapshot, then start over from zero, so each snapshot is the delta since the last one
+        """
+        with self.lock:
+            delta = {'counters': self.counters, 'maxima': self.maxima, 'timers': self.timers}
+            self.counters, self.maxima, self.timers = {}, {}, {}
+        return delta
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, value in snapshot['counters'].items():
+                self.count(name, value)
+            for name, value in snapshot['maxima'].items():
+                self.maximum(name, value)
+            for name, (seconds, calls) in snapshot['timers'].items():
+                timer = self.timers.setdefault(name, [0.0, 0])
+                timer[0] += seconds
+                timer[1] += calls
+
+    def mergeWorker(self, pid, snapshot):
+        """
+        merge the delta of a worker into its own registry and into this one
+        """
+        worker = self.workers.get(pid)
+        if worker is None:
+            worker = self.workers[pid] = MetricsRegistry()
+        worker.merge(snapshot)
+        self.merge(snapshot)
+
+
+def enable():
+    """
+    turn the instrumentation on in this process, with an empty registry
+    rtype: MetricsRegistry
+    """
+    global _registry
+    _registry = MetricsRegistry()
+    return _registry
+
+
+def disable():
+    global _registry
+    _registry = None
+
+
+def enabled():
+    return _registry is not None
+
+
+def registry():
+    return _registry
+
+
+def count(name, value=1):
+    if _registry is not None:
+        _registry.count(name, value)
+
+
+def maximum(name, value):
+    if _registry is not None:
+        _registry.maximum(name, value)
+
+
+def timer(name):
+    """
+    with timer('stage'): ... adds the seconds of the block to the timer, does nothing if the instrumentation is off
+    """
+    if _registry is None:
+        return NULLTIMER
+    return Timer(_registry, name)
+
+
+def peakRss():
+    """
+    rtype: float, peak resident set size of this process so far in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class InstrumentedTask(object):
+    """
+    Wraps the function of a pool task, it takes (time queued, task) and returns (result, pid, counters delta)
+    with profile 'cprofile' or 'sampling', the first worker to claim profilepath/profile.lock runs its tasks
+    under cProfile (worker-<pid>.prof, for pstats) or samples its stack every 5 ms (worker-<pid>.stacks, one
+    collapsed stack and its count per line, for flame graphs), the files are rewritten at most once a second
+    and when the worker exits
+    """
+    def __init__(self, func, profile=None, profilepath=None):
+        self.func = func
+        self.profile = profile
+        self.profilepath = profilepath
+
+    def __call__(self, item):
+        queued, task = item
+        worker = workerRegistry()
+        worker.addTime('queue', time.time() - queued)
+        profiler = workerProfiler(self.profile, self.profilepath)
+        start = time.perf_counter()
+        if profiler is not None:
+            with profiler:
+                result = self.func(task)
+        else:
+            result = self.func(task)
+        worker.addTime('task', time.perf_counter() - start)
+        worker.count('tasks')
+        worker.maximum('peak_rss_mb', peakRss())
+        return result, os.getpid(), worker.drain()
+
+
+def workerRegistry():
+    """
+    rtype: MetricsRegistry of this worker process, a forked worker drops the registry copied from the parent
+    """
+    global _registry
+    if _registry is None or _registry.pid != os.getpid():
+        _registry = MetricsRegistry()
+    return _registry
+
+
+# profiler of this worker process, False once it knows it is not the profiled one
+_profiler = None
+
+
+def workerProfiler(profile, profilepath):
+    global _profiler
+    if not profile:
+        return None
+    if _profiler is None:
+        try:
+            os.close(os.open(os.path.join(profilepath, 'profile.lock'), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            _profiler = False
+        else:
+            _profiler = CProfileHook(profilepath) if profile == 'cprofile' else SamplingHook(profilepath)
+            from multiprocessing.util import Finalize
+            Finalize(_profiler, _profiler.dump, exitpriority=10)
+    return _profiler or None
+
+
+class CProfileHook(object):
+    def __init__(self, profilepath):
+        import cProfile
+        self.profiler = cProfile.Profile()
+        self.path = os.path.join(profilepath, 'worker-{}.prof'.format(os.getpid()))
+        self.lastdump = time.time()
+
+    def __enter__(self):
+        self.profiler.enable()
+
+    def __exit__(self, *exc):
+        self.profiler.disable()
+        if time.time() - self.lastdump >= 1.0:
+            self.dump()
+        return False
+
+    def dump(self):
+        self.profiler.dump_stats(self.path)
+        self.lastdump = time.time()
+
+
+class SamplingHook(object):
+    """
+    records the stack of the worker every interval seconds of CPU time while a task runs, with SIGPROF
+    the timer keeps running between tasks, so tasks shorter than the interval are sampled too
+    """
+    def __init__(self, profilepath, interval=0.005):
+        self.path = os.path.join(profilepath, 'worker-{}.stacks'.format(os.getpid()))
+        self.stacks = Counter()
+        self.active = False
+        self.lastdump = time.time()
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+    def sample(self, signum, frame):
+        if not self.active:
+            return
+        names = []
+        while frame is not None:
+            names.append('{}:{}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(names))] += 1
+
+    def __enter__(self):
+        self.active = True
+
+    def __exit__(self, *exc):
+        self.active = False
+        if time.time() - self.lastdump >= 1.0:
+            self.dump()
+        return False
+
+    def dump(self):
+        with open(self.path, 'w') as f:
+            for stack, samples in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, samples))
+        self.lastdump = time.time()
+
+
+# profiler of one worker, see InstrumentedTask, set by setProfile
+_profile, _profilepath = None, None
+
+
+def setProfile(profile, profilepath):
+    """
+    profile type: None, 'cprofile' or 'sampling'
+    profilepath type: str, folder of the profile files, any earlier claim of a worker in it is dropped
+    """
+    global _profile, _profilepath
+    _profile, _profilepath = profile, profilepath
+    if profile:
+        os.makedirs(profilepath, exist_ok=True)
+        lockfile = os.path.join(profilepath, 'profile.lock')
+        if os.path.exists(lockfile):
+            os.remove(lockfile)
+
+
+def instrument(func, profile=True):
+    """
+    profile type: bool, False if the workers of this pool must not claim the profiler, e.g. the parse workers
+    """
+    return InstrumentedTask(func, _profile if profile else None, _profilepath)
+
+
+def samplePickled(direction, obj):
+    """
+    count the pickled size of obj if it is the first of PICKLESAMPLE of its direction, 'in' for tasks and 'out' for results
+    """
+    _registry.count('tasks_seen_' + direction)
+    if (_registry.counters['tasks_seen_' + direction] - 1) % PICKLESAMPLE:
+        return
+    _registry.count('tasks_sampled_' + direction)
+    _registry.count('bytes_pickled_' + direction, len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)))
+
+
+def stampTasks(iterable):
+    for task in iterable:
+        samplePickled('in', task)
+        yield time.time(), task
+
+
+def stamp(task):
+    samplePickled('in', task)
+    return time.time(), task
+
+
+def collectResult(item):
+    """
+    rtype: the result of an InstrumentedTask, whose worker counters are merged into the registry
+    """
+    result, pid, delta = item
+    _registry.mergeWorker(pid, delta)
+    samplePickled('out', result)
+    return result
+
+
+def poolMap(pool, func, iterable, profile=True):
+    """
+    pool.map, instrumented if enabled, with the same chunks but the results collected as they come back
+    """
+    if _registry is None:
+        return pool.map(func, iterable)
+    tasks = list(iterable)
+    chunksize, extra = divmod(len(tasks), 4 * (os.cpu_count() or 1))
+    return [collectResult(item) for item in pool.imap(instrument(func, profile), stampTasks(tasks), chunksize + bool(extra))]
+
+
+def poolImap(pool, func, iterable, unordered=False):
+    """
+    pool.imap or pool.imap_unordered, instrumented if enabled
+    """
+    imap = pool.imap_unordered if unordered else pool.imap
+    if _registry is None:
+        return imap(func, iterable)
+    return (collectResult(item) for item in imap(instrument(func), stampTasks(iterable)))
+
+
+class InstrumentedResult(object):
+    def __init__(self, asyncresult):
+        self.asyncresult = asyncresult
+
+    def get(self):
+        return collectResult(self.asyncresult.get())
+
+
+def applyAsync(pool, func, task):
+    """
+    pool.apply_async(func, (task,)), instrumented if enabled
+    """
+    if _registry is None:
+        return pool.apply_async(func, (task,))
+    return InstrumentedResult(pool.apply_async(instrument(func), (stamp(task),)))
+
+
+# progress line thread of the parent, see startProgress
+_progress = None
+
+
+def startProgress(interval):
+    global _progress
+    stopProgress()
+    _progress = ProgressReporter(interval)
+    _progress.start()
+
+
+def stopProgress():
+    global _progress
+    if _progress is not None:
+        _progress.stop()
+        _progress = None
+
+
+class ProgressReporter(threading.Thread):
+    """
+    prints a progress line every interval seconds from the registry of the parent, until stop
+    """
+    def __init__(self, interval, stream=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            print(progressLine(), file=self.stream, flush=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def progressLine():
+    snapshot = _registry.snapshot()
+    counters, elapsed = snapshot['counters'], time.time() - _registry.start
+    points = counters.get('points_matched', 0)
+    return 'progress: {:.0f} s, {} trajectories parsed, {} matched, {} points matched, {:.0f} points/s, {} tasks, {:.0f} MB peak RSS'.format(
+        elapsed, counters.get('trajectories_parsed', 0), counters.get('trajectories_matched', 0), points, points / elapsed if elapsed else 0.0,
+        counters.get('tasks', 0), max([peakRss()] + [worker.maxima.get('peak_rss_mb', 0.0) for worker in list(_registry.workers.values())]))
+
+
+def report(**info):
+    """
+    rtype: dict, the run report: info, wall clock seconds, the totals of the parent and all workers,
+            the registry of each worker, and ratios derived from the totals
+    """
+    totals = _registry.snapshot()
+    counters = totals['counters']
+    derived = {}
+    if counters.get('trajectories_parsed'):
+        derived['candidates_per_trajectory'] = counters.get('candidates', 0) / counters['trajectories_parsed']
+    if counters.get('tasks'):
+        derived['queue_s_per_task'] = totals['timers'].get('queue', [0.0])[0] / counters['tasks']
+    for direction in ('in', 'out'):
+        if counters.get('tasks_sampled_' + direction):
+            derived['bytes_pickled_{}_per_task'.format(direction)] = counters['bytes_pickled_' + direction] / counters['tasks_sampled_' + direction]
+    wall = time.time() - _registry.start
+    if counters.get('points_matched') and wall:
+        derived['points_matched_per_s'] = counters['points_matched'] / wall
+    if counters.get('points_compressed') and counters.get('points_written'):
+        derived['points_compressed_fraction'] = counters['points_compressed'] / counters['points_written']
+    for name in ('cell_cache', 'candidate_cache'):
+        lookups = counters.get(name + '_hits', 0) + counters.get(name + '_misses', 0)
+        if lookups:
+            derived[name + '_hit_rate'] = counters.get(name + '_hits', 0) / lookups
+    return dict(info, wall_s=wall, parent_peak_rss_mb=peakRss(), totals=totals, derived=derived,
+                workers={str(pid): worker.snapshot() for pid, worker in sorted(_registry.workers.items())})
+
+
+def writeReport(path, **info):
+    """
+    write the run report to path as json
+    rtype: dict, the report
+    """
+    runreport = report(**info)
+    with open(path, 'w') as f:
+        json.dump(runreport, f, indent=1, sort_keys=True)
+    return runreport
@@ -1,22 +1,108 @@
 import math
+import time
+import calendar
+from array import array
+import numpy as np
 from geopy.distance import great_circle as distance
 
+from LinkData import greatCircleMatrix, EARTH_RADIUS
+
+DATETIMEFORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+
 class ProbeData(object):
+    """
+    shapeInfo is kept as a flat array of (latitude, longitude, altitude) doubles in coords,
+    the shapeInfo attribute rebuilds the list of 3-tuples on access
+    after compress, coords only holds the first point of each run of stationary points, which is what is mapped,
+    rowcoords holds every row and repeats the number of rows of each run, until expand puts the rows back
+    """
+    __slots__ = ('sampleID', 'duration', 'coords', 'geohashtag', 'candidatelist',
+                 'mappingsucessful', 'maplinkID', 'maplinkIDs', 'distFromRef', 'distFromLink', 'slpoe',
+                 'rowcoords', 'repeats')
+
     def __init__(self, sampleID, duration, shapeInfo, geohashtag, candidatelist):
+        """
+        shapeInfo type: list of (latitude, longitude, altitude) tuples
+        """
         self.sampleID = sampleID
         self.duration = duration
         self.shapeInfo = shapeInfo
+        # set by compress, see stationaryRuns
+        self.rowcoords = None
+        self.repeats = None
         self.geohashtag = geohashtag
         self.candidatelist = candidatelist
 
         # following are mapping attributes
         self.mappingsucessful = False
         self.maplinkID = -1
+        # link of each point, only set by the sequential matcher, see SequentialMatcher
+        self.maplinkIDs = None
         self.distFromRef = []
         self.distFromLink = []
         self.slpoe = []
 
 
+    @property
+    def shapeInfo(self):
+        coords = self.coords
+        return [tuple(coords[i:i+3]) for i in range(0, len(coords), 3)]
+
+    @shapeInfo.setter
+    def shapeInfo(self, shapeInfo):
+        self.coords = array('d', [value for point in shapeInfo for value in point])
+
+    @property
+    def points(self):
+        """
+        rtype: (P, 3) float64 array sharing the memory of coords
+        """
+        return np.frombuffer(self.coords, dtype=np.float64).reshape(-1, 3)
+
+    @property
+    def numpoints(self):
+        return len(self.coords) // 3
+
+    @property
+    def rowpoints(self):
+        """
+        rtype: (N, 3) float64 array of every row of the trajectory, the same as points unless it is compressed
+        """
+        if self.rowcoords is None:
+            return self.points
+        return np.frombuffer(self.rowcoords, dtype=np.float64).reshape(-1, 3)
+
+    def compress(self, repeats):
+        """
+        keep only the first point of each run of consecutive points for the mapping
+        repeats type: sequence of int, number of rows of each run, see stationaryRuns
+        """
+        repeats = np.asarray(repeats, dtype=np.int64)
+        if len(repeats) == self.numpoints:
+            return
+        firsts = np.concatenate(([0], np.cumsum(repeats)[:-1]))
+        self.rowcoords = self.coords
+        self.coords = array('d', self.points[firsts].ravel().tolist())
+        self.repeats = array('I', repeats.tolist())
+
+    def expand(self):
+        """
+        undo compress after the mapping, the rows of a run get the link and the distances of its first point,
+        the other rows of the run get the slope 0, as a point at zero distance from the previous one
+        """
+        if self.repeats is None:
+            return
+        repeats = self.repeats.tolist()
+        if len(self.distFromRef) == len(repeats):
+            self.distFromRef = [value for value, count in zip(self.distFromRef, repeats) for _ in range(count)]
+            self.distFromLink = [value for value, count in zip(self.distFromLink, repeats) for _ in range(count)]
+        if self.maplinkIDs is not None and len(self.maplinkIDs) == len(repeats):
+            self.maplinkIDs = [linkID for linkID, count in zip(self.maplinkIDs, repeats) for _ in range(count)]
+        if len(self.slpoe) == len(repeats):
+            self.slpoe = [value for slope, count in zip(self.slpoe, repeats) for value in [slope] + [0] * (count - 1)]
+        self.coords, self.rowcoords, self.repeats = self.rowcoords, None, None
+
     def setMapInfo(self, linkID, distFromRef, distFromLink):
         """
         set the mapping information
@@ -26,14 +112,14 @@ class ProbeData(object):
         self.distFromRef = distFromRef[:]
         self.distFromLink = distFromLink[:]
 
-    def setSlope(self, refnodeInfo):
+    def setSlope(self, refnodeInfo, window=1):
         """
-        calculate the slope for each probe data point
+        calculate the slope for each probe data point, from the previous point (the ref node for the first one),
+        see slopeArray, the slope is the integer 0 where slopeDegree gives 0
+        window type: int, number of consecutive steps the slope of each point is smoothed over
         """
-        prev = refnodeInfo
-        for cur in self.shapeInfo:
-            self.slpoe.append(self.slopeDegree(prev, cur))
-            prev = cur
+        slopes = slopeArray(self.points, np.array([0, self.numpoints]), refnodeArray([refnodeInfo]), window)
+        self.slpoe.extend(0 if math.isnan(slope) else slope for slope in slopes.tolist())
 
     def slopeDegree(self, node1, node2):
         """
@@ -57,11 +143,239 @@ class ProbeAdditionalInfo(object):
     """
     Stores the irrelevant info, for fast lookup when writing result back to csv
     additional information includes: dateTime, speed, heading
+    dateTime is kept as int64 epoch seconds, speed and heading as float32, sourceCode as codes into a category tuple,
+    the *list attributes format them back to the original text. A column whose text doesn't survive this round trip
+    exactly (e.g. another date format, or '76.0') is kept as the list of raw strings instead.
     """
+    __slots__ = ('dateTimes', 'sourceCategories', 'sourceCodes', 'speeds', 'headings')
+
     def __init__(self, dateTimelist, sourceCodelist, speedlist, headinglist):
+        """
+        type: lists of the raw text of each point
+        """
         self.dateTimelist = dateTimelist
         self.sourceCodelist = sourceCodelist
         self.speedlist = speedlist
         self.headinglist = headinglist
 
+    @classmethod
+    def fromColumns(cls, dateTimes, sourceCategories, sourceCodes, speeds, headings):
+        """
+        build it from columns already compacted, e.g. by ProbeStore, without parsing the text again
+        dateTimes, speeds, headings type: array('q'), array('f'), array('f'), or lists of raw text as kept by the setters
+        sourceCategories type: tuple of the sourceCode texts, sourceCodes type: array of codes into it
+        """
+        addiinfo = cls.__new__(cls)
+        addiinfo.dateTimes, addiinfo.speeds, addiinfo.headings = dateTimes, speeds, headings
+        addiinfo.sourceCategories, addiinfo.sourceCodes = sourceCategories, sourceCodes
+        return addiinfo
+
+    @property
+    def dateTimelist(self):
+        if isinstance(self.dateTimes, list):
+            return self.dateTimes
+        return [formatDateTime(timestamp) for timestamp in self.dateTimes]
+
+    @dateTimelist.setter
+    def dateTimelist(self, dateTimelist):
+        self.dateTimes = compactColumn(dateTimelist, lambda values: array('q', [parseDateTime(value) for value in values]), formatDateTime)
+
+    @property
+    def timestamps(self):
+        """
+        rtype: array of int64 epoch seconds, None if the dateTime column is kept as text
+        """
+        return None if isinstance(self.dateTimes, list) else self.dateTimes
+
+    @property
+    def sourceCodelist(self):
+        categories = self.sourceCategories
+        return [categories[code] for code in self.sourceCodes]
+
+    @sourceCodelist.setter
+    def sourceCodelist(self, sourceCodelist):
+        index = {}
+        codes = [index.setdefault(sourceCode, len(index)) for sourceCode in sourceCodelist]
+        self.sourceCategories = tuple(index)
+        self.sourceCodes = array('B' if len(index) <= 256 else 'I', codes)
+
+    @property
+    def speedlist(self):
+        return self.speeds if isinstance(self.speeds, list) else [formatFloat32(value) for value in self.speeds]
+
+    @speedlist.setter
+    def speedlist(self, speedlist):
+        self.speeds = compactColumn(speedlist, lambda values: array('f', [float(value) for value in values]), formatFloat32)
+
+    @property
+    def headinglist(self):
+        return self.headings if isinstance(self.headings, list) else [formatFloat32(value) for value in self.headings]
 
+    @headinglist.setter
+    def headinglist(self, headinglist):
+        self.headings = compactColumn(headinglist, lambda values: array('f', [float(value) for value in values]), formatFloat32)
+
+
+def refnodeArray(refnodeInfos):
+    """
+    rtype: (T, 3) float64 array of the ref nodes, the altitude is nan if a ref node has none
+    """
+    refnodes = np.full((len(refnodeInfos), 3), np.nan)
+    for idx, refnodeInfo in enumerate(refnodeInfos):
+        refnodes[idx, :len(refnodeInfo)] = refnodeInfo[:3]
+    return refnodes
+
+
+def slopeArray(points, offsets, refnodes, window=1):
+    """
+    slopes of many trajectories at once, over their concatenated points
+    the slope of a point is the angle in degrees of the altitude change from the previous point of its trajectory,
+    or from the ref node of its link for the first point, over their great circle distance, as slopeDegree
+    with window > 1 the slope of a point is taken over the window steps centered on it instead (fewer at the ends of
+    the trajectory), i.e. the total altitude change over the total distance, which smooths the altitude noise
+    points type: (M, 3) float64 array of (latitude, longitude, altitude)
+    offsets type: (T+1,) int array, the points of trajectory t are points[offsets[t]:offsets[t+1]]
+    refnodes type: (T, 3) float64 array, see refnodeArray
+    rtype: (M,) float64 array, nan where slopeDegree gives 0 (no altitude or zero distance)
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    prev = np.empty_like(points)
+    prev[1:] = points[:-1]
+    firsts = offsets[:-1][counts > 0]
+    prev[firsts] = refnodes[counts > 0]
+
+    dist = greatCircleMatrix(prev[:, 0], prev[:, 1], points[:, 0], points[:, 1])
+    rise = points[:, 2] - prev[:, 2]
+    valid = (dist != 0) & ~np.isnan(rise)
+    if window <= 1:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(valid, np.degrees(np.arctan(rise / dist)), np.nan)
+
+    # sums of the valid steps in [lo, hi] of each point, clipped to its trajectory
+    half = window // 2
+    ends = np.repeat(offsets[1:], counts)
+    starts = np.repeat(offsets[:-1], counts)
+    index = np.arange(len(points))
+    lo = np.maximum(starts, index - half)
+    hi = np.minimum(ends, lo + window)
+    lo = np.maximum(starts, hi - window)
+    # summed step by step from lo rather than as differences of a running sum over the concatenated points,
+    # so the slopes of a trajectory don't depend on the trajectories batched with it
+    stepdist, steprise = np.where(valid, dist, 0.0), np.where(valid, rise, 0.0)
+    dist, rise = np.zeros(len(points)), np.zeros(len(points))
+    for k in range(window):
+        inside = lo + k < hi
+        step = np.where(inside, lo + k, 0)
+        dist += np.where(inside, stepdist[step], 0.0)
+        rise += np.where(inside, steprise[step], 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(dist > 0, np.degrees(np.arctan(rise / dist)), np.nan)
+
+
+def stationaryRuns(points, timestamps, distance, seconds, maxrun=256):
+    """
+    split a trajectory into runs of consecutive points, a run is its first point and the points after it which are
+    within distance meters and seconds seconds of it, e.g. a vehicle waiting at a light or repeated GPS fixes
+    the distances are planar around the first point, which is exact enough at the scale of the tolerance
+    points type: (P, 3) float64 array
+    timestamps type: (P,) int array of epoch seconds
+    maxrun type: int, a run has at most maxrun points
+    rtype: (R,) int64 array, number of points of each run, all ones if no point is collapsed
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    numpoints = len(points)
+    xy = np.radians(points[:, :2]) * EARTH_RADIUS
+    xy[:, 1] *= math.cos(math.radians(points[0, 0])) if numpoints else 1.0
+    # a point further than 2 * distance from the previous one can't be in the run of the previous one,
+    # so runs never cross such a step, and only the points followed by a nearer one can start a longer run
+    joins = (np.hypot(*np.diff(xy, axis=0).T) <= 2 * distance) & (np.diff(timestamps) <= seconds)
+    rows = np.flatnonzero(joins)
+    if not len(rows):
+        return np.ones(numpoints, dtype=np.int64)
+
+    # within[i, k - 1]: point rows[i] + k is in the run starting at point rows[i], for k = 1 .. width
+    stretch = np.concatenate(([0], np.cumsum(~joins)))
+    stretchend = np.searchsorted(stretch, stretch[rows], side='right')
+    width = min(int((stretchend - rows).max()) - 1, maxrun - 1)
+    later = rows[:, np.newaxis] + np.arange(1, width + 1)
+    inside = later < stretchend[:, np.newaxis]
+    later = np.minimum(later, numpoints - 1)
+    within = inside & (np.hypot(*(xy[later] - xy[rows, np.newaxis]).transpose(2, 0, 1)) <= distance) \
+        & (timestamps[later] - timestamps[rows, np.newaxis] <= seconds)
+    # first point after the run starting at each point, the runs are walked from point 0
+    runend = np.arange(1, numpoints + 1)
+    runend[rows] += within.cumprod(axis=1).sum(axis=1)
+    runend = runend.tolist()
+    runstarts, first = [], 0
+    while first < numpoints:
+        runstarts.append(first)
+        first = runend[first]
+    return np.diff(np.append(runstarts, numpoints))
+
+
+def slopeArrays(points, offsets, refnodes, window=1):
+    """
+    same as slopeArray, rtype: list of (P,) float64 arrays, one per trajectory, 0 where slopeDegree gives 0
+    """
+    return np.split(np.nan_to_num(slopeArray(points, offsets, refnodes, window), nan=0.0), np.asarray(offsets)[1:-1])
+
+
+def setSlopes(probes, refnodeInfos, window=1):
+    """
+    setSlope of many ProbeData at once
+    refnodeInfos type: list of the ref node of the link of each ProbeData
+    """
+    offsets = np.zeros(len(probes) + 1, dtype=np.int64)
+    np.cumsum([probe.numpoints for probe in probes], out=offsets[1:])
+    points = np.concatenate([probe.points for probe in probes]) if probes else np.empty((0, 3))
+    slopes = slopeArray(points, offsets, refnodeArray(refnodeInfos), window).tolist()
+    for probe, start, stop in zip(probes, offsets[:-1].tolist(), offsets[1:].tolist()):
+        probe.slpoe.extend(0 if math.isnan(slope) else slope for slope in slopes[start:stop])
+
+
+def compactColumn(values, parse, formatter):
+    """
+    rtype: typed array of the parsed values if formatting them gives back the text exactly, otherwise the list of text
+    """
+    values = list(values)
+    try:
+        parsed = parse(values)
+    except (ValueError, OverflowError):
+        return values
+    if [formatter(value) for value in parsed] != values:
+        return values
+    return parsed
+
+
+def parseDateTime(dateTime):
+    """
+    parse a '%m/%d/%Y %I:%M:%S %p' timestamp of the probe data, much faster than datetime.strptime
+    the one parser of the probe timestamps, so the loader, the external sort and the writers agree on which are valid
+    dateTime type: str, or bytes of a raw row, see ExternalSort
+    rtype: int, epoch seconds, the timestamps are taken as UTC
+    """
+    if isinstance(dateTime, bytes):
+        dateTime = dateTime.decode('latin-1')
+    date, clock, ampm = dateTime.split()
+    month, day, year = date.split('/')
+    hour, minute, second = clock.split(':')
+    hour = int(hour)
+    if not 1 <= hour <= 12 or ampm not in ('AM', 'PM'):
+        raise ValueError('invalid dateTime: ' + dateTime)
+    return calendar.timegm((int(year), int(month), int(day), hour % 12 + (12 if ampm == 'PM' else 0), int(minute), int(second), 0, 0, 0))
+
+
+def formatDateTime(timestamp):
+    return time.strftime(DATETIMEFORMAT, time.gmtime(timestamp))
+
+
+def formatFloat32(value):
+    """
+    shortest text of a float32 value, integers without a decimal point
+    """
+    if value.is_integer():
+        return '%d' % value
+    return np.format_float_positional(np.float32(value), trim='-')
@@ -7,20 +7,40 @@ Store the intermediate results and get the candidate links for each probe data
 """
 
 import os
+import io
+import sys
+import locale
 import numpy as np
 import pickle
 import csv
 import geohash
 from collections import defaultdict, Counter
-from datetime import datetime, timedelta
-from ProbeData import ProbeData, ProbeAdditionalInfo
+from multiprocessing import Pool
+from ProbeData import ProbeData, ProbeAdditionalInfo, stationaryRuns, parseDateTime
 from LinkData import LinkData
 
-from LinkDataProcess import LinkDataProcess
+from LinkDataProcess import LinkDataProcess, newlineAlignedRanges
+from LinkStore import ProbeStore
+from DataCache import ArrayCache
+from CandidateCache import CandidateCache, DEFAULTMAXBYTES
+import Metrics
 
 
 class ProbeDataProcess(object):
-    def __init__(self, sourcepath, sourcefilename, tgtpath, geohash7prec_link, geohash8prec_link):
+    def __init__(self, sourcepath, sourcefilename, tgtpath, geohash7prec_link, geohash8prec_link, spatialindex=None, linkstore=None, linkfile=None, workers=1, candidatefilter=None, compress=None, cachebytes=DEFAULTMAXBYTES):
+        """
+        spatialindex type: SegmentGridIndex, if given the candidate links are looked up over whole link polylines
+                            instead of the reference node geohash maps
+        linkstore type: LinkStore the candidates refer to, needed for the spatial index and for the probe cache
+        linkfile type: str, path of the link data file, the probe cache is rebuilt when it changes
+        workers type: int, number of processes parsing the probe file in parallel, needs a linkstore
+        candidatefilter type: CandidateFilter, if given the candidate links of each trajectory are pruned by bounding box,
+                            heading and direction of travel before they are scored
+        compress type: (distance, seconds), if given the consecutive points within distance meters and seconds seconds
+                            of the first point of their run are collapsed into it for the mapping, see ProbeData.compress
+        cachebytes type: int, bytes of the geohash cells whose candidate links are kept by each process, 0 for none,
+                            see candidateCell
+        """
         self.sourcepath = sourcepath
         self.tgtpath = tgtpath
 
@@ -35,86 +55,242 @@ class ProbeDataProcess(object):
         # self.geohash7precfile = os.path.join(self.tgtpath, self.geohash7precfilename)
         # self.geohash8precfile = os.path.join(self.tgtpath, self.geohash8precfilename)
 
-        self.probeInfofilename = 'probeData.pickle'
-        self.probeInfofile = os.path.join(self.tgtpath, self.probeInfofilename)
-
-        self.addiInfofilename = 'probeDataAddiInfo.pickle'
-        self.addiInfofile = os.path.join(self.tgtpath, self.addiInfofilename)
+        self.cachepath = os.path.join(self.tgtpath, 'probecache')
 
         self.geohash7prec_link = geohash7prec_link
         self.geohash8prec_link = geohash8prec_link
+
+        self.spatialindex = spatialindex
+        self.linkstore = linkstore
+        self.linkfile = linkfile
+        self.workers = workers
+        self.candidatefilter = candidatefilter
+        self.compress = compress
+        # query radius in meters and maximum number of candidate links for the spatial index
+        self.searchradius = 50.0
+        self.maxcandidates = 8
+        # resolved candidate links of the geohash cells seen by this process, emptied when sent to a worker
+        self.cellcache = CandidateCache(cachebytes, name='cell_cache')
         
 
+    def cache(self):
+        """
+        rtype: ArrayCache of the probe data, which depends on the probe file, the link file and how candidates are found
+        """
+        sourcefiles = [self.sourcefile] + ([self.linkfile] if self.linkfile else [])
+        return ArrayCache(self.cachepath, sourcefiles, self.candidateParams())
+
+
+    def candidateParams(self):
+        """
+        rtype: dict, how the candidate links are found, anything cached from the candidates depends on it
+        """
+        if self.spatialindex is not None:
+            params = {'candidates': 'segmentindex', 'cellsize': self.spatialindex.cellsize,
+                      'searchradius': self.searchradius, 'maxcandidates': self.maxcandidates}
+        else:
+            params = {'candidates': 'geohash'}
+        if self.candidatefilter is not None:
+            params['prefilter'] = self.candidatefilter.params()
+        # the cached points are compressed too
+        if self.compress is not None:
+            params['compress'] = list(self.compress)
+        return params
+
+
     def loadData(self):
         """
         load data from probe data file
+        if a linkstore is given, the result is cached as memory-mapped arrays in probecache/ and reused as long as
+        the probe file, the link file and the candidate parameters don't change,
+        in which case both return values are sequences built on access instead of lists
+        if self.workers > 1 and a linkstore is given, the file is parsed in parallel, see parseParallel
         return type: probeInfo: list, a list of ProbeData elements, store necessary information for each probe data 
-                    addiInfo: dict, a dictionary storing the additional information needed for writing results back, no use for probe data mapping
+                    addiInfo: list, a list of ProbeAdditionalInfo storing the additional information needed for writing results back, no use for probe data mapping
         """
 
         print('\n\nLoad probe data now...')
-        if os.path.exists(self.probeInfofile) and os.path.exists(self.addiInfofile):
+        cache = self.cache() if self.linkstore is not None else None
+        if cache is not None and cache.isValid():
             try:
-                probeInfo = self.loadFilewithPickle(self.probeInfofile)
-                addiInfo = self.loadFilewithPickle(self.addiInfofile)
-                return probeInfo, addiInfo
-            except RuntimeError:
-                print("\tFiles already exist, but pickle load uncessfully!")
+                probestore = ProbeStore.fromArrays(cache.load(ProbeStore.arraynames))
+                return probestore.probeInfoList(self.linkstore), probestore.addiInfoList()
+            except (OSError, ValueError, KeyError):
+                print("\tCache already exists, but load unsuccessfully!")
+
+        if self.workers > 1 and self.linkstore is not None:
+            probestore = self.parseParallel()
+            try:
+                cache.save(probestore.arrays())
+            except OSError:
+                print("Cannot save the probe cache!")
+            return probestore.probeInfoList(self.linkstore), probestore.addiInfoList()
 
         probeInfo = []
         #addiInfo = dict()
         addiInfo = []
+        for probe, addi in self.iterData():
+            probeInfo.append(probe)
+            addiInfo.append(addi)
+
+        if cache is not None:
+            try:
+                cache.save(ProbeStore.fromProbeInfo(probeInfo, addiInfo, self.linkstore).arrays())
+            except OSError:
+                print("Cannot save the probe cache!")
+
+        return probeInfo, addiInfo
 
+
+
+    def iterData(self):
+        """
+        read the probe data file incrementally, one trajectory at a time, without any caching
+        yield type: (ProbeData, ProbeAdditionalInfo) for each trajectory with candidate links, in file order
+        """
         with open(self.sourcefile, 'r') as probefile:
             probereader = csv.reader(probefile, delimiter = ',')
+            for probe in self.iterRows(probereader):
+                yield probe
 
-            shapeInfo = []
-
-            datetimelist = []
-            sourcecodelist = []
-            speedlist = []
-            headinglist = []
-
-            previd = -1
-            prevstime, preetime = datetime.now(), datetime.now().strftime('%m/%d/%Y %I:%M:%S %p')
-            for line in probereader:
-                if len(line) != 8:
-                    continue
-                sampleID, dateTime, sourcecode, latitude, longitude, altitude, speed, heading = line
-                if sampleID != previd:
-                    if previd != -1:
-                        geohashtag, candidatelist = self.calcCandidateLinks(shapeInfo)
-                        if geohashtag:
-                            duration = (datetime.strptime(preetime, '%m/%d/%Y %I:%M:%S %p') - prevstime).total_seconds()
-                            #addiInfo[sampleID] = ProbeAdditionalInfo(datetimelist, sourcecodelist, speedlist, headinglist)
-                            addiInfo.append(ProbeAdditionalInfo(datetimelist, sourcecodelist, speedlist, headinglist))
-                            probeInfo.append(ProbeData(previd, duration, shapeInfo, geohashtag, candidatelist))
-                    
-                    prevstime = datetime.strptime(dateTime, '%m/%d/%Y %I:%M:%S %p')
-                    previd = sampleID
-                    shapeInfo = []  
-                    
-                    datetimelist = []
-                    sourcecodelist = []
-                    speedlist = []
-                    headinglist = []
-
-
-                shapeInfo.append(tuple((float(latitude), float(longitude), float(altitude))))
-                datetimelist.append(dateTime)
-                sourcecodelist.append(sourcecode)
-                speedlist.append(speed)
-                headinglist.append(heading)
-                preetime = dateTime
-
-        try:
-            self.dumpFilewithPickle(self.probeInfofile, probeInfo)
-            self.dumpFilewithPickle(self.addiInfofile, addiInfo)
-        except RuntimeError:
-            print("Cannot save files with pickle!")
-
-        return probeInfo, addiInfo
 
+    def iterRows(self, probereader, flushlast=False):
+        """
+        group the rows of probe data into trajectories by consecutive sampleID
+        probereader type: iterable of rows, i.e. lists of column values
+        flushlast type: bool, whether the last trajectory is emitted, the whole file parse never emits it,
+                        but a byte range which is not the last one of the file must
+        yield type: same as iterData
+        """
+        shapeInfo = []
+
+        datetimelist = []
+        sourcecodelist = []
+        speedlist = []
+        headinglist = []
+
+        previd = -1
+        for line in probereader:
+            if len(line) != 8:
+                continue
+            sampleID, dateTime, sourcecode, latitude, longitude, altitude, speed, heading = line
+            if sampleID != previd:
+                if previd != -1:
+                    probe = self.makeProbe(previd, shapeInfo, datetimelist, sourcecodelist, speedlist, headinglist)
+                    if probe:
+                        yield probe
+                
+                previd = sampleID
+                shapeInfo = []  
+                
+                datetimelist = []
+                sourcecodelist = []
+                speedlist = []
+                headinglist = []
+
+
+            shapeInfo.append(tuple((float(latitude), float(longitude), float(altitude))))
+            datetimelist.append(dateTime)
+            sourcecodelist.append(sourcecode)
+            speedlist.append(speed)
+            headinglist.append(heading)
+
+        if flushlast and previd != -1:
+            probe = self.makeProbe(previd, shapeInfo, datetimelist, sourcecodelist, speedlist, headinglist)
+            if probe:
+                yield probe
+
+
+    def iterGroups(self, offset=0):
+        """
+        read the rows of the probe data file from byte offset on, grouped into trajectories by consecutive sampleID
+        like iterData the last trajectory is not yielded, since more rows of it may still be appended,
+        a last line without newline is not read at all, it may be still being written
+        yield type: (start, stop, rows), stop is the offset of the first row of the next trajectory
+        """
+        encoding = locale.getpreferredencoding(False)
+        rows, previd, start, pos = [], None, offset, offset
+        with open(self.sourcefile, 'rb') as probefile:
+            probefile.seek(offset)
+            for line in probefile:
+                if not line.endswith(b'\n'):
+                    break
+                row = next(csv.reader([line.decode(encoding)]), [])
+                if len(row) == 8:
+                    if row[0] != previd and rows:
+                        yield start, pos, rows
+                        rows, start = [], pos
+                    previd = row[0]
+                    rows.append(row)
+                pos += len(line)
+
+
+    def makeProbe(self, sampleID, shapeInfo, datetimelist, sourcecodelist, speedlist, headinglist):
+        """
+        helper method for iterRows, look up the candidate links of one trajectory
+        rtype: (ProbeData, ProbeAdditionalInfo), None if there is no candidate link
+        """
+        geohashtag, cell = self.lookupCandidates(shapeInfo)
+        if not geohashtag:
+            Metrics.count('trajectories_without_candidates')
+            Metrics.count('points_without_candidates', len(shapeInfo))
+            return None
+        candidatelist = cell[0]
+        if self.candidatefilter is not None:
+            candidatelist = self.candidatefilter.pruneCandidates(candidatelist, shapeInfo, headinglist, speedlist, *cell[1:])
+        Metrics.count('trajectories_parsed')
+        Metrics.count('candidates', len(candidatelist))
+        Metrics.maximum('max_candidates', len(candidatelist))
+        addiInfo = ProbeAdditionalInfo(datetimelist, sourcecodelist, speedlist, headinglist)
+        # the dateTimes are parsed once by ProbeAdditionalInfo, unless they are not in the usual format
+        timestamps = addiInfo.timestamps
+        if timestamps is not None:
+            duration = float(timestamps[-1] - timestamps[0])
+        else:
+            # between the first and the last dateTime which parse, e.g. the external sort puts the others last
+            valid = []
+            for dateTime in datetimelist:
+                try:
+                    valid.append(parseDateTime(dateTime))
+                except ValueError:
+                    pass
+            duration = float(valid[-1] - valid[0]) if valid else 0.0
+        probe = ProbeData(sampleID, duration, shapeInfo, geohashtag, candidatelist)
+        # trajectories whose dateTimes are kept as text are not compressed
+        if self.compress is not None and timestamps is not None:
+            probe.compress(stationaryRuns(probe.points, timestamps, *self.compress))
+            Metrics.count('points_compressed', len(shapeInfo) - probe.numpoints)
+        return probe, addiInfo
+
+
+    def parseRange(self, start, stop, flushlast):
+        """
+        parse the trajectories in bytes [start, stop) of the probe data file, which must not cut a trajectory
+        rtype: ProbeStore of the trajectories
+        """
+        with open(self.sourcefile, 'rb') as probefile:
+            probefile.seek(start)
+            data = probefile.read(stop - start)
+        # same decoding and newline handling as open(sourcefile, 'r') in iterData
+        probefile = io.TextIOWrapper(io.BytesIO(data), encoding=locale.getpreferredencoding(False))
+        probeInfo, addiInfo = [], []
+        for probe, addi in self.iterRows(csv.reader(probefile, delimiter = ','), flushlast):
+            probeInfo.append(probe)
+            addiInfo.append(addi)
+        return ProbeStore.fromProbeInfo(probeInfo, addiInfo, self.linkstore)
+
+
+    def parseParallel(self):
+        """
+        parse the probe data file in self.workers byte ranges in parallel, split only where the sampleID changes,
+        each worker also looks up the candidate links, the chunks are merged in file order
+        rtype: ProbeStore, the same trajectories as iterData
+        """
+        ranges = sampleAlignedRanges(self.sourcefile, self.workers)
+        tasks = [(start, stop, idx < len(ranges) - 1) for idx, (start, stop) in enumerate(ranges)]
+        with Pool(min(self.workers, len(tasks)) or 1, initializer=attachProbeProcess, initargs=(self,)) as pool:
+            chunks = Metrics.poolMap(pool, parseProbeRange, tasks, profile=False)
+        return ProbeStore.concatenate(chunks)
 
 
     def loadFilewithPickle(self, file):
@@ -136,6 +312,7 @@ class ProbeDataProcess(object):
     def calcCandidateLinks(self, shapeInfo):
         """
         using geohash to filter the candidate links
+        if a spatial index is given, calcCandidateLinksWithIndex is used instead
         firstly we apply geohash with precision 8, if there exists more than 5 links then return that as geohashtag
         else we apply geohash with precision 7, then check if there exists at least one link, then return that as geohash
         otherwise, return None, None
@@ -143,17 +320,121 @@ class ProbeDataProcess(object):
         rtype: geohashtag: type str, as the geohash value for this probe data
                 linksIDs: type list, a list of linkPVIDs of candidate links
         """
+        geohashtag, cell = self.lookupCandidates(shapeInfo)
+        return geohashtag, cell[0] if cell is not None else None
+
+
+    def lookupCandidates(self, shapeInfo):
+        """
+        helper method for calcCandidateLinks, the precision 7 geohash of a point is the prefix of its precision 8 one
+        rtype: geohashtag: type str, or None
+                cell: (linkPVIDs, link indices, CandidateFilter.candidateBoxes) as given by candidateCell, or None
+        """
+        if self.spatialindex is not None:
+            return self.calcCandidateLinksWithIndex(shapeInfo)
         geohashtags = [geohash.encode(*shape[:2], precision=8) for shape in shapeInfo]
         for geohashtag, _ in Counter(geohashtags).most_common():
-            if geohashtag in self.geohash8prec_link and len(self.geohash8prec_link[geohashtag]) >= 5:
-                return geohashtag, self.geohash8prec_link[geohashtag]
-        geohashtags = [geohash.encode(*shape[:2], precision=7) for shape in shapeInfo]
-        for geohashtag, _ in Counter(geohashtags).most_common():
-            if geohashtag in self.geohash7prec_link:
-                return geohashtag, self.geohash7prec_link[geohashtag]
+            cell = self.candidateCell(geohashtag)
+            if cell is not None:
+                return geohashtag, cell
+        for geohashtag, _ in Counter(geohashtag[:7] for geohashtag in geohashtags).most_common():
+            cell = self.candidateCell(geohashtag)
+            if cell is not None:
+                return geohashtag, cell
         return None, None
 
 
+    def candidateCell(self, geohashtag):
+        """
+        the candidate links of one geohash cell, memoized in cellcache since many trajectories share their cells
+        a precision 8 cell needs at least 5 links, a precision 7 cell only needs to be in the map
+        rtype: (linkPVIDs, link indices, CandidateFilter.candidateBoxes) of the cell, the link indices and boxes are None
+                without a candidate filter, or None if the cell has too few links
+        """
+        def build():
+            geohashmap, minlinks = (self.geohash8prec_link, 5) if len(geohashtag) == 8 else (self.geohash7prec_link, 0)
+            if geohashtag not in geohashmap or len(geohashmap[geohashtag]) < minlinks:
+                return None, sys.getsizeof(geohashtag)
+            candidatelist = geohashmap[geohashtag]
+            links, boxes = None, None
+            if self.candidatefilter is not None:
+                links = self.linkstore.indices(candidatelist)
+                boxes = self.candidatefilter.candidateBoxes(links)
+            size = sys.getsizeof(geohashtag) + sys.getsizeof(candidatelist) + sum(map(sys.getsizeof, candidatelist))
+            if boxes is not None:
+                size += links.nbytes + sum(array.nbytes for array in boxes)
+            return (candidatelist, links, boxes), size
+
+        return self.cellcache.get(geohashtag, build)
+
+
+    def calcCandidateLinksWithIndex(self, shapeInfo):
+        """
+        using the segment spatial index to get the candidate links, i.e. the maxcandidates links nearest to the trajectory
+        among the links within searchradius of at least one point
+        the geohashtag is the most common geohash with precision 7 of the points
+
+        rtype: same as lookupCandidates, the cell has no candidateBoxes since the candidates aren't those of a geohash cell
+        """
+        lat = [shape[0] for shape in shapeInfo]
+        lon = [shape[1] for shape in shapeInfo]
+        links = self.spatialindex.queryTrajectory(lat, lon, self.searchradius, self.maxcandidates)
+        if not len(links):
+            return None, None
+        geohashtag = Counter(geohash.encode(*shape[:2], precision=7) for shape in shapeInfo).most_common(1)[0][0]
+        return geohashtag, (self.linkstore.linkPVIDs[links].tolist(), np.asarray(links, dtype=np.int64), None)
+
+
+# ProbeDataProcess held by each worker process of parseParallel, see attachProbeProcess
+_probeprocess = None
+
+
+def attachProbeProcess(probeProcess):
+    """
+    Pool initializer for parseParallel, the geohash maps and link store are sent once per worker
+    """
+    global _probeprocess
+    _probeprocess = probeProcess
+
+
+def parseProbeRange(task):
+    """
+    This is written for multiprocessing
+    task is (start, stop, flushlast), see ProbeDataProcess.parseRange
+    """
+    return _probeprocess.parseRange(*task)
+
+
+def sampleAlignedRanges(sourcefile, parts):
+    """
+    split the probe data file into about parts byte ranges, each split is moved forward to the first row
+    whose sampleID differs from the row at the newline aligned split point, so no trajectory is cut
+    rows which are not probe points (not 8 columns) never end a trajectory, same as in iterRows
+    rtype: list of (start, stop)
+    """
+    size = os.path.getsize(sourcefile)
+    bounds = [0]
+    with open(sourcefile, 'rb') as f:
+        for start, _ in newlineAlignedRanges(sourcefile, parts)[1:]:
+            if start <= bounds[-1]:
+                continue
+            f.seek(start)
+            sampleID, pos = None, start
+            for line in iter(f.readline, b''):
+                row = next(csv.reader([line.decode(locale.getpreferredencoding(False))]), [])
+                if len(row) == 8:
+                    if sampleID is None:
+                        sampleID = row[0]
+                    elif row[0] != sampleID:
+                        break
+                pos += len(line)
+            if pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+
 # lps = LinkDataProcess('./probe_data_map_matching/', 'Partition6467LinkData.csv', './probe_data_map_matching/')
 # geohashmap7prec, geohashmap8prec, linkInfo = lps.loadData()
 # print(len(geohashmap7prec), len(geohashmap8prec), len(linkInfo))
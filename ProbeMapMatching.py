@@ -10,23 +10,321 @@ then use multiprocessing to parallel processing the mapping
 
 
 import os
+import shutil
+import argparse
 from geopy.distance import great_circle as distance
 from multiprocessing import Process, Pool, Queue
 import operator
 import time
 import pickle
+from contextlib import nullcontext
 import csv
 import math
+import numpy as np
+from collections import deque
 
-from LinkData import LinkData
+from LinkData import LinkData, linkEndpoints, matchCandidates
 from LinkDataProcess import LinkDataProcess
-from ProbeData import ProbeData, ProbeAdditionalInfo
+from LinkStore import LinkStore, TrajectoryStore, ProbeStore
+from LinkGeometry import LinkGeometry
+from CandidateFilter import CandidateFilter
+from CandidateCache import CandidateCache, DEFAULTMAXBYTES, candidateSet
+from SequentialMatcher import matchSequential
+from ProbeData import ProbeData, ProbeAdditionalInfo, refnodeArray, slopeArray, setSlopes
 from ProbeDataProcess import ProbeDataProcess
-
+from ResultWriter import MatchedPointsWriter, ShardWriter, mergeShards, mergeLinkStats
+from ResultStore import ResultStoreWriter
+from ExternalSort import sortProbeFile
+from Scheduler import localityBatches
+from Checkpoint import CheckpointStore
+import Metrics
+
+
+
+# stores attached by each worker process in shared store mode, see attachSharedStore
+_linkstore, _trajstore = None, None
+
+
+def attachSharedStore(storepath, slopewindow=1, cachebytes=0):
+    """
+    Pool initializer for the shared store mode, memory-map the link store and trajectory store once per worker
+    cachebytes type: int, size of the candidate cache of the worker, 0 for none, see CandidateCache
+    """
+    global _linkstore, _trajstore
+    _linkstore = LinkStore.load(os.path.join(storepath, 'links'))
+    if os.path.isdir(os.path.join(storepath, 'geometry')):
+        _linkstore.geometry = LinkGeometry.load(os.path.join(storepath, 'geometry'))
+    _linkstore.slopewindow = slopewindow
+    if cachebytes:
+        _linkstore.candidatecache = CandidateCache(cachebytes)
+    _trajstore = TrajectoryStore.load(os.path.join(storepath, 'trajectories'))
+
+
+def matchSharedRange(bounds):
+    """
+    This is written for multiprocessing in shared store mode
+    bounds is (start, stop), the range of trajectory indices in the trajectory store to match
+    rtype: linkidx: (stop-start,) int32 array, index of the matched link in the link store
+            values: (points, 3) float64 array, distFromRef, distFromLink and slope of each point in the range,
+                    the slope is nan where setSlope gives the integer 0, so that it is written as 0 and not 0.0
+    """
+    start, stop = bounds
+    linkidx = np.empty(stop - start, dtype=np.int32)
+    values = []
+    for t in range(start, stop):
+        points, candidates = _trajstore.trajectory(t)
+        Metrics.count('trajectories_matched')
+        Metrics.count('points_matched', len(points))
+        Metrics.count('distance_evaluations', len(candidates) * len(points))
+        candidateset = candidateSet(_linkstore, candidates)
+        if _linkstore.geometry is not None:
+            idx, distfromref, distfromlink = _linkstore.geometry.matchCandidates(candidates, points, candidateset.segments)
+        else:
+            idx, distfromref, distfromlink = matchCandidates(candidateset.endpoints, points)
+        linkidx[t - start] = candidates[idx]
+        values.append(np.column_stack((distfromref, distfromlink)))
+    if not values:
+        return linkidx, np.empty((0, 3))
+
+    # the slopes of the whole range in one call
+    offsets = _trajstore.offsets[start:stop + 1]
+    slopes = slopeArray(_trajstore.points[offsets[0]:offsets[-1]], offsets - offsets[0],
+                        refnodeArray([_linkstore.link(idx).refInfo for idx in linkidx.tolist()]), _linkstore.slopewindow)
+    return linkidx, np.column_stack((np.concatenate(values), slopes))
+
+
+# link info held by each worker process in streaming mode, see attachLinkInfo
+_linkinfo = None
+
+
+def matchProbeData(probePoint, linkInfo, setslope=True):
+    """
+    map one ProbeData to the candidate link with the minimum average distance to its ref node,
+    then set the distances and slope of each point
+    setslope type: bool, False to leave the slopes to the caller, see matchProbeList
+    """
+    Metrics.count('trajectories_matched')
+    Metrics.count('points_matched', probePoint.numpoints)
+    Metrics.count('distance_evaluations', len(probePoint.candidatelist) * probePoint.numpoints)
+    # the arrays of the candidates, shared by the trajectories with the same candidates, see CandidateCache
+    candidateset = candidateSet(linkInfo, probePoint.candidatelist) if isinstance(linkInfo, LinkStore) else None
+    if isinstance(linkInfo, LinkStore) and linkInfo.adjacency is not None:
+        return matchSequential(probePoint, linkInfo, setslope=setslope, candidateset=candidateset)
+    # score all candidates against all points at once, (candidates x points) matrix
+    if isinstance(linkInfo, LinkStore) and linkInfo.geometry is not None:
+        idx, distfromref, distfromlink = linkInfo.geometry.matchCandidates(candidateset.links, probePoint.points, candidateset.segments)
+        linkid = probePoint.candidatelist[idx]
+        probePoint.setMapInfo(linkid, distfromref.tolist(), distfromlink.tolist())
+        if setslope:
+            probePoint.setSlope(linkInfo[linkid].refInfo, linkInfo.slopewindow)
+        return probePoint
+    if isinstance(linkInfo, LinkStore):
+        endpoints = candidateset.endpoints
+    else:
+        endpoints = linkEndpoints(linkInfo[candidate] for candidate in probePoint.candidatelist)
+    idx, distfromref, distfromlink = matchCandidates(endpoints, probePoint.points)
+    linkid = probePoint.candidatelist[idx]
+
+    probePoint.setMapInfo(linkid, distfromref.tolist(), distfromlink.tolist())
+    if setslope:
+        probePoint.setSlope(linkInfo[linkid].refInfo, getattr(linkInfo, 'slopewindow', 1))
+    return probePoint
+
+
+def matchProbeList(probes, linkInfo):
+    """
+    matchProbeData for a list of ProbeData, with the slopes of all of them computed in one call, see setSlopes
+    rtype: list of the mapped ProbeData
+    """
+    with Metrics.timer('match'):
+        probes = [matchProbeData(probePoint, linkInfo, setslope=False) for probePoint in probes]
+    with Metrics.timer('slope'):
+        setSlopes(probes, [linkInfo[probePoint.maplinkIDs[0] if probePoint.maplinkIDs else probePoint.maplinkID].refInfo for probePoint in probes],
+                  getattr(linkInfo, 'slopewindow', 1))
+    return probes
+
+
+def attachLinkInfo(linkInfo):
+    """
+    Pool initializer for the streaming mode, the link info is sent once per worker instead of once per task
+    """
+    global _linkinfo
+    _linkinfo = linkInfo
+
+
+def matchProbeChunk(chunk):
+    """
+    This is written for multiprocessing in streaming mode
+    chunk is a list of (ProbeData, ProbeAdditionalInfo), only the ProbeData is matched and returned
+    """
+    return matchProbeList([probePoint for probePoint, _ in chunk], _linkinfo)
+
+
+# shard folder, whether to write the binary columnar shards, whether to send the mapped ProbeData back
+# and whether to save the per link slope statistics, held by each worker process in sharded output mode, see attachShardWriter
+_shardpath, _columnar, _returnprobes, _linkstats = None, False, False, False
+
+
+def attachShardWriter(linkInfo, shardpath, columnar, returnprobes, linkstats=False):
+    """
+    Pool initializer for the sharded output mode
+    """
+    global _linkinfo, _shardpath, _columnar, _returnprobes, _linkstats
+    _linkinfo = linkInfo
+    _shardpath, _columnar, _returnprobes, _linkstats = shardpath, columnar, returnprobes, linkstats
+
+
+def matchWriteChunk(task):
+    """
+    This is written for multiprocessing in sharded output mode
+    task is (shardidx, chunk), chunk is a list of (ProbeData, ProbeAdditionalInfo)
+    the chunk is matched and its rows written to the shard files of shardidx
+    rtype: stats: (accerror, probenum, totalnum) of the shard,
+            result: list of the mapped ProbeData if they are sent back, otherwise None
+    """
+    shardidx, chunk = task
+    result = matchProbeList([probePoint for probePoint, _ in chunk], _linkinfo)
+    with Metrics.timer('write'), ShardWriter(_shardpath, shardidx, _linkinfo, _columnar, _linkstats) as writer:
+        for probePoint, (_, addiinfo) in zip(result, chunk):
+            writer.writeProbe(probePoint, addiinfo)
+    return writer.stats(), result if _returnprobes else None
+
+
+def matchProbeBatch(batch):
+    """
+    This is written for multiprocessing in locality scheduling mode
+    batch is (indices, list of ProbeData or ProbeStore of the trajectories), rtype: (indices, list of mapped ProbeData)
+    """
+    indices, probes = batch
+    if isinstance(probes, ProbeStore):
+        probes = [probes.probeData(t, _linkinfo) for t in range(len(probes))]
+    return indices, matchProbeList(probes, _linkinfo)
+
+
+def chunkIterable(iterable, chunksize):
+    """
+    group the items of iterable into lists of chunksize items
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def boundedImap(pool, func, iterable, maxinflight):
+    """
+    like pool.imap, but only maxinflight items are submitted ahead of the consumer,
+    pool.imap reads the whole iterable as fast as it can, which defeats streaming
+    yield (item, func(item)) in input order
+    """
+    inflight = deque()
+    for item in iterable:
+        if len(inflight) >= maxinflight:
+            done, asyncresult = inflight.popleft()
+            yield done, asyncresult.get()
+        inflight.append((item, Metrics.applyAsync(pool, func, item)))
+    while inflight:
+        done, asyncresult = inflight.popleft()
+        yield done, asyncresult.get()
+
+
+class MatchingOptions(object):
+    """
+    The options of a ProbeMapMatching run, with the defaults of the command line
+    """
+    def __init__(self, sharedstore=False, segmentindex=False, linkworkers=1, probeworkers=1, sortprobes=False, shardedoutput=False, columnar=False,
+                 locality=False, shapedistance=False, prefilter=False, sequential=False, slopewindow=1, linkstats=False, metrics=False, progress=10.0,
+                 profileworker=None, compress=None, cachebytes=DEFAULTMAXBYTES, resultstore=False, sortmemory=64 << 20):
+        """
+        sharedstore type: bool, if True the link and probe data are saved as memory-mapped arrays which workers
+        attach to once, tasks only carry trajectory ranges and results come back as arrays
+        segmentindex type: bool, if True candidate links are looked up with a spatial index over all link segments
+        instead of the reference node geohash maps
+        linkworkers type: int, number of processes parsing the link file in parallel on a cold start
+        probeworkers type: int, number of processes parsing the probe file in parallel on a cold start
+        sortprobes type: bool, if True the probe file is first sorted by (sampleID, dateTime) into the target folder,
+        for probe files where the rows of a vehicle are not contiguous
+        shardedoutput type: bool, if True workers write the output rows of their chunks to shard files,
+        which are concatenated in order at the end, instead of the parent writing every row
+        columnar type: bool, with shardedoutput, also write the rows as binary columns to MatchedPoints/part-*.npz
+        locality type: bool, if True trajectories are sent to the workers in batches of nearby trajectories
+        of about batchpoints points, see Scheduler
+        shapedistance type: bool, if True distFromLink is the distance to the whole link polyline and distFromRef
+        is measured along it, with the planar link geometry precomputed at load time, see LinkGeometry
+        prefilter type: bool, if True the candidate links of each trajectory are first pruned by bounding box,
+        heading and direction of travel, see CandidateFilter
+        sequential type: bool, if True each point is mapped to its own link by the beam search of SequentialMatcher,
+        over the link adjacency, with the distances to the link polylines, not available with sharedstore
+        slopewindow type: int, number of consecutive steps the slope of each point is smoothed over, 1 for no smoothing,
+        see ProbeData.slopeArray
+        linkstats type: bool, if True the count, mean, median, RMSE and bias of the slopes of the matched points
+        of each link are also written to LinkSlopeStats.csv, see SlopeAggregation
+        metrics type: bool, if True the stages, the workers and the hot paths are instrumented, a progress line is printed
+        every progress seconds and the run report is written to RunReport.json, see Metrics
+        profileworker type: None, 'cprofile' or 'sampling', with metrics, profile one worker into profile/
+        compress type: (distance, seconds), if given each run of consecutive points within distance meters and seconds
+        seconds of its first point is mapped as that one point, and the results are written back to every row, see ProbeData.compress
+        cachebytes type: int, bytes of the candidate links of the geohash cells kept by each parsing process and of the
+        candidate arrays kept by each matching process, 0 for no cache, see CandidateCache
+        resultstore type: bool, if True the output rows are also loaded into the indexed database MatchedPoints.db by a
+        dedicated writer process, see ResultStore
+        sortmemory type: int, bytes of probe rows held in memory per sorted run, python objects included, see ExternalSort
+        """
+        self.sharedstore = sharedstore
+        self.segmentindex = segmentindex
+        self.linkworkers = linkworkers
+        self.probeworkers = probeworkers
+        self.sortprobes = sortprobes
+        self.shardedoutput = shardedoutput
+        self.columnar = columnar
+        self.locality = locality
+        self.shapedistance = shapedistance
+        self.prefilter = prefilter
+        self.sequential = sequential
+        self.slopewindow = slopewindow
+        self.linkstats = linkstats
+        self.metrics = metrics
+        self.progress = progress
+        self.profileworker = profileworker
+        self.compress = compress
+        self.cachebytes = cachebytes
+        self.resultstore = resultstore
+        self.sortmemory = sortmemory
+
+    def conflicts(self, mode='run'):
+        """
+        mode type: 'run', 'streaming' or 'incremental', the run method the options are used with
+        rtype: list of str, the options which are not supported together, or which the mode would ignore
+        """
+        conflicts = []
+        if self.sharedstore and self.sequential:
+            conflicts.append('the shared store mode maps one link per trajectory, it cannot be used with the sequential matcher')
+        if mode != 'run' and self.sharedstore:
+            conflicts.append('the {} mode reads the probe file in chunks, it cannot be used with the shared store'.format(mode))
+        if self.sharedstore and self.shardedoutput:
+            conflicts.append('the shared store mode writes its own output, it cannot be used with sharded output')
+        if self.columnar and not self.shardedoutput:
+            conflicts.append('the columnar output is written by the shard writers, it needs sharded output')
+        if self.locality and (self.sharedstore or self.shardedoutput):
+            conflicts.append('the locality batches are tasks of their own, they cannot be used with the shared store or sharded output')
+        if mode != 'run' and self.locality:
+            conflicts.append('the {} mode reads the probe file in chunks, it cannot be used with locality batches'.format(mode))
+        if mode == 'incremental' and self.shardedoutput:
+            conflicts.append('the incremental mode always writes shards, to its checkpoints, it cannot be used with sharded output')
+        if self.profileworker and not self.metrics:
+            conflicts.append('the worker profile is part of the instrumentation, it needs metrics')
+        return conflicts
 
 
 class ProbeMapMatching:
-    def __init__(self, sourcepath, linkfilename, probefilename, tgtpath):
+    def __init__(self, sourcepath, linkfilename, probefilename, tgtpath, options=None, **kwargs):
+        """
+        options type: MatchingOptions, if not given it is built from the keyword arguments, e.g. segmentindex=True
+        """
         self.sourcepath = sourcepath
         self.tgtpath = tgtpath
 
@@ -41,42 +339,111 @@ class ProbeMapMatching:
         self.slopefilename = 'MatchedPointsSlope.csv'
         self.slopefile = os.path.join(self.tgtpath, self.slopefilename)
 
+        self.options = options or MatchingOptions(**kwargs)
+        self.checkOptions('run')
+        self.shardpath = os.path.join(self.tgtpath, 'shards')
+        self.columnarpath = os.path.join(self.tgtpath, 'MatchedPoints')
+        self.linkstatsfile = os.path.join(self.tgtpath, 'LinkSlopeStats.csv')
+        self.reportfile = os.path.join(self.tgtpath, 'RunReport.json')
+        self.profilepath = os.path.join(self.tgtpath, 'profile')
+        self.storefile = os.path.join(self.tgtpath, 'MatchedPoints.db')
+        self.candidatefilter = None
+        self.checkpointpath = os.path.join(self.tgtpath, 'checkpoints')
+        # number of probe points per batch in locality scheduling mode
+        self.batchpoints = 4096
+        self.sortedfilename = 'Sorted' + self.probefilename
+        self.spatialindex = None
+        self.storepath = os.path.join(self.tgtpath, 'sharedstore')
+        # number of trajectories carried by each task in shared store mode
+        self.sharedchunksize = 256
+
+
+
+    def checkOptions(self, mode):
+        """
+        raise ValueError if the options are not supported together in the mode, see MatchingOptions.conflicts
+        """
+        conflicts = self.options.conflicts(mode)
+        if conflicts:
+            raise ValueError(conflicts[0])
 
 
-    def loadData(self):
+    def loadData(self, loadprobes=True):
         """
         load the link data and probe probe data 
         geohash dict will also be loaded
+        loadprobes type: bool, False to load only the link data, e.g. for runStreaming which reads the probes itself
         """
 
+        self.startMetrics()
         start = time.time()
-        self.geohashmap7prec, self.geohashmap8prec, self.linkInfo = LinkDataProcess(self.sourcepath, self.linkfilename, self.tgtpath).loadData()
+        linkProcess = LinkDataProcess(self.sourcepath, self.linkfilename, self.tgtpath, workers=self.options.linkworkers)
+        with Metrics.timer('stage.link_load'):
+            self.geohashmap7prec, self.geohashmap8prec, self.linkInfo = linkProcess.loadData()
         end = time.time()
         print('Time used: {} s'.format(end-start))
 
+        if self.options.segmentindex:
+            self.spatialindex = linkProcess.loadSpatialIndex(self.linkInfo)
+
+        if self.options.shapedistance or self.options.sequential:
+            start = time.time()
+            self.linkInfo.geometry = LinkGeometry.fromLinkStore(self.linkInfo)
+            print('Link geometry precomputed in {:.3f} s'.format(time.time() - start))
+
+        if self.options.sequential:
+            self.linkInfo.adjacency = linkProcess.loadAdjacency(self.linkInfo)
+        self.linkInfo.slopewindow = self.options.slopewindow
+        self.linkInfo.candidatecache = CandidateCache(self.options.cachebytes) if self.options.cachebytes else None
+
+        if self.options.prefilter:
+            self.candidatefilter = CandidateFilter(self.linkInfo, self.linkInfo.geometry)
+
+        if self.options.sortprobes:
+            self.sortProbeFile()
+
+        if not loadprobes:
+            return
+
         start = time.time()
-        self.probeInfo, self.addiInfo = ProbeDataProcess(self.sourcepath, self.probefilename, self.tgtpath, self.geohashmap7prec, self.geohashmap8prec).loadData()
+        with Metrics.timer('stage.probe_load'):
+            self.probeInfo, self.addiInfo = self.probeDataProcess().loadData()
         end = time.time()
         print('Time used: {} s'.format(end-start))        
 
 
 
+    def probeDataProcess(self):
+        """
+        rtype: ProbeDataProcess for the probe file, using the spatial index for candidates if it is built
+        """
+        if self.options.sortprobes:
+            return ProbeDataProcess(self.tgtpath, self.sortedfilename, self.tgtpath, self.geohashmap7prec, self.geohashmap8prec,
+                                    spatialindex=self.spatialindex, linkstore=self.linkInfo, linkfile=self.linkfile, workers=self.options.probeworkers,
+                                    candidatefilter=self.candidatefilter, compress=self.options.compress, cachebytes=self.options.cachebytes)
+        return ProbeDataProcess(self.sourcepath, self.probefilename, self.tgtpath, self.geohashmap7prec, self.geohashmap8prec,
+                                spatialindex=self.spatialindex, linkstore=self.linkInfo, linkfile=self.linkfile, workers=self.options.probeworkers,
+                                candidatefilter=self.candidatefilter, compress=self.options.compress, cachebytes=self.options.cachebytes)
+
+
+    def sortProbeFile(self):
+        """
+        external sort of the probe file by (sampleID, dateTime) into the target folder
+        """
+        print("Sort probe data now...")
+        report = sortProbeFile(self.probefile, os.path.join(self.tgtpath, self.sortedfilename), memorylimit=self.options.sortmemory)
+        print('Sorted {} rows in {} runs, {:.1f} rows/s, {:.1f} MB/s'.format(report['rows'], report['runs'], report['rows_per_s'], report['mb_per_s']))
+        if report['unparsed']:
+            print('{} rows without a valid dateTime are kept after the other rows of their sampleID'.format(report['unparsed']))
+
+
     def probeMatching(self, probePoint):
         """
         This is written for multiprocessing
         probePoint is just one probe point in the whole probe data,
         its type is ProbeData 
         """
-        distancelist = [self.linkInfo[candidate].calcavgdistance(probePoint.shapeInfo) for candidate in probePoint.candidatelist]
-        idx, mindist = min(enumerate(distancelist), key=operator.itemgetter(1))
-        linkid = probePoint.candidatelist[idx]
-
-        distfromreflist = self.linkInfo[linkid].calcdistanceFromRef(probePoint.shapeInfo)
-        distfromlinklist = self.linkInfo[linkid].calcdistanceFromLink(probePoint.shapeInfo)
-
-        probePoint.setMapInfo(linkid, distfromreflist, distfromlinklist)
-        probePoint.setSlope(self.linkInfo[linkid].refInfo)
-        return probePoint
+        return matchProbeData(probePoint, self.linkInfo)
 
 
     def run(self):
@@ -87,13 +454,27 @@ class ProbeMapMatching:
         RMSE will be used as evaluation for the slope derivation
         """
         print('\n\nProcess probe data mapping now...')
-        with Pool() as pool:
-            start = time.time()
+        start = time.time()
+        # in shared store mode, workers attach to the memory-mapped stores at startup
+        poolargs = self.prepareSharedStore() if self.options.sharedstore else {}
+        if self.options.shardedoutput and not self.options.sharedstore:
+            poolargs = {'initializer': attachShardWriter, 'initargs': (self.linkInfo, self.shardpath, self.options.columnar, True, self.options.linkstats)}
+        elif self.options.locality and not self.options.sharedstore:
+            poolargs = {'initializer': attachLinkInfo, 'initargs': (self.linkInfo,)}
+        with Pool(**poolargs) as pool:
 
             # parallel processing the mapping, number of processes equals the number of CPU processors 
-            result = pool.map(self.probeMatching, self.probeInfo)
-            pool.close()
-            pool.join()
+            with Metrics.timer('stage.matching'):
+                if self.options.sharedstore:
+                    result = self.sharedMatching(pool)
+                elif self.options.shardedoutput:
+                    result, stats = self.shardedMatching(pool)
+                elif self.options.locality:
+                    result = self.localityMatching(pool)
+                else:
+                    result = Metrics.poolMap(pool, self.probeMatching, self.probeInfo)
+                pool.close()
+                pool.join()
 
             end = time.time()
             print('\n\nFinish probe data mapping!')
@@ -114,48 +495,281 @@ class ProbeMapMatching:
             """
             write the result back to file
             """
-            with open(self.mappedfile, 'w') as mapfile, open(self.slopefile, 'w') as slopefile:
-                mapfilewriter = csv.writer(mapfile, delimiter = ',')
-                slopefilewriter = csv.writer(slopefile, delimiter = ',')
-
-                title = ['sampleID', 'dateTime', 'sourceCode', 'latitude', 'longitude', 'altitude', 'speed', 'heading', 'linkPVID', 'direction', 'distFromRef', 'distFromLink']
-                mapfilewriter.writerow(title)
-                title = ['sampleID', 'dateTime', 'latitude', 'longitude', 'altitude', 'probeSlope', 'linkSlope']
-                slopefilewriter.writerow(title)
-
-                accerror, probenum, totalnum = 0.0, 0, 0
-                for idx, probepoint in enumerate(result):
-                    if not probepoint.mappingsucessful:
-                        continue
-                    if len(self.addiInfo[idx].dateTimelist) == len(self.addiInfo[idx].sourceCodelist) \
-                        == len(self.addiInfo[idx].speedlist) == len(self.addiInfo[idx].headinglist) \
-                        == len(probepoint.shapeInfo) == len(probepoint.distFromRef) == len(probepoint.distFromLink):
-                        i = 0
-                        while i < len(self.addiInfo[idx].dateTimelist):
-                            line = [probepoint.sampleID, self.addiInfo[idx].dateTimelist[i], self.addiInfo[idx].sourceCodelist[i], \
-                                    probepoint.shapeInfo[i][0], probepoint.shapeInfo[i][1], probepoint.shapeInfo[i][2] if len(probepoint.shapeInfo[i]) == 3 else '', self.addiInfo[idx].speedlist[i], self.addiInfo[idx].headinglist[i], \
-                                    probepoint.maplinkID, probepoint.distFromRef[i], probepoint.distFromLink[i]]
-                            mapfilewriter.writerow(line)
-
-                            line = [probepoint.sampleID, self.addiInfo[idx].dateTimelist[i], probepoint.shapeInfo[i][0], probepoint.shapeInfo[i][1], probepoint.shapeInfo[i][2] if len(probepoint.shapeInfo[i]) == 3 else '', probepoint.slpoe[i], self.linkInfo[probepoint.maplinkID].avgslope if self.linkInfo[probepoint.maplinkID].avgslope != None else '']
-                            slopefilewriter.writerow(line)
-
-                            if line[-1] != '':
-                                accerror += ((line[-1] - line[-2])**2)
-                                probenum += 1
-
-                            i += 1
-                            totalnum += 1
-                    else:
-                        print("ERROR: Number of records is invalid, for probe data: ", probepoint.sampleID)
-                    
+            with Metrics.timer('stage.output'), self.resultStore() as store:
+                if self.options.shardedoutput and not self.options.sharedstore:
+                    writer = self.mergeShards(stats, store)
+                else:
+                    with MatchedPointsWriter(self.mappedfile, self.slopefile, self.linkInfo, self.options.linkstats, store) as writer:
+                        for idx, probepoint in enumerate(result):
+                            writer.writeProbe(probepoint, self.addiInfo[idx])
+
             end = time.time()
             print('Time used: {} s'.format(end-start))
 
-            print("\nTotally {} probe points are compared with link probe".format(probenum))
-            #print('Root mean square error is: {}'.format(math.sqrt(accerror/probenum)))
-            print('Root mean square error is: {}'.format(math.sqrt(accerror/totalnum)))
-            
+            print("\nTotally {} probe points are compared with link probe".format(writer.probenum))
+            print('Root mean square error is: {}'.format(writer.rmse()))
+            self.writeLinkStats(writer)
+            self.reportResultStore(store)
+            self.finishMetrics('run', writer)
+
+
+    def runStreaming(self, chunksize=64, maxinflight=None):
+        """
+        streaming version of run with bounded memory
+        trajectories are read from the probe file incrementally, sent to the pool in chunks of chunksize trajectories,
+        and written out as soon as their chunk is mapped, in file order
+        at most maxinflight chunks (default 2 per process) are read ahead, so peak memory depends on chunksize, not file size
+        the output files are identical to run
+        """
+        self.checkOptions('streaming')
+        print('\n\nProcess probe data mapping in streaming mode now...')
+        start = time.time()
+        probeProcess = self.probeDataProcess()
+
+        maxinflight = maxinflight or 2 * (os.cpu_count() or 1)
+        chunks = chunkIterable(probeProcess.iterData(), chunksize)
+        if self.options.shardedoutput:
+            self.prepareShards()
+            stats = []
+            with Pool(initializer=attachShardWriter, initargs=(self.linkInfo, self.shardpath, self.options.columnar, False, self.options.linkstats)) as pool, \
+                    Metrics.timer('stage.streaming'):
+                for _, (shardstats, _) in boundedImap(pool, matchWriteChunk, enumerate(chunks), maxinflight):
+                    stats.append(shardstats)
+                pool.close()
+                pool.join()
+            with Metrics.timer('stage.output'), self.resultStore() as store:
+                writer = self.mergeShards(stats, store)
+        else:
+            with self.resultStore() as store, Pool(initializer=attachLinkInfo, initargs=(self.linkInfo,)) as pool, Metrics.timer('stage.streaming'), \
+                    MatchedPointsWriter(self.mappedfile, self.slopefile, self.linkInfo, self.options.linkstats, store) as writer:
+                for chunk, result in boundedImap(pool, matchProbeChunk, chunks, maxinflight):
+                    for (_, addiinfo), probepoint in zip(chunk, result):
+                        writer.writeProbe(probepoint, addiinfo)
+                pool.close()
+                pool.join()
+
+        end = time.time()
+        print('Time used: {} s'.format(end-start))
+
+        print("\nTotally {} probe points are compared with link probe".format(writer.probenum))
+        print('Root mean square error is: {}'.format(writer.rmse()))
+        self.writeLinkStats(writer)
+        self.reportResultStore(store)
+        self.finishMetrics('streaming', writer)
+
+
+    def runIncremental(self, chunksize=64, maxinflight=None):
+        """
+        incremental version of runStreaming
+        the trajectories after the watermark of the last run are mapped in batches of chunksize trajectories,
+        each batch is written to its own shard files in checkpoints/ and then the watermark is moved past it,
+        so a stopped run resumes after its last finished batch, and a probe file with appended data only maps the new trajectories
+        the output files are concatenated from all shards at the end, they are identical to run on the whole file
+        """
+        self.checkOptions('incremental')
+        print('\n\nProcess probe data mapping in incremental mode now...')
+        start = time.time()
+        probeProcess = self.probeDataProcess()
+        params = probeProcess.candidateParams()
+        if self.options.shapedistance:
+            params['shapedistance'] = True
+        if self.options.sequential:
+            params['sequential'] = True
+        if self.options.slopewindow > 1:
+            params['slopewindow'] = self.options.slopewindow
+        if self.options.linkstats:
+            params['linkstats'] = True
+        checkpoints = CheckpointStore(self.checkpointpath, probeProcess.sourcefile, self.linkfile, params)
+        offset = checkpoints.open()
+        print('Resume from byte {} after {} batches'.format(offset, checkpoints.numbatches))
+
+        # watermark of each batch in flight, (stop, sampleID) of its last trajectory
+        watermarks = {}
+
+        def batches():
+            groups = probeProcess.iterGroups(offset)
+            for shardidx, groupchunk in enumerate(chunkIterable(groups, chunksize), checkpoints.numbatches):
+                probes = [probe for _, _, rows in groupchunk for probe in probeProcess.iterRows(rows, flushlast=True)]
+                watermarks[shardidx] = (groupchunk[-1][1], groupchunk[-1][2][0][0])
+                yield shardidx, probes
+
+        maxinflight = maxinflight or 2 * (os.cpu_count() or 1)
+        with Pool(initializer=attachShardWriter, initargs=(self.linkInfo, checkpoints.path, False, False, self.options.linkstats)) as pool, \
+                Metrics.timer('stage.incremental'):
+            for (shardidx, _), (stats, _) in boundedImap(pool, matchWriteChunk, batches(), maxinflight):
+                checkpoints.commitBatch(stats, *watermarks.pop(shardidx))
+            pool.close()
+            pool.join()
+        with Metrics.timer('stage.output'), self.resultStore() as store:
+            writer = checkpoints.writeOutput(self.mappedfile, self.slopefile, self.options.linkstats)
+            if store is not None:
+                store.addFiles(self.mappedfile, self.slopefile)
+
+        end = time.time()
+        print('Time used: {} s'.format(end-start))
+
+        print("\nTotally {} probe points are compared with link probe".format(writer.probenum))
+        print('Root mean square error is: {}'.format(writer.rmse()))
+        self.writeLinkStats(writer)
+        self.reportResultStore(store)
+        self.finishMetrics('incremental', writer)
+
+
+    def prepareShards(self):
+        """
+        empty the shard folder of the sharded output mode
+        """
+        if os.path.isdir(self.shardpath):
+            shutil.rmtree(self.shardpath)
+        os.makedirs(self.shardpath)
+
+
+    def shardedMatching(self, pool):
+        """
+        sharded output mode of the mapping
+        each task maps a chunk of trajectories and writes their rows to its own shard files
+        rtype: result: list of the mapped ProbeData, stats: list of the slope error statistics of each shard
+        """
+        self.prepareShards()
+        tasks = ((shardidx, list(zip(self.probeInfo[start:start + self.sharedchunksize], self.addiInfo[start:start + self.sharedchunksize])))
+                 for shardidx, start in enumerate(range(0, len(self.probeInfo), self.sharedchunksize)))
+        result, stats = [], []
+        for shardstats, shardresult in Metrics.poolImap(pool, matchWriteChunk, tasks):
+            stats.append(shardstats)
+            result.extend(shardresult)
+        return result, stats
+
+
+    def localityMatching(self, pool):
+        """
+        locality scheduling mode of the mapping
+        batches of nearby trajectories are taken by the workers as they become idle, the results are put back in file order
+        rtype: list of the mapped ProbeData
+        """
+        batches = localityBatches(self.probeInfo, self.batchpoints, os.cpu_count() or 1)
+        store = getattr(self.probeInfo, 'store', None)
+        if store is not None:
+            # the trajectories of the probe cache are sent as the arrays of the batch and built once, in the worker
+            tasks = ((batch, store.select(batch)) for batch in batches)
+        else:
+            tasks = ((batch, [self.probeInfo[idx] for idx in batch]) for batch in batches)
+        result = [None] * len(self.probeInfo)
+        for indices, probes in Metrics.poolImap(pool, matchProbeBatch, tasks, unordered=True):
+            for idx, probePoint in zip(indices, probes):
+                result[idx] = probePoint
+        return result
+
+
+    def mergeShards(self, stats, store=None):
+        """
+        concatenate the shards into the output files in order
+        store type: ResultStoreWriter, if given the merged files are loaded into the result database
+        rtype: MatchedPointsWriter holding the total slope error statistics
+        """
+        mergeShards(self.shardpath, self.mappedfile, self.slopefile, self.columnarpath if self.options.columnar else None)
+        if store is not None:
+            store.addFiles(self.mappedfile, self.slopefile)
+        writer = MatchedPointsWriter(self.mappedfile, self.slopefile, self.linkInfo)
+        if self.options.linkstats:
+            writer.linkstats = mergeLinkStats(self.shardpath)
+        os.rmdir(self.shardpath)
+        for shardstats in stats:
+            writer.addStats(shardstats)
+        return writer
+
+
+    def resultStore(self):
+        """
+        rtype: ResultStoreWriter of MatchedPoints.db if it is asked for, else a context giving None
+        the rows are loaded from its own process while the output files are written, leaving the context waits for
+        the load and the indexes
+        """
+        if not self.options.resultstore:
+            return nullcontext()
+        return ResultStoreWriter(self.storefile)
+
+
+    def reportResultStore(self, store):
+        """
+        print the load report of the result database, if it was written
+        """
+        if store is None:
+            return
+        print('{} rows loaded into {} in {:.3f} s, indexes built in {:.3f} s'.format(
+            store.report['rows'], self.storefile, store.report['load_s'], store.report['index_s']))
+
+
+    def startMetrics(self):
+        """
+        turn the instrumentation on if it is asked for, and start the progress line
+        """
+        if not self.options.metrics or Metrics.enabled():
+            return
+        Metrics.enable()
+        Metrics.setProfile(self.options.profileworker, self.profilepath)
+        if self.options.progress:
+            Metrics.startProgress(self.options.progress)
+
+
+    def finishMetrics(self, mode, writer):
+        """
+        stop the progress line and write the run report, if the instrumentation is on
+        """
+        if not Metrics.enabled():
+            return
+        Metrics.stopProgress()
+        Metrics.writeReport(self.reportfile, mode=mode, probefile=self.probefile, linkfile=self.linkfile,
+                            workers=os.cpu_count() or 1, rmse=writer.rmse() if writer.totalnum else None)
+        print('Run report written to {}'.format(self.reportfile))
+
+
+    def writeLinkStats(self, writer):
+        """
+        write the per link slope statistics aggregated by the writer to LinkSlopeStats.csv, if they were kept
+        """
+        if writer.linkstats is None:
+            return
+        writer.linkstats.writeCsv(self.linkstatsfile)
+        print('Slope statistics of {} links written to {}'.format(len(writer.linkstats.linkPVIDs), self.linkstatsfile))
+
+
+    def prepareSharedStore(self):
+        """
+        write the link and probe data once into memory-mapped arrays for the shared store mode
+        rtype: dict, keyword arguments for the Pool so that each worker attaches to the stores at startup
+        """
+        self.linkstore = self.linkInfo if isinstance(self.linkInfo, LinkStore) else LinkStore.fromLinkInfo(self.linkInfo)
+        self.linkstore.save(os.path.join(self.storepath, 'links'))
+        if self.linkstore.geometry is not None:
+            self.linkstore.geometry.save(os.path.join(self.storepath, 'geometry'))
+        elif os.path.isdir(os.path.join(self.storepath, 'geometry')):
+            shutil.rmtree(os.path.join(self.storepath, 'geometry'))
+        TrajectoryStore.fromProbeInfo(self.probeInfo, self.linkstore).save(os.path.join(self.storepath, 'trajectories'))
+        return {'initializer': attachSharedStore, 'initargs': (self.storepath, self.options.slopewindow, self.options.cachebytes)}
+
+
+    def sharedMatching(self, pool):
+        """
+        shared store mode of the mapping
+        tasks only carry (start, stop) ranges of trajectories and results come back as compact arrays,
+        which are then set back to the ProbeData objects for writing
+        """
+        bounds = [(start, min(start + self.sharedchunksize, len(self.probeInfo)))
+                  for start in range(0, len(self.probeInfo), self.sharedchunksize)]
+        chunks = Metrics.poolMap(pool, matchSharedRange, bounds)
+
+        # probeInfo may be a sequence built on access, so the ProbeData objects are collected first
+        result = list(self.probeInfo)
+        for (start, stop), (linkidx, values) in zip(bounds, chunks):
+            pos = 0
+            for t in range(start, stop):
+                probePoint = result[t]
+                num = probePoint.numpoints
+                probePoint.setMapInfo(str(self.linkstore.linkPVIDs[linkidx[t - start]]), values[pos:pos+num, 0].tolist(), values[pos:pos+num, 1].tolist())
+                probePoint.slpoe = [0 if math.isnan(slope) else slope for slope in values[pos:pos+num, 2].tolist()]
+                pos += num
+        return result
+
 
     def loadFilewithPickle(self, file):
         """
@@ -176,13 +790,62 @@ class ProbeMapMatching:
 
 
 def main():
-    sourcepath, tgtpath = './probe_data_map_matching', './probe_data_map_matching'
-    linkdatafilename, probedatafilename = 'Partition6467LinkData.csv', 'Partition6467ProbePoints.csv'
-
-    matchProcess = ProbeMapMatching(sourcepath, linkdatafilename, probedatafilename, tgtpath)
-    matchProcess.loadData()
-
-    matchProcess.run()
+    parser = argparse.ArgumentParser(description='Probe data map matching and slope calculation')
+    parser.add_argument('--sourcepath', default='./probe_data_map_matching')
+    parser.add_argument('--tgtpath', default='./probe_data_map_matching')
+    parser.add_argument('--linkfile', default='Partition6467LinkData.csv')
+    parser.add_argument('--probefile', default='Partition6467ProbePoints.csv')
+    parser.add_argument('--shared-store', action='store_true', help='workers memory-map the link and probe data instead of receiving pickles')
+    parser.add_argument('--streaming', action='store_true', help='read, map and write trajectories incrementally with bounded memory')
+    parser.add_argument('--incremental', action='store_true', help='checkpoint every chunk and resume from the last run, only new trajectories are mapped')
+    parser.add_argument('--chunksize', type=int, default=64, help='number of trajectories per task in streaming mode')
+    parser.add_argument('--segment-index', action='store_true', help='look up candidate links over whole link polylines instead of ref node geohashes')
+    parser.add_argument('--link-workers', type=int, default=1, help='number of processes parsing the link file in parallel')
+    parser.add_argument('--sort-probes', action='store_true', help='sort the probe file by sampleID and dateTime first, with bounded memory')
+    parser.add_argument('--sort-memory', type=int, default=64, help='megabytes of memory taken by the probe rows of each sorted run, python objects included')
+    parser.add_argument('--sharded-output', action='store_true', help='workers write their own output shards, which are concatenated in order at the end')
+    parser.add_argument('--columnar', action='store_true', help='with --sharded-output, also write the rows as binary columns to MatchedPoints/part-*.npz')
+    parser.add_argument('--locality', action='store_true', help='send trajectories to the workers in batches grouped by geohash cell and sized by point count')
+    parser.add_argument('--shape-distance', action='store_true', help='measure distFromRef and distFromLink along the link polylines instead of to the ref node and the ref-nonref line')
+    parser.add_argument('--prefilter', action='store_true', help='prune the candidate links by bounding box, heading and direction of travel before scoring them')
+    parser.add_argument('--sequential', action='store_true', help='map each point to its own link with a beam search over the link adjacency, for long trips')
+    parser.add_argument('--slope-window', type=int, default=1, help='smooth the slope of each point over this many consecutive steps')
+    parser.add_argument('--link-stats', action='store_true', help='also write the count, mean, median, RMSE and bias of the matched slopes of each link to LinkSlopeStats.csv')
+    parser.add_argument('--metrics', action='store_true', help='instrument the stages, workers and hot paths, print a progress line and write RunReport.json')
+    parser.add_argument('--progress', type=float, default=10.0, help='seconds between two progress lines with --metrics, 0 for none')
+    parser.add_argument('--profile-worker', choices=['cprofile', 'sampling'], default=None, help='with --metrics, profile one worker into profile/')
+    parser.add_argument('--compress-stationary', action='store_true', help='map each run of stationary or repeated points as one point and write its result to every row')
+    parser.add_argument('--stationary-distance', type=float, default=10.0, help='meters from the first point of a run within which the next points join it')
+    parser.add_argument('--stationary-seconds', type=float, default=60.0, help='seconds from the first point of a run within which the next points join it')
+    parser.add_argument('--candidate-cache', type=float, default=DEFAULTMAXBYTES >> 20, help='megabytes of candidate links and arrays each process keeps per geohash cell and candidate list, 0 for none')
+    parser.add_argument('--result-store', action='store_true', help='also load the matched rows into the indexed SQLite database MatchedPoints.db, from a writer process')
+    parser.add_argument('--probe-workers', type=int, default=1, help='number of processes parsing the probe file in parallel')
+    args = parser.parse_args()
+
+    options = MatchingOptions(sharedstore=args.shared_store, segmentindex=args.segment_index, linkworkers=args.link_workers, probeworkers=args.probe_workers,
+                              sortprobes=args.sort_probes, shardedoutput=args.sharded_output, columnar=args.columnar,
+                              locality=args.locality, shapedistance=args.shape_distance,
+                              prefilter=args.prefilter, sequential=args.sequential,
+                              slopewindow=args.slope_window, linkstats=args.link_stats,
+                              metrics=args.metrics, progress=args.progress, profileworker=args.profile_worker,
+                              compress=(args.stationary_distance, args.stationary_seconds) if args.compress_stationary else None,
+                              cachebytes=int(args.candidate_cache * (1 << 20)), resultstore=args.result_store, sortmemory=args.sort_memory << 20)
+    if args.streaming and args.incremental:
+        parser.error('--streaming and --incremental are two run modes, only one can be used')
+    conflicts = options.conflicts('incremental' if args.incremental else 'streaming' if args.streaming else 'run')
+    if conflicts:
+        parser.error(conflicts[0])
+
+    matchProcess = ProbeMapMatching(args.sourcepath, args.linkfile, args.probefile, args.tgtpath, options)
+    if args.incremental:
+        matchProcess.loadData(loadprobes=False)
+        matchProcess.runIncremental(chunksize=args.chunksize)
+    elif args.streaming:
+        matchProcess.loadData(loadprobes=False)
+        matchProcess.runStreaming(chunksize=args.chunksize)
+    else:
+        matchProcess.loadData()
+        matchProcess.run()
     
 
 
@@ -0,0 +1,394 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module keeps the matched points in an embedded SQLite database, MatchedPoints.db, for fast queries
+The rows of MatchedPoints.csv and MatchedPointsSlope.csv are loaded into one table, points, with the columns of the
+columnar output (dateTime as epoch seconds) in the row order of the files. The rows are inserted in batched
+transactions by a dedicated writer process, see ResultStoreWriter, and the indexes on linkPVID, sampleID and dateTime
+are built once at the end. The database is written to a temporary file and renamed when complete.
+It can also be built from the output files of any run, and queried from the command line:
+
+    python3 ResultStore.py load MatchedPoints.db MatchedPoints.csv MatchedPointsSlope.csv
+    python3 ResultStore.py link MatchedPoints.db 62007637 --start "06/12/2009 06:00:00 AM" --stop "06/12/2009 07:00:00 AM"
+    python3 ResultStore.py trajectory MatchedPoints.db 3496
+    python3 ResultStore.py range MatchedPoints.db --start 1244786400 --stop 1244790000 --limit 100
+    python3 ResultStore.py summary MatchedPoints.db 62007637
+"""
+
+import os
+import io
+import csv
+import sys
+import time
+import sqlite3
+import argparse
+from itertools import islice
+from multiprocessing import Process, Queue, Pipe
+
+import Metrics
+from ProbeData import parseDateTime, formatDateTime
+from ResultWriter import COLUMNS
+
+# version of the table layout, a database of another version is not read
+STOREVERSION = 1
+
+COLUMNTYPES = {'sampleID': 'TEXT', 'dateTime': 'INTEGER', 'sourceCode': 'TEXT', 'linkPVID': 'TEXT'}
+
+INDEXES = (('points_linkPVID', 'linkPVID, dateTime'), ('points_sampleID', 'sampleID'), ('points_dateTime', 'dateTime'))
+
+
+class ResultStore(object):
+    """
+    SQLite database of the matched points, rows are tuples in the order of COLUMNS, and each query returns its rows
+    in the order of the output files
+    use it as a context manager:
+
+        with ResultStore(dbpath) as store:
+            rows = store.link('62007637')
+    """
+    # rows inserted per transaction
+    batchrows = 50000
+
+    def __init__(self, path, create=False):
+        """
+        path type: str, path of the database file
+        create type: bool, if True an empty database is created for loading, replacing the file, else it is opened read only
+        """
+        self.path = path
+        if create:
+            if os.path.exists(path):
+                os.remove(path)
+            self.connection = sqlite3.connect(path)
+            # the file is only renamed into place when complete, so the load doesn't need a journal
+            self.connection.execute('PRAGMA journal_mode = OFF')
+            self.connection.execute('PRAGMA synchronous = OFF')
+            self.connection.execute('CREATE TABLE points ({})'.format(', '.join('{} {}'.format(name, COLUMNTYPES.get(name, 'REAL')) for name in COLUMNS)))
+            self.connection.execute('PRAGMA user_version = {:d}'.format(STOREVERSION))
+        else:
+            self.connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+            version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+            if version != STOREVERSION:
+                self.connection.close()
+                raise ValueError('{} has store version {}, expected {}'.format(path, version, STOREVERSION))
+        self.numrows = 0
+        # epoch seconds of each dateTime text loaded so far, many rows share their dateTime
+        self.timestamps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT count(*) FROM points').fetchone()[0]
+
+    def insertRows(self, rows):
+        """
+        rows type: list of tuples in the order of COLUMNS, inserted in one transaction
+        """
+        with self.connection:
+            self.connection.executemany('INSERT INTO points VALUES ({})'.format(', '.join('?' * len(COLUMNS))), rows)
+        self.numrows += len(rows)
+
+    def loadCsv(self, mappedfile, slopefile, start=None, stop=None):
+        """
+        insert the rows of the output files of a run, in batches of batchrows rows
+        start, stop type: (mapped, slope) byte offsets of the rows to load, by default from after the header rows to the end
+        """
+        rows = zip(csvRange(mappedfile, *offsetPair(start, stop, 0)), csvRange(slopefile, *offsetPair(start, stop, 1)))
+        while True:
+            batch = list(islice(rows, self.batchrows))
+            if not batch:
+                break
+            self.insertRows(storeBatch([maprow for maprow, _ in batch], [sloperow for _, sloperow in batch], self.timestamps))
+
+    def createIndexes(self):
+        for name, columns in INDEXES:
+            self.connection.execute('CREATE INDEX IF NOT EXISTS {} ON points ({})'.format(name, columns))
+        self.connection.execute('ANALYZE')
+        self.connection.commit()
+
+    def query(self, where, params, limit=None):
+        """
+        rtype: list of the rows matching the where clause, in file order
+        """
+        sql = 'SELECT {} FROM points WHERE {} ORDER BY rowid'.format(', '.join(COLUMNS), where)
+        if limit is not None:
+            sql += ' LIMIT {:d}'.format(limit)
+        return self.connection.execute(sql, params).fetchall()
+
+    def link(self, linkPVID, start=None, stop=None, limit=None):
+        """
+        rtype: rows of the points matched to linkPVID, with start <= dateTime < stop in epoch seconds if given
+        """
+        where, params = timeRange('linkPVID = ?', [str(linkPVID)], start, stop)
+        return self.query(where, params, limit)
+
+    def trajectory(self, sampleID, limit=None):
+        """
+        rtype: rows of the trajectory sampleID
+        """
+        return self.query('sampleID = ?', [str(sampleID)], limit)
+
+    def timeRange(self, start, stop, limit=None):
+        """
+        rtype: rows with start <= dateTime < stop in epoch seconds
+        """
+        where, params = timeRange('1', [], start, stop)
+        return self.query(where, params, limit)
+
+    def linkSummary(self, linkPVID):
+        """
+        rtype: dict, number of points and trajectories matched to linkPVID, their first and last dateTime,
+                the mean probe slope and the link slope
+        """
+        row = self.connection.execute('SELECT count(*), count(DISTINCT sampleID), min(dateTime), max(dateTime), avg(probeSlope), max(linkSlope) '
+                                      'FROM points WHERE linkPVID = ?', [str(linkPVID)]).fetchone()
+        return dict(zip(('points', 'trajectories', 'first', 'last', 'mean_probe_slope', 'link_slope'), row))
+
+
+def timeRange(where, params, start, stop):
+    """
+    helper for the queries, add start <= dateTime < stop to a where clause
+    """
+    if start is not None:
+        where, params = where + ' AND dateTime >= ?', params + [int(start)]
+    if stop is not None:
+        where, params = where + ' AND dateTime < ?', params + [int(stop)]
+    return where, params
+
+
+def offsetPair(start, stop, idx):
+    return (start[idx] if start is not None else None), (stop[idx] if stop is not None else None)
+
+
+def csvRange(path, start=None, stop=None):
+    """
+    rtype: iterator over the csv rows in bytes [start, stop) of path, which must be row boundaries,
+            by default from after the header row to the end of the file
+    """
+    with open(path, 'rb') as binary:
+        if start is None:
+            binary.readline()
+        else:
+            binary.seek(start)
+        if stop is None:
+            yield from csv.reader(io.TextIOWrapper(binary, newline=''))
+        else:
+            yield from csv.reader(io.TextIOWrapper(io.BytesIO(binary.read(stop - binary.tell())), newline=''))
+
+
+def storeFloat(value):
+    """
+    rtype: float, or None for an empty or invalid value, sqlite stores nan as NULL too
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def floatColumn(values):
+    try:
+        # empty values are common, e.g. the linkSlope of links without surveyed slope
+        return [float(value) if value else None for value in values]
+    except ValueError:
+        return [storeFloat(value) for value in values]
+
+
+def storeTimestamp(dateTime):
+    """
+    rtype: int epoch seconds of a dateTime of the probe data, None if it can't be parsed
+    """
+    try:
+        return parseDateTime(dateTime)
+    except ValueError:
+        return None
+
+
+def timestampColumn(values, timestamps):
+    """
+    timestamps type: dict, dateTime text -> epoch seconds already parsed, updated
+    """
+    column = []
+    for value in values:
+        timestamp = timestamps.get(value)
+        if timestamp is None:
+            timestamp = timestamps[value] = storeTimestamp(value)
+        column.append(timestamp)
+    return column
+
+
+def storeBatch(maprows, sloperows, timestamps=None):
+    """
+    rtype: list of tuples in the order of COLUMNS, from rows of MatchedPoints.csv and the same rows of MatchedPointsSlope.csv,
+            converted a column at a time
+    timestamps type: dict of the dateTime texts already parsed, see timestampColumn
+    """
+    if not maprows:
+        return []
+    mapcolumns, slopecolumns = list(zip(*maprows)), list(zip(*sloperows))
+    return list(zip(mapcolumns[0], timestampColumn(mapcolumns[1], timestamps if timestamps is not None else {}), mapcolumns[2],
+                    *[floatColumn(mapcolumns[col]) for col in (3, 4, 5, 6, 7)], mapcolumns[8],
+                    floatColumn(mapcolumns[9]), floatColumn(mapcolumns[10]), floatColumn(slopecolumns[5]), floatColumn(slopecolumns[6])))
+
+
+def loadStore(path, queue, connection):
+    """
+    Process target of ResultStoreWriter, load the rows of the output files sent through queue as
+    (mappedfile, slopefile, start, stop) until None, then build the indexes and send the load report, or the error,
+    through connection
+    """
+    try:
+        store = ResultStore(path, create=True)
+        # seconds spent reading, converting and inserting, without the waits for the next range
+        loadtime = 0.0
+        for task in iter(queue.get, None):
+            start = time.perf_counter()
+            store.loadCsv(*task)
+            loadtime += time.perf_counter() - start
+        start = time.perf_counter()
+        store.createIndexes()
+        store.close()
+        connection.send({'rows': store.numrows, 'load_s': loadtime, 'index_s': time.perf_counter() - start})
+    except Exception as error:
+        connection.send({'error': repr(error)})
+        raise
+    finally:
+        connection.close()
+
+
+class ResultStoreWriter(object):
+    """
+    Loads the matched rows into a ResultStore from a dedicated process, which reads them back from the output files,
+    so the process writing the files only flushes them and sends byte offsets, use it as a context manager:
+
+        with ResultStoreWriter(dbpath) as store:
+            store.addFiles(mappedfile, slopefile)
+
+    or pass it to MatchedPointsWriter, which sends the rows it has written every batchrows rows.
+    The database replaces dbpath when the context exits, after the last rows are loaded and the indexes are built
+    """
+    batchrows = 50000
+
+    def __init__(self, dbpath):
+        self.dbpath = dbpath
+        self.tmppath = dbpath + '.tmp'
+        self.report = None
+
+    def __enter__(self):
+        self.queue = Queue()
+        self.connection, childconnection = Pipe(duplex=False)
+        self.process = Process(target=loadStore, args=(self.tmppath, self.queue, childconnection), daemon=True)
+        self.process.start()
+        childconnection.close()
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is not None:
+            self.process.terminate()
+            self.process.join()
+            if os.path.exists(self.tmppath):
+                os.remove(self.tmppath)
+            return False
+        self.queue.put(None)
+        # the time the main process waits for the last rows and the indexes
+        with Metrics.timer('store_wait'):
+            try:
+                self.report = self.connection.recv()
+            except EOFError:
+                self.report = {'error': 'the writer process exited with code {}'.format(self.process.exitcode)}
+            self.process.join()
+        if 'error' in self.report:
+            raise RuntimeError('loading {} failed: {}'.format(self.dbpath, self.report['error']))
+        os.replace(self.tmppath, self.dbpath)
+        return False
+
+    def addFiles(self, mappedfile, slopefile, start=None, stop=None):
+        """
+        load the rows of output files already written and flushed, see ResultStore.loadCsv
+        """
+        self.queue.put((mappedfile, slopefile, start, stop))
+
+
+def parseTime(value):
+    """
+    argparse type of the time arguments, epoch seconds or a dateTime of the probe data
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return parseDateTime(value)
+
+
+def writeRows(rows, output):
+    """
+    write query rows as csv with a header, dateTime formatted as in the probe data
+    """
+    writer = csv.writer(output)
+    writer.writerow(COLUMNS)
+    for row in rows:
+        writer.writerow((row[0], formatDateTime(row[1]) if row[1] is not None else '') + tuple('' if value is None else value for value in row[2:]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load and query the matched points database')
+    subparsers = parser.add_subparsers(dest='command')
+
+    loadparser = subparsers.add_parser('load', help='build the database from the output files of a run')
+    loadparser.add_argument('dbpath')
+    loadparser.add_argument('mappedfile', help='path of MatchedPoints.csv')
+    loadparser.add_argument('slopefile', help='path of MatchedPointsSlope.csv')
+
+    linkparser = subparsers.add_parser('link', help='points matched to a link')
+    linkparser.add_argument('dbpath')
+    linkparser.add_argument('linkPVID')
+
+    trajparser = subparsers.add_parser('trajectory', help='points of a trajectory')
+    trajparser.add_argument('dbpath')
+    trajparser.add_argument('sampleID')
+
+    rangeparser = subparsers.add_parser('range', help='points in a time range')
+    rangeparser.add_argument('dbpath')
+
+    summaryparser = subparsers.add_parser('summary', help='number of points and trajectories and mean slope of a link')
+    summaryparser.add_argument('dbpath')
+    summaryparser.add_argument('linkPVID')
+
+    for subparser in (linkparser, rangeparser):
+        subparser.add_argument('--start', type=parseTime, default=None, help='epoch seconds or dateTime, e.g. "06/12/2009 06:00:00 AM"')
+        subparser.add_argument('--stop', type=parseTime, default=None, help='epoch seconds or dateTime, excluded')
+    for subparser in (linkparser, trajparser, rangeparser):
+        subparser.add_argument('--limit', type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == 'load':
+        start = time.time()
+        with ResultStoreWriter(args.dbpath) as store:
+            store.addFiles(args.mappedfile, args.slopefile)
+        print('{} rows loaded in {:.3f} s, indexes built in {:.3f} s, total {:.3f} s'.format(
+            store.report['rows'], store.report['load_s'], store.report['index_s'], time.time() - start))
+        return
+    if args.command is None:
+        parser.print_help()
+        return
+    with ResultStore(args.dbpath) as store:
+        if args.command == 'link':
+            writeRows(store.link(args.linkPVID, args.start, args.stop, args.limit), sys.stdout)
+        elif args.command == 'trajectory':
+            writeRows(store.trajectory(args.sampleID, args.limit), sys.stdout)
+        elif args.command == 'range':
+            writeRows(store.timeRange(args.start, args.stop, args.limit), sys.stdout)
+        elif args.command == 'summary':
+            for key, value in store.linkSummary(args.linkPVID).items():
+                print('{}: {}'.format(key, value))
+
+
+if __name__ == '__main__':
+    main()
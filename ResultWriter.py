@@ -0,0 +1,304 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module writes the mapping results back to MatchedPoints.csv and MatchedPointsSlope.csv
+It also accumulates the slope error used for the RMSE evaluation, and optionally the per link slope statistics
+With sharded output, each worker writes the rows of its chunk of trajectories to its own shard files,
+which the parent then concatenates in chunk order, optionally with a binary columnar copy of the rows
+"""
+
+import os
+import csv
+import glob
+import math
+import shutil
+
+import numpy as np
+
+import Metrics
+from ProbeData import parseDateTime
+from SlopeAggregation import SlopeAccumulator, mergeFiles
+
+
+class MatchedPointsWriter(object):
+    """
+    Write matched probe data one trajectory at a time, so results can be written as they arrive
+    use it as a context manager:
+
+        with MatchedPointsWriter(mappedfile, slopefile, linkInfo) as writer:
+            writer.writeProbe(probepoint, addiinfo)
+    """
+    maptitle = ['sampleID', 'dateTime', 'sourceCode', 'latitude', 'longitude', 'altitude', 'speed', 'heading', 'linkPVID', 'direction', 'distFromRef', 'distFromLink']
+    slopetitle = ['sampleID', 'dateTime', 'latitude', 'longitude', 'altitude', 'probeSlope', 'linkSlope']
+
+    # write buffer of each output file
+    buffersize = 1 << 20
+    # header rows are written by the merge step, not by the shards
+    writeheader = True
+
+    def __init__(self, mappedfile, slopefile, linkInfo, linkstats=False, store=None):
+        """
+        mappedfile type: str, path of MatchedPoints.csv
+        slopefile type: str, path of MatchedPointsSlope.csv
+        linkInfo type: dict, linkPVID -> LinkData, used to look up the surveyed slope
+        linkstats type: bool, if True the slopes of the written points are also aggregated per link, see SlopeAggregation
+        store type: ResultStoreWriter, if given the written rows are also loaded into the result database, see ResultStore,
+                    every batchrows rows the files are flushed and the writer process is sent the byte ranges of the new rows
+        """
+        self.mappedfile = mappedfile
+        self.slopefile = slopefile
+        self.linkInfo = linkInfo
+        self.store = store
+
+        self.accerror, self.probenum, self.totalnum = 0.0, 0, 0
+        self.linkstats = SlopeAccumulator() if linkstats else None
+
+    def __enter__(self):
+        self.mapfile = open(self.mappedfile, 'w', buffering=self.buffersize)
+        self.slopefileobj = open(self.slopefile, 'w', buffering=self.buffersize)
+        self.mapfilewriter = csv.writer(self.mapfile, delimiter = ',')
+        self.slopefilewriter = csv.writer(self.slopefileobj, delimiter = ',')
+
+        if self.writeheader:
+            self.mapfilewriter.writerow(self.maptitle)
+            self.slopefilewriter.writerow(self.slopetitle)
+        if self.store is not None:
+            self.storeoffsets, self.storerows = self.flushOffsets(), 0
+        return self
+
+    def __exit__(self, *exc):
+        self.mapfile.close()
+        self.slopefileobj.close()
+        if self.store is not None and exc[0] is None:
+            # the rows after the last range, to the end of the files
+            self.store.addFiles(self.mappedfile, self.slopefile, self.storeoffsets)
+        return False
+
+    def writeProbe(self, probepoint, addiinfo):
+        """
+        write all points of one mapped probe data, together with its ProbeAdditionalInfo
+        the rows of the trajectory are emitted with one writerows call per file
+        """
+        maprows, sloperows = self.probeRows(probepoint, addiinfo)
+        if maprows:
+            self.writeRows(maprows, sloperows)
+
+    def writeRows(self, maprows, sloperows):
+        self.mapfilewriter.writerows(maprows)
+        self.slopefilewriter.writerows(sloperows)
+        if self.store is not None:
+            self.storerows += len(maprows)
+            if self.storerows >= self.store.batchrows:
+                offsets = self.flushOffsets()
+                self.store.addFiles(self.mappedfile, self.slopefile, self.storeoffsets, offsets)
+                self.storeoffsets, self.storerows = offsets, 0
+
+    def flushOffsets(self):
+        """
+        rtype: (mapped, slope) byte offsets of the end of the files, after flushing them
+        """
+        self.mapfile.flush()
+        self.slopefileobj.flush()
+        return self.mapfile.tell(), self.slopefileobj.tell()
+
+    def probeRows(self, probepoint, addiinfo):
+        """
+        rtype: rows of MatchedPoints.csv and of MatchedPointsSlope.csv for one mapped probe data, the slope error is accumulated
+        a compressed probe data is expanded back to every row first, see ProbeData.expand
+        """
+        maprows, sloperows = [], []
+        probepoint.expand()
+        if not probepoint.mappingsucessful:
+            Metrics.count('points_skipped', len(probepoint.shapeInfo))
+            return maprows, sloperows
+        # the compact columns are formatted back to text once per trajectory
+        dateTimelist, sourceCodelist, speedlist, headinglist = addiinfo.dateTimelist, addiinfo.sourceCodelist, addiinfo.speedlist, addiinfo.headinglist
+        shapeInfo = probepoint.shapeInfo
+        if len(dateTimelist) == len(sourceCodelist) \
+            == len(speedlist) == len(headinglist) \
+            == len(shapeInfo) == len(probepoint.distFromRef) == len(probepoint.distFromLink):
+            # the sequential matcher sets a link per point
+            linkIDs = probepoint.maplinkIDs or [probepoint.maplinkID] * len(dateTimelist)
+            avgslopes = {linkID: self.linkInfo[linkID].avgslope for linkID in set(linkIDs)}
+            i = 0
+            while i < len(dateTimelist):
+                avgslope = avgslopes[linkIDs[i]]
+                line = [probepoint.sampleID, dateTimelist[i], sourceCodelist[i], \
+                        shapeInfo[i][0], shapeInfo[i][1], shapeInfo[i][2] if len(shapeInfo[i]) == 3 else '', speedlist[i], headinglist[i], \
+                        linkIDs[i], probepoint.distFromRef[i], probepoint.distFromLink[i]]
+                maprows.append(line)
+
+                line = [probepoint.sampleID, dateTimelist[i], shapeInfo[i][0], shapeInfo[i][1], shapeInfo[i][2] if len(shapeInfo[i]) == 3 else '', probepoint.slpoe[i], avgslope if avgslope != None else '']
+                sloperows.append(line)
+
+                if line[-1] != '':
+                    self.accerror += ((line[-1] - line[-2])**2)
+                    self.probenum += 1
+
+                i += 1
+                self.totalnum += 1
+            if self.linkstats is not None:
+                self.linkstats.add(linkIDs, probepoint.slpoe, [avgslopes[linkID] for linkID in linkIDs])
+            Metrics.count('points_written', len(maprows))
+        else:
+            print("ERROR: Number of records is invalid, for probe data: ", probepoint.sampleID)
+            Metrics.count('points_skipped', len(shapeInfo))
+        return maprows, sloperows
+
+    def stats(self):
+        """
+        rtype: (accerror, probenum, totalnum), see addStats
+        """
+        return self.accerror, self.probenum, self.totalnum
+
+    def addStats(self, stats):
+        """
+        add the slope error statistics of a shard
+        """
+        accerror, probenum, totalnum = stats
+        self.accerror += accerror
+        self.probenum += probenum
+        self.totalnum += totalnum
+
+    def rmse(self):
+        """
+        root mean square error between probe slope and link slope over all written points
+        """
+        return math.sqrt(self.accerror/self.totalnum)
+
+
+class ShardWriter(MatchedPointsWriter):
+    """
+    Writes the rows of one chunk of trajectories to shard files without header, in a worker process
+    with columnar, the rows are also kept as typed columns and saved to a .npz file when the shard is closed
+    with linkstats, the per link slope statistics of the shard are saved to LinkSlopeStats-<shardidx>.npz, see mergeLinkStats
+    """
+    writeheader = False
+
+    def __init__(self, shardpath, shardidx, linkInfo, columnar=False, linkstats=False):
+        """
+        shardpath type: str, folder of the shards
+        shardidx type: int, position of the chunk, the shards are merged in this order
+        """
+        MatchedPointsWriter.__init__(self, shardFile(shardpath, 'MatchedPoints', shardidx), shardFile(shardpath, 'MatchedPointsSlope', shardidx), linkInfo, linkstats)
+        self.columnarfile = shardFile(shardpath, 'MatchedPoints', shardidx, '.npz') if columnar else None
+        self.statsfile = shardFile(shardpath, 'LinkSlopeStats', shardidx, '.npz')
+        self.columns = {name: [] for name in COLUMNS}
+
+    def writeProbe(self, probepoint, addiinfo):
+        maprows, sloperows = self.probeRows(probepoint, addiinfo)
+        if not maprows:
+            return
+        self.mapfilewriter.writerows(maprows)
+        self.slopefilewriter.writerows(sloperows)
+        if self.columnarfile:
+            appendColumns(self.columns, maprows, sloperows, addiinfo)
+
+    def __exit__(self, *exc):
+        MatchedPointsWriter.__exit__(self, *exc)
+        if self.columnarfile and not exc[0]:
+            np.savez(self.columnarfile, **columnArrays(self.columns))
+        if self.linkstats is not None and not exc[0]:
+            self.linkstats.save(self.statsfile)
+        return False
+
+
+# columns of the binary output, one entry per row of MatchedPoints.csv
+COLUMNS = ('sampleID', 'dateTime', 'sourceCode', 'latitude', 'longitude', 'altitude', 'speed', 'heading',
+           'linkPVID', 'distFromRef', 'distFromLink', 'probeSlope', 'linkSlope')
+COLUMNDTYPES = {'sampleID': str, 'dateTime': np.int64, 'sourceCode': str, 'latitude': np.float64, 'longitude': np.float64,
+                'altitude': np.float64, 'speed': np.float32, 'heading': np.float32, 'linkPVID': str,
+                'distFromRef': np.float64, 'distFromLink': np.float64, 'probeSlope': np.float64, 'linkSlope': np.float64}
+
+
+def shardFile(shardpath, name, shardidx, ext='.csv'):
+    return os.path.join(shardpath, '{}-{:06d}{}'.format(name, shardidx, ext))
+
+
+def appendColumns(columns, maprows, sloperows, addiinfo):
+    """
+    add the rows of one trajectory to the columns of the binary output
+    dateTime is epoch seconds, text which can't be parsed becomes nan for floats and -1 for dateTime
+    """
+    timestamps = addiinfo.timestamps
+    if timestamps is None:
+        timestamps = [parseTimestamp(row[1]) for row in maprows]
+    columns['dateTime'].extend(timestamps)
+    for name, col in (('sampleID', 0), ('sourceCode', 2), ('latitude', 3), ('longitude', 4), ('linkPVID', 8),
+                      ('distFromRef', 9), ('distFromLink', 10)):
+        columns[name].extend(row[col] for row in maprows)
+    for name, col in (('altitude', 5), ('speed', 6), ('heading', 7)):
+        columns[name].extend(toFloat(row[col]) for row in maprows)
+    for name, col in (('probeSlope', 5), ('linkSlope', 6)):
+        columns[name].extend(toFloat(row[col]) for row in sloperows)
+
+
+def columnArrays(columns):
+    return {name: np.array(columns[name], dtype=COLUMNDTYPES[name]) for name in COLUMNS}
+
+
+def toFloat(value):
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+
+def parseTimestamp(dateTime):
+    try:
+        return parseDateTime(dateTime)
+    except ValueError:
+        return -1
+
+
+def mergeShards(shardpath, mappedfile, slopefile, columnarpath=None, numshards=None, remove=True):
+    """
+    concatenate the csv shards in shard order after the header rows, then remove them unless remove is False
+    numshards type: int, only merge the shards 0 .. numshards-1, by default all shards in the folder
+    the columnar shards are moved to columnarpath as part-000000.npz, ... in the same order
+    """
+    for name, tgtfile, title in (('MatchedPoints', mappedfile, MatchedPointsWriter.maptitle),
+                                 ('MatchedPointsSlope', slopefile, MatchedPointsWriter.slopetitle)):
+        if numshards is None:
+            shards = sorted(glob.glob(os.path.join(shardpath, name + '-*.csv')))
+        else:
+            shards = [shardFile(shardpath, name, shardidx) for shardidx in range(numshards)]
+        with open(tgtfile, 'w') as f:
+            csv.writer(f, delimiter = ',').writerow(title)
+            f.flush()
+            # byte copy, so the line endings written by the csv writers are kept
+            for shard in shards:
+                with open(shard, 'rb') as shardfile:
+                    shutil.copyfileobj(shardfile, f.buffer, MatchedPointsWriter.buffersize)
+                if remove:
+                    os.remove(shard)
+
+    if columnarpath:
+        if os.path.isdir(columnarpath):
+            shutil.rmtree(columnarpath)
+        os.makedirs(columnarpath)
+        for part, shard in enumerate(sorted(glob.glob(os.path.join(shardpath, 'MatchedPoints-*.npz')))):
+            os.replace(shard, os.path.join(columnarpath, 'part-{:06d}.npz'.format(part)))
+
+
+def mergeLinkStats(shardpath, numshards=None, remove=True):
+    """
+    merge the per link slope statistics saved by the shards, then remove them unless remove is False
+    numshards type: int, only merge the shards 0 .. numshards-1, by default all shards in the folder
+    rtype: SlopeAccumulator
+    """
+    if numshards is None:
+        shards = sorted(glob.glob(os.path.join(shardpath, 'LinkSlopeStats-*.npz')))
+    else:
+        shards = [shardFile(shardpath, 'LinkSlopeStats', shardidx, '.npz') for shardidx in range(numshards)]
+    return mergeFiles(shards, remove)
+
+
+def loadColumnar(columnarpath):
+    """
+    rtype: dict of column name -> array, all parts of a binary columnar output concatenated in row order
+    """
+    parts = [np.load(part) for part in sorted(glob.glob(os.path.join(columnarpath, 'part-*.npz')))]
+    return {name: np.concatenate([part[name] for part in parts]) if parts else np.empty(0, dtype=COLUMNDTYPES[name])
+            for name in COLUMNS}
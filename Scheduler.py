@@ -0,0 +1,86 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module schedules the probe data mapping tasks
+pool.map hands out the trajectories in file order in chunks of the same number of trajectories,
+so a chunk touches links all over the partition and long trajectories make some chunks much slower than others.
+Here the trajectories are ordered by their geohash cell, so the trajectories of a batch share their candidate links,
+and batches are cut by number of points instead of trajectories. The batches are many more than the processes
+and every idle worker takes the next one from the pool's task queue, so a slow batch doesn't hold up the others.
+"""
+
+import numpy as np
+
+
+def scheduleKeys(probeInfo):
+    """
+    rtype: lists of the geohashtag and the number of points of each trajectory, read from the columns of the ProbeStore
+            if probeInfo is built on access from one, see ProbeDataSequence, so no ProbeData is built
+    """
+    store = getattr(probeInfo, 'store', None)
+    if store is not None:
+        return store.geohashtags.tolist(), store.pointCounts().tolist()
+    geohashtags, sizes = [], []
+    for probe in probeInfo:
+        geohashtags.append(probe.geohashtag)
+        sizes.append(probe.numpoints)
+    return geohashtags, sizes
+
+
+def localityBatches(probeInfo, batchpoints=4096, workers=1):
+    """
+    group the trajectories into batches of about batchpoints points, in order of their geohashtag
+    batchpoints is lowered so that there are at least 4 batches per worker to take
+    rtype: list of lists of trajectory indices
+    """
+    geohashtags, sizes = scheduleKeys(probeInfo)
+    batchpoints = max(1, min(batchpoints, sum(sizes) // (4 * workers)))
+    order = sorted(range(len(sizes)), key=lambda idx: (geohashtags[idx], idx))
+
+    batches, batch, points = [], [], 0
+    for idx in order:
+        if batch and points + sizes[idx] > batchpoints:
+            batches.append(batch)
+            batch, points = [], 0
+        batch.append(idx)
+        points += sizes[idx]
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def fileOrderBatches(probeInfo, chunksize):
+    """
+    batches of chunksize trajectories in file order, what pool.map does
+    """
+    return [list(range(start, min(start + chunksize, len(probeInfo)))) for start in range(0, len(probeInfo), chunksize)]
+
+
+def defaultChunksize(numtasks, workers):
+    """
+    chunksize pool.map picks for numtasks tasks
+    """
+    chunksize, extra = divmod(numtasks, workers * 4)
+    return chunksize + 1 if extra else chunksize
+
+
+def batchStats(probeInfo, batches):
+    """
+    locality and balance of a schedule
+    distinct_links is the mean number of different candidate links a batch touches,
+    link_reuse is the mean number of candidate lookups per distinct link, higher means better cache reuse
+    rtype: dict
+    """
+    points = np.array([sum(probeInfo[idx].numpoints for idx in batch) for batch in batches])
+    distinct, reuse, cells = [], [], []
+    for batch in batches:
+        candidates = [candidate for idx in batch for candidate in probeInfo[idx].candidatelist]
+        distinct.append(len(set(candidates)))
+        reuse.append(len(candidates) / float(len(set(candidates))) if candidates else 0.0)
+        cells.append(len(set(probeInfo[idx].geohashtag for idx in batch)))
+    return {'batches': len(batches), 'max_batch_points': int(points.max()) if len(points) else 0,
+            'points_imbalance': float(points.max() / points.mean()) if len(points) else 0.0,
+            'distinct_links': float(np.mean(distinct)) if distinct else 0.0,
+            'link_reuse': float(np.mean(reuse)) if reuse else 0.0,
+            'cells_per_batch': float(np.mean(cells)) if cells else 0.0}
@@ -0,0 +1,124 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module maps each point of a trajectory to its own link, for long trips over several links
+The link adjacency (links sharing a ref or non ref node) is precomputed once by LinkDataProcess.loadAdjacency.
+For each point only the beamwidth candidate links nearest to it are kept, and the path through these beams
+with the minimum cost is found by dynamic programming, where the cost is the sum of
+    the distance from each point to its link (distance to the link polyline, see LinkGeometry)
+    switchcost for each change to an adjacent link, jumpcost for each change to a link which is not adjacent
+so the cost of a trajectory is O(points x beamwidth^2) after its candidates are scored.
+"""
+
+import numpy as np
+
+from LinkStore import ArrayStore
+from CandidateCache import CandidateSet
+from SpatialIndex import expandRanges
+
+
+class LinkAdjacency(ArrayStore):
+    """
+    Links sharing a node with each link, as a CSR: neighbors[offsets[i]:offsets[i+1]] are the sorted link indices
+    adjacent to link index i of the LinkStore
+    """
+    arraynames = ('offsets', 'neighbors')
+
+    def __init__(self, offsets, neighbors):
+        """
+        type offsets: (N+1,) int64 array
+        type neighbors: (E,) int32 array
+        """
+        self.offsets = offsets
+        self.neighbors = neighbors
+
+    @classmethod
+    def fromLinkStore(cls, linkstore):
+        numlinks = len(linkstore)
+        nodes = np.concatenate((linkstore.refnode, linkstore.nonrefnode)).astype(np.int64)
+        owners = np.concatenate((np.arange(numlinks), np.arange(numlinks)))
+
+        # links touching each node
+        order = np.argsort(nodes, kind='stable')
+        sortednodes, nodelinks = nodes[order], owners[order]
+        starts = np.searchsorted(sortednodes, nodes, side='left')
+        stops = np.searchsorted(sortednodes, nodes, side='right')
+
+        # every other link at either node of each link, each pair once
+        links = np.repeat(owners, stops - starts)
+        neighbors = nodelinks[expandRanges(starts, stops)]
+        pairs = np.unique(np.column_stack((links, neighbors))[links != neighbors], axis=0).reshape(-1, 2)
+        offsets = np.zeros(numlinks + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs[:, 0], minlength=numlinks), out=offsets[1:])
+        return cls(offsets, pairs[:, 1].astype(np.int32))
+
+    def connected(self, links):
+        """
+        links type: (C,) int array of link indices
+        rtype: (C, C) bool matrix, True where two of the links share a node
+        """
+        links = np.asarray(links, dtype=np.int64)
+        starts, stops = self.offsets[links], self.offsets[links + 1]
+        owners = np.repeat(np.arange(len(links)), stops - starts)
+        neighbors = self.neighbors[expandRanges(starts, stops)]
+
+        sorter = np.argsort(links)
+        found = np.minimum(np.searchsorted(links[sorter], neighbors), len(links) - 1)
+        valid = links[sorter][found] == neighbors
+        matrix = np.zeros((len(links), len(links)), dtype=bool)
+        matrix[owners[valid], sorter[found[valid]]] = True
+        return matrix
+
+
+def beamPath(distfromlink, transition, beamwidth):
+    """
+    distfromlink type: (C, P) matrix, cost of mapping each point to each candidate
+    transition type: (C, C) matrix, cost of moving from a candidate to another between two points
+    rtype: (P,) int array, position of the candidate of each point on the path of minimum total cost,
+            among the beamwidth nearest candidates of each point
+    """
+    numcands, numpoints = distfromlink.shape
+    width = min(beamwidth, numcands)
+    beams = np.argsort(distfromlink, axis=0, kind='stable')[:width]
+    emission = np.take_along_axis(distfromlink, beams, axis=0)
+
+    cost = emission[:, 0].copy()
+    back = np.zeros((width, numpoints), dtype=np.int64)
+    for t in range(1, numpoints):
+        total = cost[:, np.newaxis] + transition[beams[:, t - 1, np.newaxis], beams[np.newaxis, :, t]]
+        back[:, t] = total.argmin(axis=0)
+        cost = total[back[:, t], np.arange(width)] + emission[:, t]
+
+    path = np.empty(numpoints, dtype=np.int64)
+    state = int(cost.argmin())
+    for t in range(numpoints - 1, -1, -1):
+        path[t] = beams[state, t]
+        state = back[state, t]
+    return path
+
+
+def matchSequential(probePoint, linkstore, beamwidth=5, switchcost=10.0, jumpcost=100.0, setslope=True, candidateset=None):
+    """
+    map each point of one ProbeData to a link, the link store needs its geometry and adjacency
+    maplinkIDs is set to the link of each point, maplinkID to the link of the most points,
+    distFromRef and distFromLink of each point are measured to its own link
+    setslope type: bool, False to leave the slopes to the caller, e.g. setSlopes for many ProbeData at once
+    candidateset type: CandidateSet of the candidate links, e.g. from the CandidateCache, gathered here if not given
+    """
+    if candidateset is None:
+        candidateset = CandidateSet(linkstore, linkstore.indices(probePoint.candidatelist))
+    distfromref, distfromlink = linkstore.geometry.polylineDistances(candidateset.links, probePoint.points, candidateset.segments)
+
+    transition = np.where(candidateset.connected, switchcost, jumpcost)
+    np.fill_diagonal(transition, 0.0)
+    path = beamPath(distfromlink, transition, beamwidth)
+
+    columns = np.arange(len(path))
+    linkids = [probePoint.candidatelist[pos] for pos in path.tolist()]
+    probePoint.setMapInfo(probePoint.candidatelist[int(np.bincount(path).argmax())],
+                          distfromref[path, columns].tolist(), distfromlink[path, columns].tolist())
+    probePoint.maplinkIDs = linkids
+    if setslope:
+        probePoint.setSlope(linkstore[linkids[0]].refInfo, linkstore.slopewindow)
+    return probePoint
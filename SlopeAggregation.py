@@ -0,0 +1,224 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module aggregates the slopes of the matched points per link
+For each link it gives the number of matched points, the mean and median probe slope, and the RMSE and bias
+(mean of probe slope - link slope) against the surveyed avgslope of the link, over the same points as the RMSE of
+MatchedPointsWriter. The accumulators are keyed by linkPVID and can be merged, so every worker, shard or checkpoint
+batch can keep its own and the parent merges them. The median comes from a histogram of the slopes with bins of
+resolution degrees, so it is exact up to half a bin.
+It can also be run on the output files of any run:
+
+    python3 SlopeAggregation.py probe_data_map_matching/MatchedPoints.csv probe_data_map_matching/MatchedPointsSlope.csv
+"""
+
+import os
+import csv
+import argparse
+from itertools import islice
+
+import numpy as np
+
+# columns of LinkSlopeStats.csv
+STATSTITLE = ['linkPVID', 'count', 'meanSlope', 'medianSlope', 'linkSlope', 'errorCount', 'rmse', 'bias']
+
+
+class SlopeAccumulator(object):
+    """
+    Per link sums of the matched point slopes, add buffers the points and reduces them in batches of flushsize points
+    """
+    resolution = 0.01
+    flushsize = 1 << 16
+    sumnames = ('count', 'slopesum', 'errcount', 'errsum', 'errsqsum')
+
+    def __init__(self):
+        self.linkPVIDs = np.empty(0, dtype=str)
+        self.linkslope = np.empty(0)
+        for name in self.sumnames:
+            setattr(self, name, np.empty(0))
+        # sparse histogram, histcount[i] points of link histlink[i] in bin histbin[i]
+        self.histlink = np.empty(0, dtype=np.int64)
+        self.histbin = np.empty(0, dtype=np.int64)
+        self.histcount = np.empty(0, dtype=np.int64)
+        self.pending = ([], [], [])
+
+    def add(self, linkPVIDs, slopes, linkslopes):
+        """
+        linkPVIDs type: list, link of each point
+        slopes type: list of float, probe slope of each point
+        linkslopes type: list of float, surveyed slope of the link of each point, None or nan if the link has none
+        """
+        self.pending[0].extend(linkPVIDs)
+        self.pending[1].extend(slopes)
+        self.pending[2].extend(linkslopes)
+        if len(self.pending[0]) >= self.flushsize:
+            self.flush()
+
+    def flush(self):
+        """
+        reduce the buffered points into the per link sums
+        """
+        if not self.pending[0]:
+            return
+        linkPVIDs, slopes, linkslopes = self.pending
+        self.pending = ([], [], [])
+        linkPVIDs = np.array(linkPVIDs, dtype=str)
+        slopes = np.array(slopes, dtype=np.float64)
+        linkslopes = np.array([np.nan if value is None else value for value in linkslopes], dtype=np.float64)
+
+        keys, inverse = np.unique(linkPVIDs, return_inverse=True)
+        errors = slopes - linkslopes
+        surveyed = ~np.isnan(linkslopes)
+        batch = SlopeAccumulator()
+        batch.linkPVIDs = keys
+        batch.linkslope = np.full(len(keys), np.nan)
+        batch.linkslope[inverse[surveyed]] = linkslopes[surveyed]
+        batch.count = np.bincount(inverse, minlength=len(keys)).astype(np.float64)
+        batch.slopesum = np.bincount(inverse, slopes, len(keys))
+        batch.errcount = np.bincount(inverse, surveyed, len(keys))
+        batch.errsum = np.bincount(inverse, np.where(surveyed, errors, 0.0), len(keys))
+        batch.errsqsum = np.bincount(inverse, np.where(surveyed, errors ** 2, 0.0), len(keys))
+        batch.histlink, batch.histbin, batch.histcount = reduceHistogram(inverse, np.rint(slopes / self.resolution).astype(np.int64),
+                                                                         np.ones(len(slopes), dtype=np.int64))
+        self.mergeSums(batch)
+
+    def merge(self, other):
+        """
+        add the sums of another accumulator, e.g. of a worker or a shard
+        """
+        other.flush()
+        self.flush()
+        self.mergeSums(other)
+        return self
+
+    def mergeSums(self, other):
+        keys, inverse = np.unique(np.concatenate((self.linkPVIDs, other.linkPVIDs)), return_inverse=True)
+        numself = len(self.linkPVIDs)
+        for name in self.sumnames:
+            setattr(self, name, np.bincount(inverse, np.concatenate((getattr(self, name), getattr(other, name))), len(keys)))
+        linkslope = np.full(len(keys), np.nan)
+        for values, positions in ((other.linkslope, inverse[numself:]), (self.linkslope, inverse[:numself])):
+            known = ~np.isnan(values)
+            linkslope[positions[known]] = values[known]
+        self.linkslope = linkslope
+        self.histlink, self.histbin, self.histcount = reduceHistogram(
+            np.concatenate((inverse[:numself][self.histlink], inverse[numself:][other.histlink])),
+            np.concatenate((self.histbin, other.histbin)), np.concatenate((self.histcount, other.histcount)))
+        self.linkPVIDs = keys
+
+    def medians(self):
+        """
+        rtype: (K,) array, median slope of each link from the histogram, the mean of the two middle bins for even counts
+        """
+        self.flush()
+        cumulative = np.cumsum(self.histcount)
+        before = np.concatenate(([0], cumulative))[np.searchsorted(self.histlink, np.arange(len(self.linkPVIDs)))]
+        counts = self.count.astype(np.int64)
+        lower = np.searchsorted(cumulative, before + (counts + 1) // 2)
+        upper = np.searchsorted(cumulative, before + counts // 2 + 1)
+        return (self.histbin[lower] + self.histbin[upper]) * self.resolution / 2.0
+
+    def table(self):
+        """
+        rtype: dict of column name of LinkSlopeStats.csv -> (K,) array, links in linkPVID order
+        rmse and bias are nan for the links without surveyed slope
+        """
+        self.flush()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return {'linkPVID': self.linkPVIDs, 'count': self.count.astype(np.int64), 'meanSlope': self.slopesum / self.count,
+                    'medianSlope': self.medians(), 'linkSlope': self.linkslope, 'errorCount': self.errcount.astype(np.int64),
+                    'rmse': np.sqrt(self.errsqsum / self.errcount), 'bias': self.errsum / self.errcount}
+
+    def writeCsv(self, path):
+        """
+        write LinkSlopeStats.csv, the links with the largest squared error first, nan values are left empty
+        """
+        table = self.table()
+        order = np.argsort(-np.nan_to_num(self.errsqsum, nan=0.0), kind='stable')
+        columns = [[str(value) for value in table[name][order].tolist()] if name in ('linkPVID', 'count', 'errorCount')
+                   else ['' if np.isnan(value) else repr(value) for value in table[name][order].tolist()] for name in STATSTITLE]
+        with open(path, 'w') as f:
+            writer = csv.writer(f, delimiter = ',')
+            writer.writerow(STATSTITLE)
+            writer.writerows(zip(*columns))
+
+    def save(self, path):
+        self.flush()
+        np.savez(path, linkPVIDs=self.linkPVIDs, linkslope=self.linkslope, histlink=self.histlink, histbin=self.histbin,
+                 histcount=self.histcount, **{name: getattr(self, name) for name in self.sumnames})
+
+    @classmethod
+    def load(cls, path):
+        accumulator = cls()
+        with np.load(path) as arrays:
+            for name in ('linkPVIDs', 'linkslope', 'histlink', 'histbin', 'histcount') + cls.sumnames:
+                setattr(accumulator, name, arrays[name])
+        return accumulator
+
+
+def reduceHistogram(links, bins, counts):
+    """
+    sum the counts of the same (link, bin) pairs
+    rtype: links, bins, counts sorted by (link, bin)
+    """
+    if not len(links):
+        return links.astype(np.int64), bins.astype(np.int64), counts.astype(np.int64)
+    # one int64 key per pair, sorted by link then bin
+    lowest = int(bins.min())
+    span = int(bins.max()) - lowest + 1
+    keys, inverse = np.unique(links.astype(np.int64) * span + (bins - lowest), return_inverse=True)
+    return keys // span, keys % span + lowest, np.bincount(inverse.ravel(), counts, len(keys)).astype(np.int64)
+
+
+def mergeFiles(paths, remove=False):
+    """
+    rtype: SlopeAccumulator, the merge of the saved accumulators in paths
+    """
+    accumulator = SlopeAccumulator()
+    for path in paths:
+        accumulator.merge(SlopeAccumulator.load(path))
+        if remove:
+            os.remove(path)
+    return accumulator
+
+
+def aggregateFiles(mappedfile, slopefile, chunkrows=1 << 16):
+    """
+    aggregate the output files of a run, read in chunks of chunkrows rows, the rows of both files are in the same order
+    rtype: SlopeAccumulator
+    """
+    accumulator = SlopeAccumulator()
+    with open(mappedfile, 'r') as mapf, open(slopefile, 'r') as slopef:
+        mapreader, slopereader = csv.reader(mapf, delimiter = ','), csv.reader(slopef, delimiter = ',')
+        next(mapreader, None)
+        next(slopereader, None)
+        while True:
+            maprows, sloperows = list(islice(mapreader, chunkrows)), list(islice(slopereader, chunkrows))
+            if not maprows:
+                break
+            accumulator.add([row[8] for row in maprows], [float(row[5]) for row in sloperows],
+                            [float(row[6]) if row[6] != '' else None for row in sloperows])
+    accumulator.flush()
+    return accumulator
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per link slope statistics of the matched points')
+    parser.add_argument('mappedfile', help='MatchedPoints.csv of a run')
+    parser.add_argument('slopefile', help='MatchedPointsSlope.csv of the same run')
+    parser.add_argument('-o', '--output', default=None, help='default LinkSlopeStats.csv next to the mapped file')
+    parser.add_argument('--top', type=int, default=10, help='number of links with the largest squared error to print')
+    args = parser.parse_args()
+
+    accumulator = aggregateFiles(args.mappedfile, args.slopefile)
+    output = args.output or os.path.join(os.path.dirname(args.mappedfile), 'LinkSlopeStats.csv')
+    accumulator.writeCsv(output)
+    print('{} links written to {}'.format(len(accumulator.linkPVIDs), output))
+    with open(output, 'r') as f:
+        for row in islice(csv.reader(f), args.top + 1):
+            print(','.join(row))
+
+
+if __name__ == '__main__':
+    main()
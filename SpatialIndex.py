@@ -0,0 +1,181 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module is the segment level spatial index for the candidate link lookup
+The geohash maps only hash the reference node of each link, so a long link passing through a probe's cell
+is missed unless its reference node is in the same cell. Here every segment of every link polyline
+(ref node, shape nodes, non-ref node) is rasterized into a uniform grid, so any link near a probe point is found.
+"""
+
+import numpy as np
+
+from LinkData import EARTH_RADIUS
+from LinkStore import ArrayStore
+
+# cell keys are (cx + CELLOFFSET) * CELLSPAN + (cy + CELLOFFSET), which fits in int64 for cells of 1 m or more
+CELLOFFSET = 2 ** 30
+CELLSPAN = 2 ** 31
+
+
+class SegmentGridIndex(ArrayStore):
+    """
+    Uniform grid over the link segments, in a local equirectangular projection (meters) around the partition
+    segments of cell cellkeys[i] are cellsegments[celloffsets[i]:celloffsets[i+1]],
+    segment s goes from node segstart[s] to node segstart[s]+1 of the LinkStore and belongs to link seglink[s]
+    """
+    arraynames = ('params', 'xy', 'segstart', 'seglink', 'cellkeys', 'celloffsets', 'cellsegments')
+
+    def __init__(self, params, xy, segstart, seglink, cellkeys, celloffsets, cellsegments):
+        """
+        type params: (2,) float64 array, (reference latitude of the projection, cell size in meters)
+        type xy: (M, 2) float64 array, projected coordinates of every node of the LinkStore
+        type segstart: (S,) int64 array
+        type seglink: (S,) int32 array, non-decreasing
+        type cellkeys: (G,) int64 array, sorted
+        type celloffsets: (G+1,) int64 array
+        type cellsegments: int32 array, segment ids of each cell, ascending within a cell
+        """
+        self.params = params
+        self.xy = xy
+        self.segstart = segstart
+        self.seglink = seglink
+        self.cellkeys = cellkeys
+        self.celloffsets = celloffsets
+        self.cellsegments = cellsegments
+
+        self.reflat, self.cellsize = float(params[0]), float(params[1])
+
+    @classmethod
+    def fromLinkStore(cls, linkstore, cellsize=100.0):
+        """
+        build the index over every segment of every link of a LinkStore
+        cellsize type: float, grid cell size in meters
+        """
+        polyoffsets = np.asarray(linkstore.polyoffsets, dtype=np.int64)
+        coords = np.asarray(linkstore.coords)
+        reflat = float(np.mean(coords[:, 0])) if len(coords) else 0.0
+        xy = project(coords[:, 0], coords[:, 1], reflat)
+
+        # every node except the last of each link starts a segment
+        isstart = np.ones(len(coords), dtype=bool)
+        isstart[polyoffsets[1:] - 1] = False
+        segstart = np.nonzero(isstart)[0]
+        seglink = np.repeat(np.arange(len(polyoffsets) - 1, dtype=np.int32), np.diff(polyoffsets) - 1)
+        # shape nodes without longitude can't be placed in the grid
+        finite = np.isfinite(xy[segstart]).all(axis=1) & np.isfinite(xy[segstart + 1]).all(axis=1)
+        segstart, seglink = segstart[finite], seglink[finite]
+
+        # rasterize the bounding box of each segment into the grid
+        start, end = xy[segstart], xy[segstart + 1]
+        lo = np.floor(np.minimum(start, end) / cellsize).astype(np.int64)
+        hi = np.floor(np.maximum(start, end) / cellsize).astype(np.int64)
+        width = hi[:, 0] - lo[:, 0] + 1
+        ncells = width * (hi[:, 1] - lo[:, 1] + 1)
+
+        segments = np.repeat(np.arange(len(segstart), dtype=np.int64), ncells)
+        within = np.arange(len(segments)) - np.repeat(np.cumsum(ncells) - ncells, ncells)
+        cx = lo[segments, 0] + within % width[segments]
+        cy = lo[segments, 1] + within // width[segments]
+        keys = cellKey(cx, cy)
+
+        order = np.lexsort((segments, keys))
+        keys, segments = keys[order], segments[order]
+        cellkeys, firsts = np.unique(keys, return_index=True)
+        celloffsets = np.append(firsts, len(keys)).astype(np.int64)
+
+        return cls(np.array([reflat, cellsize]), xy, segstart, seglink, cellkeys, celloffsets, segments.astype(np.int32))
+
+    def candidateSegments(self, xy, radius):
+        """
+        rtype: sorted array of the ids of all segments in the cells within radius of any of the points xy
+        """
+        reach = int(np.ceil(radius / self.cellsize))
+        steps = np.arange(-reach, reach + 1)
+        cells = np.floor(xy / self.cellsize).astype(np.int64)
+        # the key of cell (cx + dx, cy + dy) is the key of (cx, cy) plus dx * CELLSPAN + dy
+        neighbours = (steps[:, np.newaxis] * CELLSPAN + steps[np.newaxis, :]).ravel()
+        keys = np.unique((np.unique(cellKey(cells[:, 0], cells[:, 1]))[:, np.newaxis] + neighbours).ravel())
+
+        if not len(self.cellkeys):
+            return np.empty(0, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.cellkeys, keys), len(self.cellkeys) - 1)
+        pos = pos[self.cellkeys[pos] == keys]
+        if not len(pos):
+            return np.empty(0, dtype=np.int64)
+        return np.unique(self.cellsegments[expandRanges(self.celloffsets[pos], self.celloffsets[pos + 1])])
+
+    def linkDistances(self, lat, lon, radius):
+        """
+        distance from each point to the polyline of each link near the points
+        rtype: links: (L,) int array, link indices
+                dist: (P, L) float64 matrix, distance in meters from each point to each link polyline
+        """
+        xy = project(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64), self.reflat)
+        segments = self.candidateSegments(xy, radius)
+        if not len(segments):
+            return np.empty(0, dtype=np.int64), np.empty((len(xy), 0))
+
+        segdist = pointSegmentDistance(xy, self.xy[self.segstart[segments]], self.xy[self.segstart[segments] + 1])
+        # segments are sorted, so the segments of each link are contiguous
+        links, firsts = np.unique(self.seglink[segments], return_index=True)
+        return links, np.minimum.reduceat(segdist, firsts, axis=1)
+
+    def queryPoint(self, lat, lon, radius=50.0, k=8):
+        """
+        bounded radius k nearest links of one point
+        rtype: (k',) int array of link indices within radius, nearest first, k' <= k
+        """
+        links, dist = self.linkDistances([lat], [lon], radius)
+        dist = dist[0]
+        order = np.argsort(dist, kind='stable')
+        order = order[dist[order] <= radius][:k]
+        return links[order]
+
+    def queryTrajectory(self, lat, lon, radius=50.0, k=8):
+        """
+        bounded radius k nearest links of a trajectory
+        links within radius of at least one point are ranked by their mean distance to all points,
+        where distances beyond radius count as radius
+        rtype: (k',) int array of link indices, best first, k' <= k
+        """
+        links, dist = self.linkDistances(lat, lon, radius)
+        near = dist <= radius
+        keep = near.any(axis=0)
+        links, score = links[keep], np.where(near, dist, radius)[:, keep].mean(axis=0)
+        return links[np.argsort(score, kind='stable')[:k]]
+
+
+def project(lat, lon, reflat):
+    """
+    equirectangular projection around reflat, rtype: (N, 2) array of (x, y) in meters
+    """
+    return np.column_stack((EARTH_RADIUS * np.radians(lon) * np.cos(np.radians(reflat)), EARTH_RADIUS * np.radians(lat)))
+
+
+def cellKey(cx, cy):
+    return (cx + CELLOFFSET) * CELLSPAN + (cy + CELLOFFSET)
+
+
+def expandRanges(starts, stops):
+    """
+    rtype: int64 array, concatenation of range(start, stop) for each pair, without a python loop
+    """
+    lengths = stops - starts
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if len(ends) else 0, dtype=np.int64) + np.repeat(starts - (ends - lengths), lengths)
+
+
+def pointSegmentDistance(points, start, end):
+    """
+    planar distance from each point to each segment
+    points type: (P, 2) array, start, end type: (S, 2) arrays
+    rtype: (P, S) matrix
+    """
+    seg = end - start
+    seglen2 = (seg ** 2).sum(axis=1)
+    rel = points[:, np.newaxis, :] - start[np.newaxis, :, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(seglen2 > 0, (rel * seg[np.newaxis, :, :]).sum(axis=2) / seglen2, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.sqrt(((rel - t[:, :, np.newaxis] * seg[np.newaxis, :, :]) ** 2).sum(axis=2))
@@ -0,0 +1,253 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module generates synthetic link and probe data files in the layout of Partition6467LinkData.csv and
+Partition6467ProbePoints.csv (see dataFormat.txt), for benchmarks at any scale without the partition files
+The links form a grid road network of about spacing meters per link, with 0 to 3 shape points, over a smooth terrain
+whose gradient gives the surveyed slopes. Like the real data, some links have no elevation or no slopeInfo.
+Each trajectory drives along adjacent links at a random speed with one point every interval seconds, with GPS noise
+on the position and the altitude. The start links are drawn with weight (rank + 1) ** -skew over a random ranking of
+the links, so skew 0 spreads the trajectories evenly and a larger skew puts most of them on a few hot spots.
+With stops, the vehicles also wait a random time at random places of their trip, e.g. at traffic lights, where
+they keep reporting their position with the same noise and speed 0, as the real probe data does.
+The same seed always gives the same files, e.g.
+
+    python3 SyntheticData.py /tmp/synthetic --links 20000 --trajectories 5000 --points 60 --skew 1.0 --stops 1.5
+"""
+
+import os
+import csv
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from LinkData import EARTH_RADIUS
+
+LINKFILENAME = 'SyntheticLinkData.csv'
+PROBEFILENAME = 'SyntheticProbePoints.csv'
+
+
+class SyntheticNetwork(object):
+    """
+    Grid road network, node (row, col) is at origin + (row, col) * spacing meters
+    each link goes from its ref node to its non ref node through its shape points
+    """
+    def __init__(self, numlinks, spacing=200.0, origin=(51.0, 9.0), seed=0):
+        """
+        numlinks type: int, number of links, the grid is the smallest square with as many
+        spacing type: float, meters between two neighbouring nodes
+        origin type: (latitude, longitude) of the south west node
+        """
+        self.rnd = np.random.RandomState(seed)
+        self.spacing = spacing
+        self.origin = origin
+        self.latstep = np.degrees(spacing / EARTH_RADIUS)
+        self.lonstep = self.latstep / np.cos(np.radians(origin[0]))
+
+        side = 2
+        while 2 * side * (side - 1) < numlinks:
+            side += 1
+        self.side = side
+        rows, cols = np.divmod(np.arange(side * side), side)
+        right = np.column_stack((rows * side + cols, rows * side + cols + 1))[cols < side - 1]
+        up = np.column_stack((rows * side + cols, (rows + 1) * side + cols))[rows < side - 1]
+        edges = np.concatenate((right, up))
+        edges = edges[self.rnd.permutation(len(edges))[:numlinks]]
+        # half of the links are digitized from the other end
+        flip = self.rnd.rand(len(edges)) < 0.5
+        self.refnodes = np.where(flip, edges[:, 1], edges[:, 0])
+        self.nonrefnodes = np.where(flip, edges[:, 0], edges[:, 1])
+        self.linkPVIDs = 500000000 + self.rnd.choice(10 * numlinks, numlinks, replace=False)
+        self.directions = self.rnd.choice(np.array(['F', 'T', 'B']), numlinks, p=[0.15, 0.15, 0.7])
+        self.has3d = self.rnd.rand(numlinks) >= 0.1
+        self.hasslope = self.has3d & (self.rnd.rand(numlinks) >= 0.2)
+
+        # polyline of every link, the ref node first, shape points pushed off the straight line by up to 10 meters
+        steps = np.array([self.latstep, self.lonstep])
+        self.polylines = []
+        for ref, nonref in zip(self.refnodes.tolist(), self.nonrefnodes.tolist()):
+            start, stop = self.nodeLatLon(ref), self.nodeLatLon(nonref)
+            fractions = np.sort(self.rnd.rand(self.rnd.randint(0, 4)))
+            along = (stop - start) / steps
+            normal = np.array([along[1], -along[0]]) * steps
+            offsets = self.rnd.uniform(-10.0, 10.0, len(fractions)) / spacing
+            shape = start + fractions[:, np.newaxis] * (stop - start) + offsets[:, np.newaxis] * normal
+            self.polylines.append(np.vstack((start, shape, stop)))
+
+        # links at each node, for the trips
+        self.nodelinks = [[] for _ in range(side * side)]
+        for linkidx, (ref, nonref) in enumerate(zip(self.refnodes.tolist(), self.nonrefnodes.tolist())):
+            self.nodelinks[ref].append(linkidx)
+            self.nodelinks[nonref].append(linkidx)
+
+    def nodeLatLon(self, node):
+        row, col = divmod(node, self.side)
+        return np.array([self.origin[0] + row * self.latstep, self.origin[1] + col * self.lonstep])
+
+    def altitude(self, latlon):
+        """
+        terrain height in meters of (K, 2) latitudes and longitudes, hills of a few kilometers up to about 5 degrees steep
+        """
+        north = np.radians(latlon[..., 0] - self.origin[0]) * EARTH_RADIUS
+        east = np.radians(latlon[..., 1] - self.origin[1]) * EARTH_RADIUS * np.cos(np.radians(self.origin[0]))
+        return 150.0 + 60.0 * np.sin(north / 1300.0) + 45.0 * np.cos(east / 900.0 + 0.7)
+
+    def linkRow(self, linkidx):
+        """
+        rtype: list, the row of the link in the link data file
+        """
+        polyline = self.polylines[linkidx]
+        lengths = planarLengths(polyline)
+        if self.has3d[linkidx]:
+            heights = self.altitude(polyline)
+            shapeInfo = '|'.join('{:.5f}/{:.5f}/{:.2f}'.format(lat, lon, height) for (lat, lon), height in zip(polyline.tolist(), heights.tolist()))
+        else:
+            shapeInfo = '|'.join('{:.5f}/{:.5f}/'.format(lat, lon) for lat, lon in polyline.tolist())
+        slopeInfo = ''
+        if self.hasslope[linkidx]:
+            heights = self.altitude(polyline)
+            distances = np.concatenate(([0.0], np.cumsum(lengths)[:-1]))
+            slopes = np.degrees(np.arctan2(np.diff(heights), np.maximum(lengths, 1e-6)))
+            slopeInfo = '|'.join('{:.2f}/{:.3f}'.format(distance, slope) for distance, slope in zip(distances.tolist(), slopes.tolist()))
+        speedlimit = int(self.rnd.choice([30, 50, 70, 100]))
+        return [str(self.linkPVIDs[linkidx]), str(self.refnodes[linkidx]), str(self.nonrefnodes[linkidx]),
+                '{:.2f}'.format(lengths.sum()), str(self.rnd.randint(1, 6)), self.directions[linkidx], str(self.rnd.randint(1, 9)),
+                str(speedlimit), str(speedlimit), '1', '1', 'F', 'T', '1.0', shapeInfo, '', slopeInfo]
+
+    def writeLinks(self, linkfile):
+        with open(linkfile, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter = ',')
+            for linkidx in range(len(self.polylines)):
+                writer.writerow(self.linkRow(linkidx))
+
+    def tripPolyline(self, startlink, length):
+        """
+        rtype: (K, 2) polyline of adjacent links driven from a node of startlink, at least length meters long
+        or up to a dead end
+        """
+        polyline, travelled, link = [], 0.0, startlink
+        node = self.refnodes[link] if self.rnd.rand() < 0.5 else self.nonrefnodes[link]
+        while True:
+            nodes = self.polylines[link] if node == self.refnodes[link] else self.polylines[link][::-1]
+            polyline.append(nodes if not polyline else nodes[1:])
+            travelled += planarLengths(nodes).sum()
+            node = self.nonrefnodes[link] if node == self.refnodes[link] else self.refnodes[link]
+            nextlinks = [other for other in self.nodelinks[node] if other != link]
+            if travelled >= length or not nextlinks:
+                return np.vstack(polyline)
+            link = nextlinks[self.rnd.randint(len(nextlinks))]
+
+    def writeProbes(self, probefile, numtrajectories, numpoints, skew=0.0, interval=5.0, noise=5.0, stops=0.0, stopseconds=60.0):
+        """
+        numpoints type: int, mean number of points per trajectory, the numbers are Poisson distributed
+        interval type: float, seconds between two points
+        noise type: float, standard deviation of the position noise in meters, the altitude noise is half of it
+        stops type: float, mean number of stops per trajectory, Poisson distributed
+        stopseconds type: float, mean seconds of a stop, exponentially distributed
+        rtype: int, number of points written
+        """
+        weights = (self.rnd.permutation(len(self.polylines)) + 1.0) ** -skew
+        startlinks = self.rnd.choice(len(self.polylines), numtrajectories, p=weights / weights.sum())
+        start = datetime(2009, 6, 12)
+        written = 0
+        with open(probefile, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter = ',')
+            for trajectory, startlink in enumerate(startlinks.tolist()):
+                count = max(2, self.rnd.poisson(numpoints))
+                speed = self.rnd.uniform(20.0, 110.0)
+                step = speed / 3.6 * interval
+                polyline = self.tripPolyline(startlink, step * count)
+                cumulative = np.concatenate(([0.0], np.cumsum(planarLengths(polyline))))
+                distances = np.minimum(np.arange(count) * step + self.rnd.uniform(0, step), cumulative[-1])
+                stopped = np.zeros(count, dtype=bool)
+                if stops > 0:
+                    distances, stopped = self.stopDistances(distances, stops, stopseconds / interval * step)
+                latlon = np.column_stack((np.interp(distances, cumulative, polyline[:, 0]), np.interp(distances, cumulative, polyline[:, 1])))
+                heights = self.altitude(latlon) + self.rnd.normal(0, noise / 2.0, count)
+                headings = segmentBearings(polyline)[np.clip(np.searchsorted(cumulative, distances, side='right') - 1, 0, len(polyline) - 2)]
+                latlon += self.rnd.normal(0, noise, (count, 2)) * np.array([self.latstep, self.lonstep]) / self.spacing
+                speeds = np.where(stopped, 0.0, np.clip(speed + self.rnd.normal(0, 5.0, count), 0, None))
+
+                sampleID = str(3000000 + trajectory)
+                timestamp = start + timedelta(seconds=int(self.rnd.randint(0, 86400)))
+                rows = []
+                for i, ((lat, lon), height, pointspeed, heading) in enumerate(zip(latlon.tolist(), heights.tolist(), speeds.tolist(), headings.tolist())):
+                    rows.append([sampleID, (timestamp + timedelta(seconds=i * interval)).strftime('%m/%d/%Y %I:%M:%S %p'), '13',
+                                 '{:.6f}'.format(lat), '{:.6f}'.format(lon), str(int(round(height))), str(int(round(pointspeed))), str(int(round(heading)) % 360)])
+                writer.writerows(rows)
+                written += count
+        return written
+
+    def stopDistances(self, distances, stops, stoplength):
+        """
+        put stops into a trip, the vehicle waits at each stop for an exponentially distributed time
+        distances type: (P,) increasing meters along the trip of the points without stops
+        stoplength type: float, mean length of a stop, as the meters the vehicle would have driven meanwhile
+        rtype: distances: (P,) meters along the trip of the points with stops, stopped: (P,) bool, the points at a stop
+        """
+        places = np.sort(self.rnd.uniform(distances[0], distances[-1], self.rnd.poisson(stops)))
+        if not len(places):
+            return distances, np.zeros(len(distances), dtype=bool)
+        lengths = self.rnd.exponential(stoplength, len(places))
+        # stop k covers [starts[k], starts[k] + lengths[k]) of the distances without stops
+        starts = places + np.cumsum(lengths) - lengths
+        last = max(distances[-1], starts[-1] + lengths[-1]) + 1.0
+        withoutstops = np.concatenate(([0.0], np.column_stack((starts, starts + lengths)).ravel(), [last]))
+        withstops = np.concatenate(([0.0], np.repeat(places, 2), [last - lengths.sum()]))
+        before = np.searchsorted(starts, distances, side='right') - 1
+        stopped = (before >= 0) & (distances < (starts + lengths)[np.maximum(before, 0)])
+        return np.interp(distances, withoutstops, withstops), stopped
+
+
+def planarLengths(polyline):
+    """
+    rtype: (K-1,) meters between consecutive nodes of a (K, 2) polyline in degrees
+    """
+    lat = np.radians(polyline[:, 0])
+    steps = np.radians(np.diff(polyline, axis=0))
+    return EARTH_RADIUS * np.hypot(steps[:, 0], steps[:, 1] * np.cos(lat[:-1]))
+
+
+def segmentBearings(polyline):
+    """
+    rtype: (K-1,) degrees clockwise from north of the segments of a (K, 2) polyline in degrees
+    """
+    steps = np.radians(np.diff(polyline, axis=0))
+    return np.degrees(np.arctan2(steps[:, 1] * np.cos(np.radians(polyline[:-1, 0])), steps[:, 0])) % 360.0
+
+
+def generateData(tgtpath, numlinks, numtrajectories, numpoints, skew=0.0, seed=0, stops=0.0, stopseconds=60.0):
+    """
+    write SyntheticLinkData.csv and SyntheticProbePoints.csv to tgtpath
+    stops, stopseconds: see SyntheticNetwork.writeProbes
+    rtype: dict with the file names and the number of links, trajectories and points
+    """
+    os.makedirs(tgtpath, exist_ok=True)
+    network = SyntheticNetwork(numlinks, seed=seed)
+    network.writeLinks(os.path.join(tgtpath, LINKFILENAME))
+    written = network.writeProbes(os.path.join(tgtpath, PROBEFILENAME), numtrajectories, numpoints, skew, stops=stops, stopseconds=stopseconds)
+    return {'linkfile': LINKFILENAME, 'probefile': PROBEFILENAME, 'links': numlinks, 'trajectories': numtrajectories,
+            'points': written, 'skew': skew, 'seed': seed, 'stops': stops, 'stopseconds': stopseconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic link and probe data files')
+    parser.add_argument('tgtpath', help='folder the files are written to')
+    parser.add_argument('--links', type=int, default=10000)
+    parser.add_argument('--trajectories', type=int, default=2000)
+    parser.add_argument('--points', type=int, default=50, help='mean number of points per trajectory')
+    parser.add_argument('--skew', type=float, default=0.0, help='0 for evenly spread trajectories, larger for a few hot spots')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stops', type=float, default=0.0, help='mean number of stops per trajectory')
+    parser.add_argument('--stop-seconds', type=float, default=60.0, help='mean seconds of a stop')
+    args = parser.parse_args()
+
+    report = generateData(args.tgtpath, args.links, args.trajectories, args.points, args.skew, args.seed, args.stops, args.stop_seconds)
+    for key, value in report.items():
+        print('{}: {}'.format(key, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+"""
+@author: Linlin Chen
+    lchen96@hawk.iit.edu
+
+This module runs the probe data mapping as independent geographic tiles, e.g. on separate nodes
+The partition is cut into tiles by geohash prefix: each trajectory belongs to the tile of its first point, and each
+tile gets the links near the cells touched by its trajectories (the halo): the links whose reference node is in a
+touched cell or next to one, for the geohash candidates, and the links whose bounding box, grown by HALOMETERS, covers
+a touched cell, for the segment index. So the candidate links of a border trajectory are the same as in a single
+machine run in both modes. The split streams both files to the tile folders.
+Each tile folder is a self-contained job, and the merge step puts the tile results back in the order of the
+original probe file.
+
+    python3 Tiling.py split --precision 5 --tgtpath ./tiles
+    python3 Tiling.py run ./tiles/u1x0j          (one per tile, on any node)
+    python3 Tiling.py merge ./tiles --tgtpath ./probe_data_map_matching
+    python3 Tiling.py local --jobs 4             (all three steps, at most 4 tiles at a time)
+"""
+
+import os
+import sys
+import csv
+import json
+import glob
+import heapq
+import argparse
+import subprocess
+from collections import OrderedDict
+from itertools import islice
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import geohash
+
+from LinkData import EARTH_RADIUS
+from ProbeMapMatching import ProbeMapMatching, attachLinkInfo, matchProbeChunk, chunkIterable
+from ResultWriter import MatchedPointsWriter
+
+TILEFILE = 'tile.json'
+LINKFILE = 'LinkData.csv'
+PROBEFILE = 'ProbePoints.csv'
+
+# margin in meters of the link bounding boxes, twice the search radius of the segment index, see ProbeDataProcess
+HALOMETERS = 100.0
+# tile files kept open at once by the split
+MAXOPENFILES = 64
+
+
+def readTrajectories(probefile):
+    """
+    group the rows of the probe data file by consecutive sampleID, the same way as ProbeDataProcess
+    the last trajectory is left out, as ProbeDataProcess never emits it
+    yield type: list of rows of each trajectory
+    """
+    rows, previd = [], None
+    with open(probefile, 'r') as f:
+        for line in csv.reader(f, delimiter = ','):
+            if len(line) != 8:
+                continue
+            if line[0] != previd and rows:
+                yield rows
+                rows = []
+            previd = line[0]
+            rows.append(line)
+
+
+def linkNodes(line):
+    """
+    rtype: list of the (latitude, longitude) of the nodes of a link data row, None if ProbeDataProcess would skip the link
+    """
+    shapeInfo = line[14]
+    if not shapeInfo or len(shapeInfo.split('|')) < 2:
+        return None
+    nodes = [tuple(float(val) for val in node.split('/') if val) for node in shapeInfo.split('|')]
+    if len(nodes[0]) < 2 or len(nodes[-1]) < 2:
+        return None
+    return [node[:2] for node in nodes if len(node) >= 2]
+
+
+def coveringCells(south, west, north, east, precision):
+    """
+    rtype: set of the geohash cells of the given precision covering the box, in degrees
+    """
+    _, _, laterr, lonerr = geohash.decode_exactly(geohash.encode(south, west, precision=precision))
+    lats = np.append(np.arange(south, north, 2 * laterr), north)
+    lons = np.append(np.arange(west, east, 2 * lonerr), east)
+    return set(geohash.encode(lat, lon, precision=precision) for lat in lats.tolist() for lon in lons.tolist())
+
+
+def linkCells(line, precision):
+    """
+    rtype: set of the tile cells a link is a candidate for, the cell of its reference node and the cells next to it,
+            and the cells covered by its bounding box grown by HALOMETERS, None if ProbeDataProcess would skip the link
+    """
+    nodes = linkNodes(line)
+    if nodes is None:
+        return None
+    refcell = geohash.encode(*nodes[0], precision=precision)
+    lats, lons = [node[0] for node in nodes], [node[1] for node in nodes]
+    dlat = np.degrees(HALOMETERS / EARTH_RADIUS)
+    dlon = dlat / max(np.cos(np.radians(max(abs(min(lats)), abs(max(lats))) + dlat)), 1e-6)
+    cells = coveringCells(min(lats) - dlat, min(lons) - dlon, max(lats) + dlat, max(lons) + dlon, precision)
+    cells.add(refcell)
+    cells.update(geohash.neighbors(refcell))
+    return cells
+
+
+class TileFiles(object):
+    """
+    csv writers of the tile folders, at most MAXOPENFILES files are open at once, the least recently used are closed
+    and reopened to append
+    """
+    def __init__(self, tilespath, filename):
+        self.tilespath = tilespath
+        self.filename = filename
+        self.files = OrderedDict()
+        self.created = set()
+
+    def writer(self, prefix):
+        if prefix in self.files:
+            self.files.move_to_end(prefix)
+            return self.files[prefix][1]
+        if len(self.files) >= MAXOPENFILES:
+            self.files.popitem(last=False)[1][0].close()
+        tilepath = os.path.join(self.tilespath, prefix)
+        os.makedirs(tilepath, exist_ok=True)
+        f = open(os.path.join(tilepath, self.filename), 'a' if prefix in self.created else 'w')
+        self.created.add(prefix)
+        self.files[prefix] = (f, csv.writer(f, delimiter = ','))
+        return self.files[prefix][1]
+
+    def close(self):
+        for f, _ in self.files.values():
+            f.close()
+        self.files.clear()
+
+
+def splitPartition(linkfile, probefile, tilespath, precision=5):
+    """
+    cut the link and probe data into tile folders under tilespath, the rows are streamed to the tile files,
+    only the trajectory indices and touched cells of each tile are kept in memory
+    precision type: int, geohash precision of the tiles, at most 7 so that every geohash cell of the candidate lookup
+                    lies inside one tile, about 5 km wide for 5
+    rtype: list of tile folders
+    """
+    if not 1 <= precision <= 7:
+        raise ValueError('tile precision must be between 1 and 7')
+
+    tiles = {}
+    # tile cell -> prefixes of the tiles whose trajectories touch it
+    touched = {}
+    probefiles = TileFiles(tilespath, PROBEFILE)
+    try:
+        for trajidx, rows in enumerate(readTrajectories(probefile)):
+            prefix = geohash.encode(float(rows[0][3]), float(rows[0][4]), precision=precision)
+            tiles.setdefault(prefix, {'trajectories': [], 'links': 0})['trajectories'].append([trajidx, len(rows)])
+            for row in rows:
+                touched.setdefault(geohash.encode(float(row[3]), float(row[4]), precision=precision), set()).add(prefix)
+            probefiles.writer(prefix).writerows(rows)
+    finally:
+        probefiles.close()
+
+    linkfiles = TileFiles(tilespath, LINKFILE)
+    try:
+        for prefix in tiles:
+            linkfiles.writer(prefix)
+        with open(linkfile, 'r') as f:
+            for line in csv.reader(f, delimiter = ','):
+                cells = linkCells(line, precision)
+                if cells is None:
+                    continue
+                for prefix in set().union(*(touched.get(cell, ()) for cell in cells)):
+                    linkfiles.writer(prefix).writerow(line)
+                    tiles[prefix]['links'] += 1
+    finally:
+        linkfiles.close()
+
+    cells = {}
+    for cell, prefixes in touched.items():
+        for prefix in prefixes:
+            cells.setdefault(prefix, []).append(cell)
+    tilepaths = []
+    for prefix in sorted(tiles):
+        tilepath = os.path.join(tilespath, prefix)
+        with open(os.path.join(tilepath, TILEFILE), 'w') as f:
+            json.dump({'prefix': prefix, 'precision': precision, 'trajectories': tiles[prefix]['trajectories'],
+                       'cells': sorted(cells[prefix]), 'links': tiles[prefix]['links'], 'halometers': HALOMETERS}, f)
+        tilepaths.append(tilepath)
+    return tilepaths
+
+
+class TileWriter(MatchedPointsWriter):
+    """
+    Writes the rows of a tile with the index of the trajectory in the original probe file as first column,
+    which the merge step orders by
+    """
+    maptitle = ['trajectory'] + MatchedPointsWriter.maptitle
+    slopetitle = ['trajectory'] + MatchedPointsWriter.slopetitle
+
+    def writeTrajectory(self, trajidx, probepoint, addiinfo):
+        maprows, sloperows = self.probeRows(probepoint, addiinfo)
+        if maprows:
+            self.mapfilewriter.writerows([trajidx] + row for row in maprows)
+            self.slopefilewriter.writerows([trajidx] + row for row in sloperows)
+
+
+def runTile(tilepath, segmentindex=False, chunksize=64, workers=None):
+    """
+    map the trajectories of one tile folder, the results are written to the tile folder
+    workers type: int, number of worker processes, all the cpus by default
+    """
+    with open(os.path.join(tilepath, TILEFILE), 'r') as f:
+        tile = json.load(f)
+
+    matchProcess = ProbeMapMatching(tilepath, LINKFILE, PROBEFILE, tilepath, segmentindex=segmentindex)
+    matchProcess.loadData(loadprobes=False)
+    probeProcess = matchProcess.probeDataProcess()
+
+    # the rows of each trajectory are known, so every mapped trajectory keeps its index in the original file
+    probes = []
+    with open(os.path.join(tilepath, PROBEFILE), 'r') as f:
+        reader = csv.reader(f, delimiter = ',')
+        for trajidx, numrows in tile['trajectories']:
+            for probe in probeProcess.iterRows(islice(reader, numrows), flushlast=True):
+                probes.append((trajidx, probe))
+
+    with Pool(workers, initializer=attachLinkInfo, initargs=(matchProcess.linkInfo,)) as pool:
+        results = [probepoint for result in pool.map(matchProbeChunk, chunkIterable((probe for _, probe in probes), chunksize))
+                   for probepoint in result]
+
+    with TileWriter(os.path.join(tilepath, matchProcess.mappedfilename), os.path.join(tilepath, matchProcess.slopefilename), matchProcess.linkInfo) as writer:
+        for (trajidx, (_, addiinfo)), probepoint in zip(probes, results):
+            writer.writeTrajectory(trajidx, probepoint, addiinfo)
+    with open(os.path.join(tilepath, 'stats.json'), 'w') as f:
+        json.dump(writer.stats(), f)
+    return writer.stats()
+
+
+def tileRows(tilepath, filename, rank):
+    """
+    yield type: (trajectory index, rank of the tile, row without the index), in file order
+    """
+    with open(os.path.join(tilepath, filename), 'r') as f:
+        reader = csv.reader(f, delimiter = ',')
+        next(reader, None)
+        for row in reader:
+            yield int(row[0]), rank, row[1:]
+
+
+def mergeTiles(tilespath, mappedfile, slopefile):
+    """
+    merge the results of all tiles into the output files, in the order of the original probe file
+    each trajectory belongs to exactly one tile, the tile of its first point, rows of a trajectory from two tiles
+    mean the tile folders come from different splits
+    rtype: MatchedPointsWriter holding the total slope error statistics
+    """
+    tilepaths = sorted(os.path.dirname(tilefile) for tilefile in glob.glob(os.path.join(tilespath, '*', TILEFILE)))
+    for filename, tgtfile, title in (('MatchedPoints.csv', mappedfile, MatchedPointsWriter.maptitle),
+                                     ('MatchedPointsSlope.csv', slopefile, MatchedPointsWriter.slopetitle)):
+        with open(tgtfile, 'w') as f:
+            writer = csv.writer(f, delimiter = ',')
+            writer.writerow(title)
+            previous = (None, None)
+            # the rows of each tile are in trajectory order, so a k way merge restores the original order
+            for trajidx, rank, row in heapq.merge(*[tileRows(tilepath, filename, rank) for rank, tilepath in enumerate(tilepaths)],
+                                                  key=lambda item: item[:2]):
+                if trajidx == previous[0] and rank != previous[1]:
+                    raise ValueError('trajectory {} was mapped by tiles {} and {}'.format(trajidx, tilepaths[previous[1]], tilepaths[rank]))
+                previous = (trajidx, rank)
+                writer.writerow(row)
+
+    writer = MatchedPointsWriter(mappedfile, slopefile, None)
+    for tilepath in tilepaths:
+        with open(os.path.join(tilepath, 'stats.json'), 'r') as f:
+            writer.addStats(json.load(f))
+    return writer
+
+
+def runLocal(linkfile, probefile, tilespath, tgtpath, precision=5, segmentindex=False, jobs=None, workers=1):
+    """
+    split, run every tile in its own process, then merge, as a local stand in for a multi node run
+    jobs type: int, number of tiles run at once, the number of cpus by default
+    workers type: int, worker processes of each tile
+    """
+    tilepaths = splitPartition(linkfile, probefile, tilespath, precision)
+    command = [sys.executable, os.path.abspath(__file__), 'run', '--workers', str(workers)] + (['--segment-index'] if segmentindex else [])
+
+    def runJob(tilepath):
+        return subprocess.run(command + [tilepath], stdout=subprocess.DEVNULL).returncode
+
+    with ThreadPool(jobs or os.cpu_count()) as pool:
+        for tilepath, returncode in zip(tilepaths, pool.imap(runJob, tilepaths)):
+            if returncode != 0:
+                raise RuntimeError('tile job failed: {}'.format(tilepath))
+    return mergeTiles(tilespath, os.path.join(tgtpath, 'MatchedPoints.csv'), os.path.join(tgtpath, 'MatchedPointsSlope.csv'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Probe data map matching in geographic tiles')
+    subparsers = parser.add_subparsers(dest='step')
+
+    splitparser = subparsers.add_parser('split', help='cut the partition into tile folders')
+    runparser = subparsers.add_parser('run', help='map one tile folder')
+    mergeparser = subparsers.add_parser('merge', help='merge the tile results')
+    localparser = subparsers.add_parser('local', help='split, run each tile as a separate process and merge')
+    for subparser in (splitparser, localparser):
+        subparser.add_argument('--sourcepath', default='./probe_data_map_matching')
+        subparser.add_argument('--linkfile', default='Partition6467LinkData.csv')
+        subparser.add_argument('--probefile', default='Partition6467ProbePoints.csv')
+        subparser.add_argument('--precision', type=int, default=5, help='geohash precision of the tiles')
+        subparser.add_argument('--tilespath', default='./probe_data_map_matching/tiles')
+    for subparser in (mergeparser, localparser):
+        subparser.add_argument('--tgtpath', default='./probe_data_map_matching')
+    for subparser in (runparser, localparser):
+        subparser.add_argument('--segment-index', action='store_true')
+    runparser.add_argument('--workers', type=int, default=None, help='worker processes, all the cpus by default')
+    localparser.add_argument('--workers', type=int, default=1, help='worker processes of each tile')
+    localparser.add_argument('--jobs', type=int, default=None, help='tiles run at once, the number of cpus by default')
+    runparser.add_argument('tilepath')
+    mergeparser.add_argument('tilespath')
+
+    args = parser.parse_args()
+    if args.step == 'split':
+        tilepaths = splitPartition(os.path.join(args.sourcepath, args.linkfile), os.path.join(args.sourcepath, args.probefile),
+                                   args.tilespath, args.precision)
+        print('{} tiles written to {}'.format(len(tilepaths), args.tilespath))
+        return
+    if args.step == 'run':
+        runTile(args.tilepath, args.segment_index, workers=args.workers)
+        return
+    if args.step == 'merge':
+        writer = mergeTiles(args.tilespath, os.path.join(args.tgtpath, 'MatchedPoints.csv'), os.path.join(args.tgtpath, 'MatchedPointsSlope.csv'))
+    elif args.step == 'local':
+        writer = runLocal(os.path.join(args.sourcepath, args.linkfile), os.path.join(args.sourcepath, args.probefile),
+                          args.tilespath, args.tgtpath, args.precision, args.segment_index, args.jobs, args.workers)
+    else:
+        parser.print_help()
+        return
+    print("\nTotally {} probe points are compared with link probe".format(writer.probenum))
+    print('Root mean square error is: {}'.format(writer.rmse()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,8 @@
+"""
+the modules of the repository are imported from its top folder, as the scripts do
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
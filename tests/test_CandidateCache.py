@@ -0,0 +1,67 @@
+import pickle
+
+import Metrics
+from CandidateCache import CandidateCache
+
+
+def builder(value, size, calls):
+    def build():
+        calls.append(value)
+        return value, size
+    return build
+
+
+def testLeastRecentlyUsedEvictedByBytes():
+    cache, calls = CandidateCache(100), []
+    for key in 'abc':
+        cache.get(key, builder(key.upper(), 30, calls))
+    assert cache.get('a', builder('other', 30, calls)) == 'A'
+    # 120 bytes are over the bound, b is the least recently used since a was read again
+    assert cache.get('d', builder('D', 30, calls)) == 'D'
+    assert list(cache.entries) == ['c', 'a', 'd'] and cache.nbytes == 90
+    assert cache.get('b', builder('B', 30, calls)) == 'B'
+    assert calls == ['A', 'B', 'C', 'D', 'B']
+
+    # one large entry evicts as many as needed, one above the bound is not kept at all
+    assert cache.get('e', builder('E', 80, calls)) == 'E'
+    assert list(cache.entries) == ['e'] and cache.nbytes == 80
+    assert cache.get('f', builder('F', 101, calls)) == 'F'
+    assert list(cache.entries) == ['e'] and cache.nbytes == 80
+
+
+def testZeroBytesIsPassthrough():
+    cache, calls = CandidateCache(0), []
+    assert cache.get('a', builder('A', 10, calls)) == 'A'
+    assert cache.get('a', builder('A', 10, calls)) == 'A'
+    assert calls == ['A', 'A']
+    assert len(cache) == 0
+    assert cache.stats() == {'hits': 0, 'misses': 0, 'evictions': 0, 'entries': 0, 'bytes': 0, 'maxbytes': 0, 'hit_rate': 0.0}
+
+
+def testCounters():
+    Metrics.enable()
+    try:
+        cache, calls = CandidateCache(50, name='test_cache'), []
+        for key in 'abab':
+            cache.get(key, builder(key, 20, calls))
+        cache.get('c', builder('c', 20, calls))
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 3, 1)
+        assert stats['entries'] == 2 and stats['bytes'] == 40 and stats['hit_rate'] == 0.4
+        counters = Metrics.registry().counters
+        assert (counters['test_cache_hits'], counters['test_cache_misses'], counters['test_cache_evictions']) == (2, 3, 1)
+        assert Metrics.registry().maxima['test_cache_bytes'] == 40
+    finally:
+        Metrics.disable()
+
+
+def testPickledCopyStartsEmpty():
+    cache = CandidateCache(100, name='test_cache')
+    cache.get('a', builder('A', 30, []))
+    cache.get('a', builder('A', 30, []))
+    copy = pickle.loads(pickle.dumps(cache))
+    assert (copy.maxbytes, copy.name) == (100, 'test_cache')
+    assert len(copy) == 0 and copy.nbytes == 0
+    assert (copy.hits, copy.misses, copy.evictions) == (0, 0, 0)
+    # the original keeps its entries
+    assert len(cache) == 1 and cache.hits == 1
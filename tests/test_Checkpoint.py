@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+import Checkpoint
+from Checkpoint import CheckpointStore
+from ResultWriter import shardFile
+
+ROWS = b'1,a\n1,b\n2,c\n'
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """
+    a checkpoint folder with one committed batch, rtype: function returning a reopened CheckpointStore, and the hashes made
+    """
+    probefile, linkfile = tmp_path / 'probe.csv', tmp_path / 'link.csv'
+    probefile.write_bytes(ROWS)
+    linkfile.write_bytes(b'link\n')
+    path = str(tmp_path / 'checkpoints')
+
+    checkpoints = CheckpointStore(path, str(probefile), str(linkfile))
+    checkpoints.open()
+    for name in ('MatchedPoints', 'MatchedPointsSlope'):
+        with open(shardFile(path, name, 0), 'w') as f:
+            f.write('row\n')
+    checkpoints.commitBatch((0.0, 1, 1), len(ROWS), '2')
+
+    hashed = []
+    rangeDigest = Checkpoint.rangeDigest
+    monkeypatch.setattr(Checkpoint, 'rangeDigest', lambda *args: hashed.append(args) or rangeDigest(*args))
+
+    def reopen():
+        checkpoints = CheckpointStore(path, str(probefile), str(linkfile))
+        checkpoints.open()
+        return checkpoints
+    return reopen, hashed, probefile, path
+
+
+def testResumeWithoutHashing(store):
+    reopen, hashed, _, _ = store
+    assert reopen().numbatches == 1
+    assert hashed == []
+
+
+def testAppendedProbeFileIsHashedOnce(store):
+    reopen, hashed, probefile, _ = store
+    with open(probefile, 'ab') as f:
+        f.write(b'3,d\n')
+    assert reopen().numbatches == 1
+    assert len(hashed) == 1
+    assert reopen().numbatches == 1
+    assert len(hashed) == 1
+
+
+def testChangedProbeFileDropsCheckpoints(store):
+    reopen, hashed, probefile, _ = store
+    probefile.write_bytes(ROWS.replace(b'b', b'x'))
+    os.utime(probefile, ns=(0, 0))
+    assert reopen().numbatches == 0
+    assert len(hashed) == 1
+
+
+def testTruncatedShardDropsCheckpoints(store):
+    reopen, hashed, _, path = store
+    open(shardFile(path, 'MatchedPointsSlope', 0), 'w').close()
+    assert reopen().numbatches == 0
+    assert hashed == []
@@ -0,0 +1,62 @@
+import sys
+import random
+import tracemalloc
+
+import pytest
+
+from ExternalSort import UNPARSED, rowOverhead, sortKey, sortProbeFile
+from ProbeData import parseDateTime
+
+
+def probeLines(count, seed=0):
+    rnd = random.Random(seed)
+    return ['{},06/12/2009 {:02d}:{:02d}:{:02d} {},13,51.0,9.0,100,50,90\r\n'.format(
+        3000 + rnd.randrange(50), rnd.randint(1, 12), rnd.randrange(60), rnd.randrange(60), rnd.choice(['AM', 'PM'])).encode()
+            for _ in range(count)]
+
+
+def testSortInManyRuns(tmp_path):
+    lines = probeLines(5000)
+    sourcefile, tgtfile = tmp_path / 'probes.csv', tmp_path / 'sorted.csv'
+    sourcefile.write_bytes(b''.join(lines))
+    report = sortProbeFile(str(sourcefile), str(tgtfile), memorylimit=64 << 10, fanin=4)
+    assert report['runs'] > 4 and report['passes'] > 1
+    # python's sort is stable, so equal keys keep the file order as in the external sort
+    assert tgtfile.read_bytes() == b''.join(sorted(lines, key=sortKey))
+
+
+def testRowOverheadMatchesMemory():
+    lines = probeLines(20000, seed=1)
+    tracemalloc.start()
+    try:
+        batch, estimate = [], 0
+        for line in lines:
+            key = sortKey(line)
+            batch.append((key, len(batch), line))
+            estimate += len(line) + len(key[0]) + rowOverhead(batch[0])
+        batch.sort()
+        # the lines were allocated before tracing started
+        traced = tracemalloc.get_traced_memory()[1] + sum(sys.getsizeof(line) for line in lines)
+    finally:
+        tracemalloc.stop()
+    assert 0.9 < estimate / float(traced) < 1.2
+
+
+def testUnparsedRowsAreKept(tmp_path):
+    # an ISO dateTime and an hour of 13, which the loader doesn't parse either, and an empty row, which it skips
+    lines = [b'\r\n',
+             b'3001,06/12/2009 06:00:05 AM,13,51.0,9.0,100,50,90\r\n',
+             b'3000,2009-06-12 12:55:21,13,51.0,9.0,100,50,90\r\n',
+             b'3000,06/12/2009 06:00:10 AM,13,51.0,9.0,100,50,90\r\n',
+             b'3001,06/12/2009 13:00:00 PM,13,51.0,9.0,100,50,90\r\n',
+             b'3000,06/12/2009 06:00:00 AM,13,51.0,9.0,100,50,90\r\n']
+    sourcefile, tgtfile = tmp_path / 'probes.csv', tmp_path / 'sorted.csv'
+    sourcefile.write_bytes(b''.join(lines))
+    report = sortProbeFile(str(sourcefile), str(tgtfile))
+    assert report['rows'] == 5 and report['skipped'] == 1 and report['unparsed'] == 2
+    assert tgtfile.read_bytes() == b''.join([lines[5], lines[3], lines[2], lines[1], lines[4]])
+    for line in lines[2], lines[4]:
+        with pytest.raises(ValueError):
+            parseDateTime(line.split(b',')[1])
+        assert sortKey(line)[1] == UNPARSED
+    assert sortKey(lines[1]) == (b'3001', parseDateTime('06/12/2009 06:00:05 AM'))
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from geopy.distance import great_circle
+
+from LinkData import LinkData, greatCircleMatrix, calcdistanceFromRefMatrix, calcdistanceFromLinkMatrix, linkEndpoints, matchCandidates
+
+# geopy warns that the original methods pass points of different altitudes, which it ignores
+pytestmark = pytest.mark.filterwarnings('ignore:Calculating distance between points with different altitudes')
+
+# the vectorized kernels agree with the per point geopy methods within this many meters
+TOLERANCE = 1e-6
+
+
+def randomLinks(rng, count):
+    links = []
+    for _ in range(count):
+        ref = (51.0 + rng.uniform(-0.05, 0.05), 9.0 + rng.uniform(-0.05, 0.05), float(rng.integers(0, 300)))
+        nonref = (ref[0] + rng.uniform(-0.003, 0.003), ref[1] + rng.uniform(-0.003, 0.003), ref[2])
+        links.append(LinkData('1', '2', 'B', ref, nonref, [], None))
+    return links
+
+
+def randomPoints(rng, count):
+    return [(51.0 + rng.uniform(-0.05, 0.05), 9.0 + rng.uniform(-0.05, 0.05), 100.0) for _ in range(count)]
+
+
+def testGreatCircleMatrix():
+    rng = np.random.default_rng(0)
+    points = np.array(randomPoints(rng, 50))
+    others = np.array(randomPoints(rng, 40))
+    matrix = greatCircleMatrix(points[:, 0:1], points[:, 1:2], others[np.newaxis, :, 0], others[np.newaxis, :, 1])
+    expected = [[great_circle(point[:2], other[:2]).meters for other in others] for point in points]
+    assert matrix.shape == (50, 40)
+    assert np.allclose(matrix, expected, rtol=0, atol=TOLERANCE)
+
+
+def testDistanceMatrices():
+    rng = np.random.default_rng(1)
+    links = randomLinks(rng, 20)
+    # a point on a ref node has distance 0 from it and from its link
+    points = randomPoints(rng, 30) + [links[3].refInfo]
+    fromref = calcdistanceFromRefMatrix(links, points)
+    fromlink = calcdistanceFromLinkMatrix(links, points)
+    assert np.allclose(fromref, [link.calcdistanceFromRef(points) for link in links], rtol=0, atol=TOLERANCE)
+    assert np.allclose(fromlink, [link.calcdistanceFromLink(points) for link in links], rtol=0, atol=TOLERANCE)
+    assert fromref[3, -1] == 0 and fromlink[3, -1] == 0
+
+
+def testMatchCandidates():
+    rng = np.random.default_rng(2)
+    for _ in range(20):
+        links = randomLinks(rng, 8)
+        points = randomPoints(rng, 12)
+        idx, distfromref, distfromlink = matchCandidates(linkEndpoints(links), np.array(points))
+        averages = [link.calcavgdistance(points) for link in links]
+        assert idx == averages.index(min(averages))
+        assert np.allclose(distfromref, links[idx].calcdistanceFromRef(points), rtol=0, atol=TOLERANCE)
+        assert np.allclose(distfromlink, links[idx].calcdistanceFromLink(points), rtol=0, atol=TOLERANCE)
+
+
+def testEmptyCandidates():
+    assert calcdistanceFromRefMatrix([], randomPoints(np.random.default_rng(3), 4)).shape == (0, 4)
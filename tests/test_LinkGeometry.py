@@ -0,0 +1,41 @@
+import numpy as np
+
+from LinkData import LinkData, matchCandidates
+from LinkGeometry import LinkGeometry
+from LinkStore import LinkStore
+
+
+def twoLinks():
+    """
+    link A runs east from (51, 9) for about 700 m and the probe points lie on it, link B runs east about 300 m
+    north of A and starts east of the points, so its nearest point to every probe point is its ref node
+    """
+    linkInfo = {'A': LinkData('1', '2', 'B', (51.0, 9.0, 0.0), (51.0, 9.01, 0.0), [], None),
+                'B': LinkData('3', '4', 'B', (51.0027, 9.012, 0.0), (51.0027, 9.02, 0.0), [], None)}
+    points = np.array([(51.0, lon) for lon in (9.002, 9.004, 9.006, 9.008)])
+    return LinkStore.fromLinkInfo(linkInfo), points
+
+
+def testShapeDistancePicksNearestLink():
+    linkstore, points = twoLinks()
+    geometry = LinkGeometry.fromLinkStore(linkstore)
+    links = linkstore.indices(['A', 'B'])
+
+    distfromref, distfromlink = geometry.polylineDistances(links, points)
+    assert np.allclose(distfromref[1], 0.0)
+    assert np.all(distfromlink[1] > 250.0)
+
+    idx, distfromref, distfromlink = geometry.matchCandidates(links, points)
+    assert idx == 0
+    assert np.all(distfromlink < 1.0)
+    assert np.all(distfromref > 100.0)
+    # the same link as the default mapping
+    assert matchCandidates(linkstore.endpoints[links], points)[0] == idx
+
+
+def testShapeDistanceAlongPolyline():
+    linkstore, points = twoLinks()
+    geometry = LinkGeometry.fromLinkStore(linkstore)
+    _, distfromref, _ = geometry.matchCandidates(linkstore.indices(['A']), points)
+    # 0.002 degrees of longitude at 51 degrees north is about 140 m
+    assert np.allclose(np.diff(distfromref), distfromref[0], rtol=1e-3)
@@ -0,0 +1,62 @@
+import numpy as np
+
+from LinkData import LinkData
+from LinkStore import LinkStore, ProbeStore
+from ProbeData import ProbeData, ProbeAdditionalInfo
+
+
+def linkStore():
+    return LinkStore.fromLinkInfo({'A': LinkData('1', '2', 'B', (51.0, 9.0, 0.0), (51.0, 9.01, 0.0), [], None)})
+
+
+def probeStore(columns):
+    """
+    columns type: list of (dateTimes, sourceCodes, speeds, headings) text lists, one per trajectory
+    """
+    probes = [ProbeData(str(idx), 0.0, [(51.0, 9.0 + 0.001 * point, 0.0) for point in range(len(dateTimes))], 'u1x0j', ['A'])
+              for idx, (dateTimes, _, _, _) in enumerate(columns)]
+    return ProbeStore.fromProbeInfo(probes, [ProbeAdditionalInfo(*column) for column in columns], linkStore())
+
+
+def texts(store):
+    return [(addi.dateTimelist, addi.sourceCodelist, addi.speedlist, addi.headinglist) for addi in store.addiInfoList()]
+
+
+COMPACT = [(['06/12/2009 06:00:00 AM', '06/12/2009 06:00:05 AM'], ['13', '13'], ['76', '12.5'], ['3', '350']),
+           (['06/12/2009 11:59:59 PM'], ['4'], ['0'], ['180'])]
+# a speed which float32 doesn't format back, and another date format
+TEXT = [(['2009-06-12 06:00:10'], ['13'], ['76.0'], ['3'])]
+
+
+def testCompactColumns():
+    store = probeStore(COMPACT)
+    assert store.dateTimes.dtype == np.int64
+    assert store.speeds.dtype == np.float32 and store.headings.dtype == np.float32
+    assert store.sourceCodes.dtype == np.uint8 and store.sourceCategories.tolist() == ['13', '4']
+    assert texts(store) == COMPACT
+    assert store.addiInfo(0).timestamps is not None
+
+
+def testTextColumns():
+    store = probeStore(COMPACT + TEXT)
+    assert store.dateTimes.dtype.kind == 'U' and store.speeds.dtype.kind == 'U'
+    assert store.headings.dtype == np.float32
+    assert texts(store) == COMPACT + TEXT
+
+
+def testConcatenate():
+    # chunks with typed and text columns and their own categories, e.g. from a parallel parse
+    store = ProbeStore.concatenate([probeStore(COMPACT[:1]), probeStore(TEXT), probeStore(COMPACT[1:])])
+    assert texts(store) == COMPACT[:1] + TEXT + COMPACT[1:]
+    assert store.sourceCategories.tolist() == ['13', '4']
+    assert texts(ProbeStore.fromArrays(store.arrays())) == texts(store)
+
+
+def testSelect():
+    store = probeStore(COMPACT + TEXT)
+    selected = store.select([2, 0])
+    assert texts(selected) == [TEXT[0], COMPACT[0]]
+    assert selected.pointCounts().tolist() == [1, 2]
+    assert [probe.shapeInfo for probe in selected.probeInfoList(linkStore())] == \
+        [store.probeData(2, linkStore()).shapeInfo, store.probeData(0, linkStore()).shapeInfo]
+    assert len(store.select([])) == 0
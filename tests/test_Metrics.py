@@ -0,0 +1,24 @@
+from multiprocessing import Pool
+
+import Metrics
+
+
+def double(value):
+    return 2 * value
+
+
+def testPickledBytesSampledInParent():
+    Metrics.enable()
+    try:
+        with Pool(1) as pool:
+            results = list(Metrics.poolImap(pool, double, range(40)))
+            assert Metrics.applyAsync(pool, double, 5).get() == 10
+        counters = Metrics.registry().counters
+        assert results == [2 * value for value in range(40)]
+        assert counters['tasks'] == counters['tasks_seen_in'] == counters['tasks_seen_out'] == 41
+        # the tasks 1, 17 and 33 of each direction
+        assert counters['tasks_sampled_in'] == counters['tasks_sampled_out'] == 3
+        assert counters['bytes_pickled_in'] > 0 and counters['bytes_pickled_out'] > 0
+        assert Metrics.report()['derived']['bytes_pickled_in_per_task'] == counters['bytes_pickled_in'] / 3
+    finally:
+        Metrics.disable()
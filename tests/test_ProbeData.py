@@ -0,0 +1,136 @@
+import math
+
+import numpy as np
+import pytest
+from geopy.distance import great_circle
+
+from ProbeData import ProbeData, refnodeArray, slopeArray, slopeArrays, stationaryRuns
+
+# geopy warns that the original methods pass points of different altitudes, which it ignores
+pytestmark = pytest.mark.filterwarnings('ignore:Calculating distance between points with different altitudes')
+
+# geopy's great_circle and greatCircleMatrix agree within 1e-6 meters, the slopes within this many degrees
+TOLERANCE = 1e-9
+
+
+def trajectories():
+    """
+    (points, ref node) of trajectories covering the cases of slopeDegree: integer zero altitudes, a repeated point
+    (zero distance), a ref node without altitude, a single point and no point at all
+    """
+    return [([(51.0, 9.0, 0), (51.0001, 9.0, 0), (51.0002, 9.0001, 3), (51.0002, 9.0001, 5), (51.0003, 9.0002, 0)], (50.9999, 9.0, 2.0)),
+            ([(51.1, 9.1, 10.0)], (51.1001, 9.1, 0)),
+            ([], (51.2, 9.2, 1.0)),
+            ([(51.3, 9.3, 4.0), (51.3001, 9.3, 7.0), (51.3002, 9.3, 6.0)], (51.2999, 9.3)),
+            ([(51.4, 9.4, 1.0), (51.4, 9.4, 1.0)], (51.4, 9.4, 1.0))]
+
+
+def concatenated(cases):
+    offsets = np.zeros(len(cases) + 1, dtype=np.int64)
+    np.cumsum([len(points) for points, _ in cases], out=offsets[1:])
+    points = np.array([point for points, _ in cases for point in points], dtype=np.float64).reshape(-1, 3)
+    return points, offsets, refnodeArray([refnode for _, refnode in cases])
+
+
+def slopeDegrees(points, refnode):
+    """
+    the slopes of the original per point method, from the previous point or the ref node
+    """
+    probe = ProbeData('0', 0, [], None, [])
+    return [probe.slopeDegree(node1, node2) for node1, node2 in zip([refnode] + points[:-1], points)]
+
+
+def windowSlopes(points, refnode, window):
+    """
+    windowed slopes of one trajectory computed point by point: the total altitude change over the total distance
+    of the window steps centered on the point, moved inside the trajectory at its ends
+    """
+    steps = []
+    for node1, node2 in zip([refnode] + points[:-1], points):
+        dist = great_circle(node1[:2], node2[:2]).meters
+        # the steps slopeDegree gives 0 for are left out of the sums
+        steps.append((dist, node2[2] - node1[2]) if len(node1) == 3 and len(node2) == 3 and dist != 0 else (0.0, 0.0))
+    slopes = []
+    for idx in range(len(points)):
+        hi = min(len(points), max(0, idx - window // 2) + window)
+        lo = max(0, hi - window)
+        dist, rise = sum(step[0] for step in steps[lo:hi]), sum(step[1] for step in steps[lo:hi])
+        slopes.append(math.degrees(math.atan(rise / dist)) if dist > 0 else 0)
+    return slopes
+
+
+def testSlopeArrayMatchesSlopeDegree():
+    cases = trajectories()
+    slopes = slopeArrays(*concatenated(cases))
+    assert len(slopes) == len(cases)
+    for (points, refnode), slope in zip(cases, slopes):
+        assert len(slope) == len(points)
+        assert np.allclose(slope, slopeDegrees(points, refnode), rtol=0, atol=TOLERANCE)
+
+
+def testZeroSlopes():
+    points, refnode = trajectories()[0]
+    slopes = slopeArray(*concatenated([(points, refnode)]))
+    # the repeated point has zero distance, nan in slopeArray and the integer 0 in setSlope
+    assert math.isnan(slopes[3])
+    assert not np.isnan(np.delete(slopes, 3)).any()
+    probe = ProbeData('0', 0, points, None, [])
+    probe.setSlope(refnode)
+    assert probe.slpoe[3] == 0 and isinstance(probe.slpoe[3], int)
+    # the ref node has no altitude, so the first point has no slope
+    points, refnode = trajectories()[3]
+    assert math.isnan(slopeArray(*concatenated([(points, refnode)]))[0])
+
+
+def testEmptyAndSinglePoint():
+    assert len(slopeArray(np.empty((0, 3)), np.zeros(1, dtype=np.int64), np.empty((0, 3)))) == 0
+    assert len(slopeArray(np.empty((0, 3)), np.zeros(2, dtype=np.int64), refnodeArray([(51.0, 9.0, 0.0)]), 3)) == 0
+    points, refnode = trajectories()[1]
+    assert np.allclose(slopeArray(*concatenated([(points, refnode)]), 5), slopeDegrees(points, refnode), atol=TOLERANCE)
+
+
+@pytest.mark.parametrize('window', [2, 3, 4, 7])
+def testWindowClippedToTrajectory(window):
+    cases = trajectories()
+    slopes = slopeArrays(*concatenated(cases), window)
+    for (points, refnode), slope in zip(cases, slopes):
+        assert np.allclose(slope, windowSlopes(points, refnode, window), rtol=0, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize('window', [1, 3])
+def testSlopesIndependentOfBatch(window):
+    # the same bits whether a trajectory is computed alone or with others, so every run mode writes the same slopes
+    cases = trajectories()
+    together = slopeArrays(*concatenated(cases), window)
+    for case, slope in zip(cases, together):
+        assert np.array_equal(slopeArrays(*concatenated([case]), window)[0], slope)
+
+
+def testCompressExpand():
+    # runs of 2, 3 and 1 points, e.g. a repeated GPS fix and a vehicle waiting at a light
+    points = [(51.0, 9.0, 1.0), (51.0, 9.0, 1.0), (51.0001, 9.0, 2.0), (51.00010001, 9.0, 2.0), (51.0001, 9.0, 2.0), (51.0002, 9.0, 3.0)]
+    repeats = stationaryRuns(np.array(points), np.array([0, 0, 5, 10, 40, 45]), 10.0, 60.0)
+    assert repeats.tolist() == [2, 3, 1]
+    probe = ProbeData('1', 0.0, points, 'u1x0j', ['A'])
+    probe.compress(repeats)
+    assert probe.numpoints == 3
+    assert probe.shapeInfo == [points[0], points[2], points[5]]
+    probe.setMapInfo('A', [1.0, 2.0, 3.0], [4.0, 5.0, 6.0])
+    probe.slpoe = [0.5, 1.5, 2.5]
+    probe.expand()
+    # every row gets the results of the first point of its run, and the later rows of a run the slope 0
+    assert probe.shapeInfo == points
+    assert probe.distFromRef == [1.0, 1.0, 2.0, 2.0, 2.0, 3.0]
+    assert probe.distFromLink == [4.0, 4.0, 5.0, 5.0, 5.0, 6.0]
+    assert probe.slpoe == [0.5, 0, 1.5, 0, 0, 2.5]
+
+
+def testCompressWithoutRepeats():
+    points = [(51.0, 9.0, 1.0), (51.001, 9.0, 2.0)]
+    assert stationaryRuns(np.array(points), np.array([0, 5]), 10.0, 60.0).tolist() == [1, 1]
+    probe = ProbeData('1', 0.0, points, 'u1x0j', ['A'])
+    probe.compress([1, 1])
+    probe.setMapInfo('A', [1.0, 2.0], [3.0, 4.0])
+    probe.slpoe = [0.5, 1.5]
+    probe.expand()
+    assert probe.shapeInfo == points and probe.distFromRef == [1.0, 2.0] and probe.slpoe == [0.5, 1.5]
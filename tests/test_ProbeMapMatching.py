@@ -0,0 +1,264 @@
+import os
+import csv
+import sys
+import random
+import shutil
+import filecmp
+import datetime
+
+import numpy as np
+import pytest
+
+from ProbeMapMatching import ProbeMapMatching, MatchingOptions, main
+from ResultWriter import loadColumnar, parseTimestamp, toFloat
+
+LINKFILENAME, PROBEFILENAME = 'LinkData.csv', 'ProbePoints.csv'
+OUTPUTS = ('MatchedPoints.csv', 'MatchedPointsSlope.csv')
+
+
+def writeData(path, numlinks=120, numtrajectories=60, seed=0):
+    """
+    write a small link and probe file in the layout of dataFormat.txt, links with and without altitudes and slopes,
+    and trajectories of up to 20 points around the ref node of a random link
+    """
+    rng = random.Random(seed)
+    refnodes = []
+    with open(os.path.join(path, LINKFILENAME), 'w', newline='') as f:
+        writer = csv.writer(f)
+        for idx in range(numlinks):
+            lat, lon = 51.0 + 0.03 * rng.random(), 9.0 + 0.03 * rng.random()
+            shape = '|'.join('{:.5f}/{:.5f}/{}'.format(lat + 0.0005 * k, lon + 0.0004 * k * rng.random(),
+                                                       '' if rng.random() < 0.1 else '{:.1f}'.format(100 + 20 * rng.random()))
+                             for k in range(rng.randint(2, 5)))
+            slopes = '' if rng.random() < 0.3 else '|'.join('{:.2f}/{:.3f}'.format(10.0 * k, rng.uniform(-3, 3)) for k in range(rng.randint(1, 3)))
+            writer.writerow([1000 + idx, idx, idx + 1, 50, 5, rng.choice('FTB'), 7, 50, 50, 1, 1, 'F', 'T', 0.0, shape, '', slopes])
+            refnodes.append((lat, lon))
+    with open(os.path.join(path, PROBEFILENAME), 'w', newline='') as f:
+        writer = csv.writer(f)
+        for sampleID in range(3000, 3000 + numtrajectories):
+            lat, lon = rng.choice(refnodes)
+            time = datetime.datetime(2009, 6, 12) + datetime.timedelta(seconds=rng.randint(0, 86399))
+            for _ in range(rng.randint(1, 20)):
+                writer.writerow([sampleID, time.strftime('%m/%d/%Y %I:%M:%S %p'), 13, '{:.6f}'.format(lat + rng.gauss(0, 0.0003)),
+                                 '{:.6f}'.format(lon + rng.gauss(0, 0.0003)), rng.randint(90, 130), rng.randint(0, 120), rng.randint(0, 359)])
+                time += datetime.timedelta(seconds=rng.choice([0, 5, 5, 10]))
+
+
+def runMode(sourcepath, tgtpath, mode='run', chunksize=8, **options):
+    """
+    map the probe file of sourcepath into tgtpath with the options
+    mode type: 'run', or the run method reading the probe file itself, e.g. 'runStreaming'
+    rtype: tgtpath
+    """
+    matchProcess = ProbeMapMatching(str(sourcepath), LINKFILENAME, PROBEFILENAME, str(tgtpath), **options)
+    if mode == 'run':
+        matchProcess.loadData()
+        matchProcess.run()
+    else:
+        matchProcess.loadData(loadprobes=False)
+        getattr(matchProcess, mode)(chunksize=chunksize)
+    return tgtpath
+
+
+@pytest.fixture(scope='module')
+def default(tmp_path_factory):
+    """
+    rtype: folder of the link and probe files, folder of the output of the default run
+    """
+    sourcepath = tmp_path_factory.mktemp('data')
+    writeData(str(sourcepath))
+    return sourcepath, runMode(sourcepath, tmp_path_factory.mktemp('default'))
+
+
+def sameOutput(tgtpath, expected):
+    return all(filecmp.cmp(str(expected / name), str(tgtpath / name), shallow=False) for name in OUTPUTS)
+
+
+def testDefaultRunMatches(default):
+    _, expected = default
+    with open(str(expected / 'MatchedPoints.csv')) as f:
+        assert sum(1 for _ in f) > 100
+
+
+def testSharedStore(default, tmp_path):
+    sourcepath, expected = default
+    assert sameOutput(runMode(sourcepath, tmp_path, sharedstore=True), expected)
+
+
+def testStreaming(default, tmp_path):
+    sourcepath, expected = default
+    assert sameOutput(runMode(sourcepath, tmp_path, 'runStreaming'), expected)
+
+
+def testCacheReuse(default, tmp_path):
+    # the second run loads the link and probe data from the caches of the first
+    sourcepath, expected = default
+    runMode(sourcepath, tmp_path)
+    for cache in ('linkcache', 'probecache'):
+        assert os.path.exists(str(tmp_path / cache / 'manifest.json'))
+        os.utime(str(tmp_path / cache / 'manifest.json'), ns=(0, 0))
+    for name in OUTPUTS:
+        os.remove(str(tmp_path / name))
+    assert sameOutput(runMode(sourcepath, tmp_path), expected)
+    for cache in ('linkcache', 'probecache'):
+        assert os.stat(str(tmp_path / cache / 'manifest.json')).st_mtime_ns == 0
+
+
+def testParallelLinkParse(default, tmp_path):
+    sourcepath, expected = default
+    assert sameOutput(runMode(sourcepath, tmp_path, linkworkers=3), expected)
+
+
+def testParallelProbeParse(default, tmp_path):
+    sourcepath, expected = default
+    assert sameOutput(runMode(sourcepath, tmp_path, probeworkers=3), expected)
+
+
+def testSortProbes(default, tmp_path):
+    # the rows of each trajectory are already contiguous and in time order, so sorting changes nothing
+    sourcepath, expected = default
+    assert sameOutput(runMode(sourcepath, tmp_path, sortprobes=True), expected)
+
+
+@pytest.mark.parametrize('mode', ['run', 'runStreaming'])
+def testShardedOutput(default, tmp_path, mode):
+    sourcepath, expected = default
+    assert sameOutput(runMode(sourcepath, tmp_path, mode, shardedoutput=True), expected)
+
+
+def testColumnarOutput(default, tmp_path):
+    # the binary columns hold the same rows as the csv files
+    sourcepath, expected = default
+    assert sameOutput(runMode(sourcepath, tmp_path, shardedoutput=True, columnar=True), expected)
+    columns = loadColumnar(str(tmp_path / 'MatchedPoints'))
+    with open(str(expected / 'MatchedPoints.csv')) as f:
+        maprows = list(csv.reader(f))[1:]
+    with open(str(expected / 'MatchedPointsSlope.csv')) as f:
+        sloperows = list(csv.reader(f))[1:]
+    assert len(columns['sampleID']) == len(maprows) == len(sloperows)
+    assert columns['sampleID'].tolist() == [row[0] for row in maprows]
+    assert columns['linkPVID'].tolist() == [row[8] for row in maprows]
+    assert columns['dateTime'].tolist() == [parseTimestamp(row[1]) for row in maprows]
+    for name, col in (('latitude', 3), ('longitude', 4), ('altitude', 5), ('distFromRef', 9), ('distFromLink', 10)):
+        assert columns[name].tolist() == [float(row[col]) for row in maprows]
+    for name, col in (('speed', 6), ('heading', 7)):
+        assert columns[name].tolist() == [float(np.float32(row[col])) for row in maprows]
+    for name, col in (('probeSlope', 5), ('linkSlope', 6)):
+        assert np.array_equal(columns[name], np.array([toFloat(row[col]) for row in sloperows]), equal_nan=True)
+
+
+def testLocality(default, tmp_path):
+    sourcepath, expected = default
+    matchProcess = ProbeMapMatching(str(sourcepath), LINKFILENAME, PROBEFILENAME, str(tmp_path), locality=True)
+    # small batches, so the trajectories come back out of file order
+    matchProcess.batchpoints = 50
+    matchProcess.loadData()
+    matchProcess.run()
+    assert sameOutput(tmp_path, expected)
+
+
+def testCompressStationary(default, tmp_path):
+    # every row repeated up to 3 times, the repeats are collapsed before matching and written back after it
+    sourcepath, _ = default
+    repeated = tmp_path / 'data'
+    repeated.mkdir()
+    shutil.copy(str(sourcepath / LINKFILENAME), str(repeated / LINKFILENAME))
+    rng = random.Random(1)
+    with open(str(sourcepath / PROBEFILENAME)) as f, open(str(repeated / PROBEFILENAME), 'w') as out:
+        for line in f:
+            out.write(line * rng.randint(1, 3))
+    full = runMode(repeated, tmp_path / 'full')
+    compressed = runMode(repeated, tmp_path / 'compressed', compress=(10.0, 60.0))
+    with open(str(full / 'MatchedPoints.csv')) as f:
+        fullrows = list(csv.reader(f))
+    with open(str(compressed / 'MatchedPoints.csv')) as f:
+        maprows = list(csv.reader(f))
+    with open(str(compressed / 'MatchedPointsSlope.csv')) as f:
+        sloperows = list(csv.reader(f))
+    assert [row[:8] for row in maprows] == [row[:8] for row in fullrows]
+    repeats = [idx for idx in range(2, len(maprows)) if maprows[idx][:8] == maprows[idx-1][:8]]
+    assert repeats
+    for idx in repeats:
+        assert maprows[idx][8:] == maprows[idx-1][8:]
+        assert float(sloperows[idx][5]) == 0.0
+
+
+def testNoCompressionIsDefault(default, tmp_path):
+    # nothing is within 0 meters and 0 seconds of another point of the test data
+    sourcepath, expected = default
+    assert sameOutput(runMode(sourcepath, tmp_path / 'none', compress=None), expected)
+    assert sameOutput(runMode(sourcepath, tmp_path / 'zero', compress=(0.0, 0.0)), expected)
+
+
+def testIncremental(default, tmp_path):
+    sourcepath, expected = default
+    assert sameOutput(runMode(sourcepath, tmp_path, 'runIncremental'), expected)
+    # the second run resumes after the last batch and maps nothing
+    for name in OUTPUTS:
+        os.remove(str(tmp_path / name))
+    assert sameOutput(runMode(sourcepath, tmp_path, 'runIncremental'), expected)
+
+
+def testOptionsConflicts(tmp_path, monkeypatch):
+    assert MatchingOptions().conflicts() == []
+    assert len(MatchingOptions(sharedstore=True, sequential=True).conflicts()) == 1
+    with pytest.raises(ValueError):
+        ProbeMapMatching(str(tmp_path), LINKFILENAME, PROBEFILENAME, str(tmp_path), sharedstore=True, sequential=True)
+    # the command line rejects them before loading anything
+    monkeypatch.setattr(sys, 'argv', ['ProbeMapMatching.py', '--sourcepath', str(tmp_path), '--shared-store', '--sequential'])
+    with pytest.raises(SystemExit):
+        main()
+
+
+def testStreamingConflicts():
+    assert MatchingOptions(sharedstore=True).conflicts() == []
+    assert len(MatchingOptions(sharedstore=True).conflicts('streaming')) == 1
+
+
+def testShardedOutputConflicts():
+    assert MatchingOptions(shardedoutput=True, columnar=True).conflicts() == []
+    assert len(MatchingOptions(columnar=True).conflicts()) == 1
+    assert len(MatchingOptions(sharedstore=True, shardedoutput=True).conflicts()) == 1
+
+
+def testLocalityConflicts():
+    assert MatchingOptions(locality=True).conflicts() == []
+    assert len(MatchingOptions(locality=True, sharedstore=True).conflicts()) == 1
+    assert len(MatchingOptions(locality=True, shardedoutput=True).conflicts()) == 1
+    for mode in ('streaming', 'incremental'):
+        assert len(MatchingOptions(locality=True).conflicts(mode)) == 1
+
+
+def testIncrementalConflicts(tmp_path, monkeypatch):
+    assert MatchingOptions(shardedoutput=True).conflicts('streaming') == []
+    assert len(MatchingOptions(shardedoutput=True).conflicts('incremental')) == 1
+    assert len(MatchingOptions(sharedstore=True).conflicts('incremental')) == 1
+    monkeypatch.setattr(sys, 'argv', ['ProbeMapMatching.py', '--sourcepath', str(tmp_path), '--streaming', '--incremental'])
+    with pytest.raises(SystemExit):
+        main()
+
+
+def testProfileWorkerConflicts():
+    assert MatchingOptions(metrics=True, profileworker='sampling').conflicts() == []
+    assert len(MatchingOptions(profileworker='sampling').conflicts()) == 1
+
+
+def testSortProbesKeepsUnparsedRows(default, tmp_path):
+    # a dateTime the loader keeps as text, the sort keeps the row after the other rows of its sampleID
+    sourcepath, _ = default
+    changed = tmp_path / 'data'
+    changed.mkdir()
+    shutil.copy(str(sourcepath / LINKFILENAME), str(changed / LINKFILENAME))
+    with open(str(sourcepath / PROBEFILENAME)) as f:
+        lines = f.readlines()
+    row = lines[3].split(',')
+    row[1] = '2009-06-12 12:55:21'
+    lines[3] = ','.join(row)
+    with open(str(changed / PROBEFILENAME), 'w') as f:
+        f.writelines(lines)
+    rows = {}
+    for name, options in (('default', {}), ('sorted', {'sortprobes': True})):
+        with open(str(runMode(changed, tmp_path / name, **options) / 'MatchedPoints.csv')) as f:
+            rows[name] = sorted(line.split(',')[:8] for line in f)
+    assert [row[0], '2009-06-12 12:55:21'] in [line[:2] for line in rows['sorted']]
+    assert rows['sorted'] == rows['default']
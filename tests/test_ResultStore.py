@@ -0,0 +1,77 @@
+import io
+import csv
+import sys
+
+import pytest
+
+from ProbeData import parseDateTime
+from ProbeMapMatching import ProbeMapMatching
+from ResultStore import ResultStore, main
+from SyntheticData import generateData, LINKFILENAME, PROBEFILENAME
+
+
+@pytest.fixture(scope='module')
+def run(tmp_path_factory):
+    """
+    rtype: output folder of a synthetic run with the result store,
+            (sampleID, epoch seconds, linkPVID, distFromRef, probeSlope) of each row of the csv output in file order
+    """
+    sourcepath, tgtpath = tmp_path_factory.mktemp('data'), tmp_path_factory.mktemp('output')
+    generateData(str(sourcepath), 200, 40, 20)
+    matchProcess = ProbeMapMatching(str(sourcepath), LINKFILENAME, PROBEFILENAME, str(tgtpath), resultstore=True, progress=0)
+    matchProcess.loadData()
+    matchProcess.run()
+    with open(str(tgtpath / 'MatchedPoints.csv'), newline='') as mapped, open(str(tgtpath / 'MatchedPointsSlope.csv'), newline='') as slope:
+        rows = [(maprow[0], parseDateTime(maprow[1]), maprow[8], float(maprow[9]), float(sloperow[5]))
+                for maprow, sloperow in list(zip(csv.reader(mapped), csv.reader(slope)))[1:]]
+    return tgtpath, rows
+
+
+def keyColumns(rows):
+    return [(row[0], row[1], row[8], row[9], row[11]) for row in rows]
+
+
+def testQueriesMatchCsv(run):
+    tgtpath, rows = run
+    with ResultStore(str(tgtpath / 'MatchedPoints.db')) as store:
+        assert len(store) == len(rows)
+
+        linkPVID = rows[len(rows) // 2][2]
+        expected = [row for row in rows if row[2] == linkPVID]
+        assert keyColumns(store.link(linkPVID)) == expected
+        assert keyColumns(store.link(linkPVID, limit=1)) == expected[:1]
+        start, stop = expected[0][1], expected[0][1] + 30
+        assert keyColumns(store.link(linkPVID, start, stop)) == [row for row in expected if start <= row[1] < stop]
+
+        sampleID = rows[-1][0]
+        assert keyColumns(store.trajectory(sampleID)) == [row for row in rows if row[0] == sampleID]
+
+        times = sorted(row[1] for row in rows)
+        start, stop = times[len(times) // 4], times[len(times) // 2]
+        expected = [row for row in rows if start <= row[1] < stop]
+        assert 0 < len(expected) < len(rows)
+        assert keyColumns(store.timeRange(start, stop)) == expected
+        assert keyColumns(store.timeRange(start, None)) == [row for row in rows if row[1] >= start]
+
+        summary = store.linkSummary(linkPVID)
+        assert summary['points'] == len(store.link(linkPVID))
+        assert summary['trajectories'] == len(set(row[0] for row in rows if row[2] == linkPVID))
+
+
+def testCommandLine(run, tmp_path, monkeypatch, capsys):
+    tgtpath, rows = run
+    dbpath = str(tmp_path / 'loaded.db')
+    monkeypatch.setattr(sys, 'argv', ['ResultStore.py', 'load', dbpath, str(tgtpath / 'MatchedPoints.csv'), str(tgtpath / 'MatchedPointsSlope.csv')])
+    main()
+    with ResultStore(dbpath) as loaded, ResultStore(str(tgtpath / 'MatchedPoints.db')) as written:
+        assert loaded.timeRange(None, None) == written.timeRange(None, None)
+    capsys.readouterr()
+
+    # the rows written by the query command are those of the csv output, with the same dateTime text
+    sampleID = rows[0][0]
+    monkeypatch.setattr(sys, 'argv', ['ResultStore.py', 'trajectory', dbpath, sampleID])
+    main()
+    output = list(csv.reader(io.StringIO(capsys.readouterr().out)))
+    with open(str(tgtpath / 'MatchedPoints.csv'), newline='') as mapped:
+        expected = [row for row in csv.reader(mapped) if row[0] == sampleID]
+    assert [row[:3] + row[8:9] for row in output[1:]] == [row[:3] + row[8:9] for row in expected]
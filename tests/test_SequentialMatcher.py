@@ -0,0 +1,80 @@
+import numpy as np
+
+from ProbeMapMatching import ProbeMapMatching, matchProbeData
+from SequentialMatcher import LinkAdjacency, beamPath
+from SyntheticData import generateData, LINKFILENAME, PROBEFILENAME
+
+
+class CountingMatrix(object):
+    """
+    transition matrix recording how many entries beamPath reads from it
+    """
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.reads = []
+
+    def __getitem__(self, key):
+        values = self.matrix[key]
+        self.reads.append(values.size)
+        return values
+
+
+def testLinksFollowAdjacency(tmp_path):
+    sourcepath = str(tmp_path / 'data')
+    generateData(sourcepath, 300, 30, 40)
+    matchProcess = ProbeMapMatching(sourcepath, LINKFILENAME, PROBEFILENAME, str(tmp_path), sequential=True, progress=0)
+    matchProcess.loadData()
+    linkstore = matchProcess.linkInfo
+
+    multilink = 0
+    for probePoint in matchProcess.probeInfo:
+        matchProbeData(probePoint, linkstore)
+        assert len(probePoint.maplinkIDs) == probePoint.numpoints
+        changes = [(prev, link) for prev, link in zip(probePoint.maplinkIDs[:-1], probePoint.maplinkIDs[1:]) if prev != link]
+        multilink += bool(changes)
+        for prev, link in changes:
+            # the trips are driven over adjacent links, so each change of link is to a link sharing a node
+            prevnodes = {linkstore[prev].refID, linkstore[prev].nonrefID}
+            assert prevnodes & {linkstore[link].refID, linkstore[link].nonrefID}
+            prevlink, nextlink = linkstore.indices([prev, link])
+            assert linkstore.adjacency.connected([prevlink, nextlink])[0, 1]
+    assert multilink > len(matchProcess.probeInfo) // 3
+
+
+def testAdjacencyMatchesSharedNodes(tmp_path):
+    sourcepath = str(tmp_path / 'data')
+    generateData(sourcepath, 60, 1, 2)
+    matchProcess = ProbeMapMatching(sourcepath, LINKFILENAME, PROBEFILENAME, str(tmp_path), sequential=True, progress=0)
+    matchProcess.loadData()
+    linkstore = matchProcess.linkInfo
+    adjacency = LinkAdjacency.fromLinkStore(linkstore)
+
+    nodes = [{link.refID, link.nonrefID} for link in map(linkstore.link, range(len(linkstore)))]
+    for idx, linknodes in enumerate(nodes):
+        expected = [other for other, othernodes in enumerate(nodes) if other != idx and linknodes & othernodes]
+        assert adjacency.neighbors[adjacency.offsets[idx]:adjacency.offsets[idx + 1]].tolist() == expected
+
+
+def testBeamWidthBoundsWork():
+    rnd = np.random.RandomState(0)
+    numpoints = 30
+    for numcands in (10, 200):
+        transition = CountingMatrix(rnd.uniform(0, 20, (numcands, numcands)))
+        path = beamPath(rnd.uniform(0, 50, (numcands, numpoints)), transition, 4)
+        assert path.shape == (numpoints,)
+        # beamwidth^2 transitions per point, whatever the number of candidates
+        assert transition.reads == [16] * (numpoints - 1)
+
+
+def testFullBeamIsExact():
+    rnd = np.random.RandomState(1)
+    numcands, numpoints = 5, 4
+    distfromlink = rnd.uniform(0, 50, (numcands, numpoints))
+    transition = rnd.uniform(0, 20, (numcands, numcands))
+    path = beamPath(distfromlink, transition, numcands)
+
+    def cost(states):
+        return (distfromlink[states, np.arange(numpoints)].sum()
+                + sum(transition[prev, state] for prev, state in zip(states[:-1], states[1:])))
+    best = min(np.ndindex(*([numcands] * numpoints)), key=lambda states: cost(list(states)))
+    assert np.isclose(cost(path.tolist()), cost(list(best)))
@@ -0,0 +1,47 @@
+import numpy as np
+
+from SlopeAggregation import SlopeAccumulator
+
+
+def randomPoints(seed, numpoints=2000, numlinks=30):
+    """
+    rtype: linkPVIDs, slopes, linkslopes of random points, a third of the links without surveyed slope
+    """
+    rnd = np.random.RandomState(seed)
+    links = rnd.randint(0, numlinks, numpoints)
+    surveyed = rnd.uniform(-3, 3, numlinks)
+    surveyed[::3] = np.nan
+    linkslopes = [None if np.isnan(surveyed[link]) else surveyed[link] for link in links.tolist()]
+    return [str(1000 + link) for link in links.tolist()], rnd.normal(0, 4, numpoints).tolist(), linkslopes
+
+
+def accumulate(linkPVIDs, slopes, linkslopes, flushsize=SlopeAccumulator.flushsize):
+    accumulator = SlopeAccumulator()
+    accumulator.flushsize = flushsize
+    for start in range(0, len(linkPVIDs), 100):
+        accumulator.add(linkPVIDs[start:start + 100], slopes[start:start + 100], linkslopes[start:start + 100])
+    return accumulator
+
+
+def testMergeEqualsOneAccumulator():
+    linkPVIDs, slopes, linkslopes = randomPoints(0)
+    expected = accumulate(linkPVIDs, slopes, linkslopes).table()
+
+    # uneven parts, the first without some of the links and flushed in small batches
+    parts = [slice(0, 50), slice(50, 1300), slice(1300, None)]
+    accumulators = [accumulate(linkPVIDs[part], slopes[part], linkslopes[part], flushsize=150) for part in parts]
+    merged = accumulators[0].merge(accumulators[1].merge(accumulators[2])).table()
+    assert merged['linkPVID'].tolist() == expected['linkPVID'].tolist()
+    for name, values in expected.items():
+        if name != 'linkPVID':
+            assert np.allclose(merged[name], values, equal_nan=True), name
+
+
+def testMediansWithinHalfBin():
+    for seed in range(3):
+        linkPVIDs, slopes, linkslopes = randomPoints(seed, numpoints=301 + seed)
+        accumulator = accumulate(linkPVIDs, slopes, linkslopes)
+        medians = accumulator.medians()
+        pointlinks = np.array(linkPVIDs)
+        expected = [np.median(np.array(slopes)[pointlinks == link]) for link in accumulator.linkPVIDs.tolist()]
+        assert np.all(np.abs(medians - expected) <= SlopeAccumulator.resolution / 2 + 1e-9)
@@ -0,0 +1,50 @@
+import numpy as np
+
+from LinkData import LinkData, EARTH_RADIUS
+from LinkStore import LinkStore
+from SpatialIndex import SegmentGridIndex
+
+LAT = 51.0225
+# degrees of longitude per meter at LAT
+LONSTEP = np.degrees(1.0 / (EARTH_RADIUS * np.cos(np.radians(LAT))))
+
+
+def linkStore():
+    """
+    a 5 km straight link running north from its ref node, and short links parallel to it 10, 20, ... 80 m to the east
+    of its middle, the nearest first
+    """
+    links = {'long': LinkData('1', '2', 'B', (51.0, 9.0, 0.0), (51.045, 9.0, 0.0), [(51.0225, 9.0, 0.0)], None)}
+    for meters in range(10, 90, 10):
+        lon = 9.0 + meters * LONSTEP
+        links['east{}'.format(meters)] = LinkData(str(meters), str(meters + 1), 'B', (LAT - 0.0002, lon, 0.0), (LAT + 0.0002, lon, 0.0), [], None)
+    return LinkStore.fromLinkInfo(links)
+
+
+def linkIDs(linkstore, links):
+    return [linkstore.linkPVIDs[idx] for idx in links.tolist()]
+
+
+def testLongLinkFromFarCell():
+    linkstore = linkStore()
+    index = SegmentGridIndex.fromLinkStore(linkstore, cellsize=100.0)
+    # the ref node of the long link is 2.5 km south, many cells away from the point
+    assert linkIDs(linkstore, index.queryPoint(LAT, 9.0 + 5 * LONSTEP, radius=50.0, k=1)) == ['long']
+    assert linkIDs(linkstore, index.queryTrajectory([LAT, LAT + 0.001], [9.0 + 5 * LONSTEP] * 2, radius=50.0, k=1)) == ['long']
+
+
+def testNearestWithinRadius():
+    linkstore = linkStore()
+    index = SegmentGridIndex.fromLinkStore(linkstore, cellsize=100.0)
+    lon = 9.0 - 5 * LONSTEP
+    ordered = ['long'] + ['east{}'.format(meters) for meters in range(10, 90, 10)]
+    # 5 m west of the long link, so the east links are 15, 25, ... 85 m away
+    assert linkIDs(linkstore, index.queryPoint(LAT, lon, radius=100.0, k=20)) == ordered
+    assert linkIDs(linkstore, index.queryPoint(LAT, lon, radius=100.0, k=3)) == ordered[:3]
+    assert linkIDs(linkstore, index.queryPoint(LAT, lon, radius=40.0, k=20)) == ordered[:4]
+    assert linkIDs(linkstore, index.queryPoint(LAT, lon, radius=2.0, k=20)) == []
+
+    # a link within radius of one point only is ranked with radius for the other points
+    lats, lons = [LAT, LAT + 0.004], [lon, lon]
+    assert linkIDs(linkstore, index.queryTrajectory(lats, lons, radius=40.0, k=20)) == ordered[:4]
+    assert linkIDs(linkstore, index.queryTrajectory(lats, lons, radius=40.0, k=2)) == ordered[:2]
@@ -0,0 +1,57 @@
+import os
+import csv
+import json
+import filecmp
+
+import geohash
+import pytest
+
+from ProbeMapMatching import ProbeMapMatching
+from SyntheticData import generateData, LINKFILENAME, PROBEFILENAME
+from Tiling import linkCells, mergeTiles, runLocal, TILEFILE
+
+
+@pytest.mark.parametrize('segmentindex', [False, True])
+def testLocalRunMatchesSingleRun(tmp_path, segmentindex):
+    sourcepath = str(tmp_path / 'data')
+    generateData(sourcepath, 300, 40, 20)
+    single, tiled = tmp_path / 'single', tmp_path / 'tiled'
+    single.mkdir()
+    tiled.mkdir()
+    matchProcess = ProbeMapMatching(sourcepath, LINKFILENAME, PROBEFILENAME, str(single), segmentindex=segmentindex, progress=0)
+    matchProcess.loadData()
+    matchProcess.run()
+
+    # precision 6 cuts the synthetic network into many tiles, so many trajectories cross a tile border
+    runLocal(os.path.join(sourcepath, LINKFILENAME), os.path.join(sourcepath, PROBEFILENAME), str(tmp_path / 'tiles'), str(tiled),
+             precision=6, segmentindex=segmentindex, jobs=2)
+    assert len(os.listdir(str(tmp_path / 'tiles'))) > 4
+    for filename in ('MatchedPoints.csv', 'MatchedPointsSlope.csv'):
+        assert filecmp.cmp(str(single / filename), str(tiled / filename), shallow=False)
+
+
+def testLongLinkReachesFarCells():
+    # a 5 km straight link running north, its middle is far outside the cells next to its reference node
+    nodes = [(51.0 + 0.009 * step, 9.0) for step in range(6)]
+    line = ['1', '1', '2', '5000', '1', 'B', '1', '50', '50', '1', '1', 'F', 'T', '1.0',
+            '|'.join('{}/{}/'.format(lat, lon) for lat, lon in nodes), '', '']
+    cells = linkCells(line, 6)
+    refcell = geohash.encode(*nodes[0], precision=6)
+    middle = geohash.encode(51.0225, 9.0, precision=6)
+    assert refcell in cells and set(geohash.neighbors(refcell)) <= cells
+    assert middle not in geohash.neighbors(refcell) and middle in cells
+    assert geohash.encode(*nodes[-1], precision=6) in cells
+
+
+def testMergeRejectsTrajectoryInTwoTiles(tmp_path):
+    header = ['trajectory', 'sampleID']
+    for prefix in ('u1x0', 'u1x1'):
+        tilepath = tmp_path / prefix
+        tilepath.mkdir()
+        (tilepath / TILEFILE).write_text(json.dumps({'prefix': prefix}))
+        (tilepath / 'stats.json').write_text(json.dumps([0.0, 0, 0]))
+        for filename in ('MatchedPoints.csv', 'MatchedPointsSlope.csv'):
+            with open(str(tilepath / filename), 'w') as f:
+                csv.writer(f).writerows([header, ['3', '100']])
+    with pytest.raises(ValueError):
+        mergeTiles(str(tmp_path), str(tmp_path / 'MatchedPoints.csv'), str(tmp_path / 'MatchedPointsSlope.csv'))